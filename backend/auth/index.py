@@ -7,15 +7,233 @@ Returns: HTTP response dict с данными пользователя или о
 
 import json
 import os
+import math
+import base64
+import calendar
+import functools
 import hashlib
+import hmac
+import random
 import secrets
 import re
+import sys
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from collections import Counter, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Set
 import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local — корзины в памяти контейнера, postgres — общая таблица rate_limit_buckets, off — без лимитов
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# Сколько запросов контейнер одновременно пускает к базе; остальным сразу 503, а не очередь за соединением
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Бюджеты действий: (ёмкость корзины, пополнение токенов в секунду); RATE_LIMIT_OVERRIDES='{"login": [10, 0.2]}'
+RATE_LIMITS = {
+    'login': (10, 10 / 60),
+    'register': (5, 1 / 60),
+    'default': (60, 5),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Выборочное профилирование: доля вызовов, действия через запятую (send,GET) или заголовок X-Profile-Key
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Стеки копятся всё время жизни тёплого контейнера и выгружаются каждые PROFILE_DUMP_EVERY профилированных вызовов
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# Пользовательские таблицы (emails, search_history, downloads) могут лежать в нескольких базах;
+# DATABASE_URL остаётся домашней базой для users, sessions и справочника user_shards
+SHARD_DSNS: List[str] = json.loads(os.environ['DATABASE_SHARDS']) if os.environ.get('DATABASE_SHARDS') else [DATABASE_URL]
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', '60'))
+# Реплики для чтения: {"<dsn основной базы>": ["<dsn реплики>", ...]}; база без реплик читается сама
+REPLICA_DSNS: Dict[str, List[str]] = json.loads(os.environ.get('DATABASE_REPLICAS') or '{}')
+REPLICA_LAG_CACHE_TTL = float(os.environ.get('REPLICA_LAG_CACHE_TTL', '1'))
+MAINTENANCE_KEY = os.environ.get('MAINTENANCE_KEY')
+SESSION_SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', '5000'))
+SESSION_SWEEP_MAX_BATCHES = int(os.environ.get('SESSION_SWEEP_MAX_BATCHES', '20'))
+SESSION_TOKEN_MODE = os.environ.get('SESSION_TOKEN_MODE', 'db')
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_CACHE_TTL = float(os.environ.get('REVOCATION_CACHE_TTL', '30'))
+SIGNED_TOKEN_PREFIX = 'v1.'
+NIKMAIL_ATTEMPTS = 3
+
+SESSION_USER_SQL = """
+    SELECT u.id, u.email, u.phone, u.nikmail, u.display_name, u.avatar_url, u.created_at, s.expires_at
+    FROM users u
+    JOIN sessions s ON u.id = s.user_id
+    WHERE s.token_hash = $1 AND s.expires_at > $2 AND u.is_active = true
+"""
+
+# Вся регистрация одним запросом: занятые email/телефон/nikmail ловит ON CONFLICT,
+# а приветственное письмо уходит в mail_outbox и доставляется пачками функцией mail
+REGISTER_SQL = """
+    WITH new_user AS (
+        INSERT INTO users (email, phone, password_hash, nikmail, display_name, created_at, updated_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $6)
+        ON CONFLICT DO NOTHING
+        RETURNING id, email, phone, nikmail, display_name, created_at
+    ),{session}
+    new_settings AS (
+        INSERT INTO user_settings (user_id, dark_mode, default_search_engine, updated_at)
+        SELECT id, FALSE, 'google', $6 FROM new_user
+    ),
+    welcome AS (
+        INSERT INTO mail_outbox (user_id, template, payload, created_at)
+        SELECT id, 'welcome', json_build_object('nikmail', nikmail, 'display_name', display_name), $6
+        FROM new_user
+    )
+    SELECT * FROM new_user
+"""
+
+REGISTER_SESSION_CTE = """
+    new_session AS (
+        INSERT INTO sessions (user_id, token_hash, expires_at, created_at)
+        SELECT id, $7, $8, $6 FROM new_user
+    ),"""
+
+# Подписанный токен уже проверен в процессе: нужен только сам пользователь, срок берём из токена
+SIGNED_USER_SQL = """
+    SELECT u.id, u.email, u.phone, u.nikmail, u.display_name, u.avatar_url, u.created_at, $2::timestamp AS expires_at
+    FROM users u
+    WHERE u.id = $1 AND u.is_active = true
+"""
+
+BOOTSTRAP_USER_COLUMNS = """
+        row_to_json(me) AS user,
+        (SELECT row_to_json(st) FROM (
+            SELECT dark_mode, default_search_engine, settings_json
+            FROM user_settings WHERE user_id = me.id
+        ) st) AS settings
+"""
+
+# Данные из пользовательских таблиц; номера параметров лимитов подставляются,
+# потому что на отдельном шарде запрос получает только user_id
+BOOTSTRAP_DATA_COLUMNS = """
+        (SELECT json_build_object(
+            'inbox', count(*) FILTER (WHERE is_archived = FALSE AND snoozed_until IS NULL),
+            'unread', count(*) FILTER (WHERE is_archived = FALSE AND snoozed_until IS NULL AND is_read = FALSE),
+            'starred', count(*) FILTER (WHERE is_starred = TRUE AND is_archived = FALSE),
+            'archived', count(*) FILTER (WHERE is_archived = TRUE)
+        ) FROM emails WHERE user_id = me.id) AS mail_counts,
+        (SELECT COALESCE(json_agg(e), '[]') FROM (
+            SELECT id, from_email, from_name, subject, is_read, is_starred, created_at
+            FROM emails
+            WHERE user_id = me.id AND is_archived = FALSE AND snoozed_until IS NULL
+            ORDER BY created_at DESC
+            LIMIT ${mail_limit}
+        ) e) AS inbox,
+        (SELECT COALESCE(json_agg(h), '[]') FROM (
+            SELECT id, search_query, search_engine, created_at
+            FROM search_history
+            WHERE user_id = me.id AND is_incognito = false
+            ORDER BY created_at DESC
+            LIMIT ${history_limit}
+        ) h) AS history,
+        (SELECT COALESCE(json_agg(d), '[]') FROM (
+            SELECT d.id, d.file_name, c.file_url, d.file_size, d.file_type, d.download_status,
+                   d.progress, d.created_at, d.completed_at, d.is_installed, d.installed_at
+            FROM downloads d
+            JOIN download_catalog c ON c.url_hash = d.url_hash
+            WHERE d.user_id = me.id
+            ORDER BY d.created_at DESC
+            LIMIT ${downloads_limit}
+        ) d) AS downloads
+"""
+
+BOOTSTRAP_SQL = "WITH me AS ({me}) SELECT {columns} FROM me"
+
+# Горячие запросы: PREPARE один раз на соединение из пула, дальше только EXECUTE
+STATEMENTS = {
+    'auth_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'auth_session_user': SESSION_USER_SQL,
+    'auth_signed_user': SIGNED_USER_SQL,
+    'auth_bootstrap': BOOTSTRAP_SQL.format(
+        me=SESSION_USER_SQL,
+        columns=BOOTSTRAP_USER_COLUMNS + ',' + BOOTSTRAP_DATA_COLUMNS.format(mail_limit=3, history_limit=4, downloads_limit=5)
+    ),
+    'auth_bootstrap_signed': BOOTSTRAP_SQL.format(
+        me=SIGNED_USER_SQL,
+        columns=BOOTSTRAP_USER_COLUMNS + ',' + BOOTSTRAP_DATA_COLUMNS.format(mail_limit=3, history_limit=4, downloads_limit=5)
+    ),
+    'auth_bootstrap_user': BOOTSTRAP_SQL.format(me=SESSION_USER_SQL, columns=BOOTSTRAP_USER_COLUMNS),
+    'auth_bootstrap_user_signed': BOOTSTRAP_SQL.format(me=SIGNED_USER_SQL, columns=BOOTSTRAP_USER_COLUMNS),
+    'auth_bootstrap_data': BOOTSTRAP_SQL.format(
+        me="SELECT $1::integer AS id",
+        columns=BOOTSTRAP_DATA_COLUMNS.format(mail_limit=2, history_limit=3, downloads_limit=4)
+    ),
+    'auth_revoked_since': """
+        SELECT jti, revoked_at, EXTRACT(EPOCH FROM expires_at)::bigint AS exp
+        FROM revoked_tokens
+        WHERE revoked_at >= $1 AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'auth_register': REGISTER_SQL.format(session=REGISTER_SESSION_CTE),
+    'auth_register_signed': REGISTER_SQL.format(session=''),
+    'auth_user_shard': "SELECT shard, moving_to FROM user_shards WHERE user_id = $1",
+    'auth_insert_session': """
+        INSERT INTO sessions (user_id, token_hash, expires_at, created_at)
+        VALUES ($1, $2, $3, $4)
+    """,
+}
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Jump consistent hash: при добавлении шарда переезжает только ~1/n пользователей
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+_shard_directory: Dict[int, Tuple[float, Optional[int], Optional[int]]] = {}
+
+def user_shard_dsn(user_id: int, for_write: bool = False) -> str:
+    if len(SHARD_DSNS) == 1:
+        return SHARD_DSNS[0]
+    
+    user_id = int(user_id)
+    now = time.time()
+    cached = _shard_directory.get(user_id)
+    
+    if not cached or cached[0] <= now:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            execute_prepared(cur, 'auth_user_shard', (user_id,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        if len(_shard_directory) > 10000:
+            _shard_directory.clear()
+        cached = (now + SHARD_DIRECTORY_TTL, row['shard'] if row else None, row['moving_to'] if row else None)
+        _shard_directory[user_id] = cached
+    
+    _, pinned_shard, moving_to = cached
+    if for_write and moving_to is not None:
+        raise ShardUnavailable()
+    
+    return SHARD_DSNS[pinned_shard if pinned_shard is not None else jump_hash(user_id, len(SHARD_DSNS))]
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -23,6 +241,83 @@ def hash_password(password: str) -> str:
 def generate_session_token() -> str:
     return secrets.token_urlsafe(32)
 
+def hash_session_token(session_token: str) -> bytes:
+    return hashlib.sha256(session_token.encode('utf-8', 'surrogatepass')).digest()
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def issue_signed_token(user_id: int, expires_at: datetime) -> str:
+    payload = f"{SIGNED_TOKEN_PREFIX}{user_id}.{calendar.timegm(expires_at.utctimetuple())}.{secrets.token_urlsafe(12)}"
+    return f"{payload}.{sign_token_payload(payload)}"
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    # Настоящие токены состоят из ASCII; остальное — сразу мимо, а подписи сравниваются байтами
+    if not SESSION_SIGNING_KEY or not session_token.isascii() or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    
+    parts = session_token.split('.')
+    if len(parts) != 5:
+        return None
+    
+    if not hmac.compare_digest(parts[4].encode(), sign_token_payload('.'.join(parts[:4])).encode()):
+        return None
+    
+    try:
+        claims = {'user_id': int(parts[1]), 'exp': int(parts[2]), 'jti': parts[3]}
+    except ValueError:
+        return None
+    
+    return claims if claims['exp'] > time.time() else None
+
+_revoked: Dict[str, int] = {}
+_revoked_checked_at = 0.0
+_revoked_watermark = datetime(1970, 1, 1)
+
+def is_token_revoked(jti: str) -> bool:
+    global _revoked_checked_at, _revoked_watermark
+    
+    now = time.time()
+    if now - _revoked_checked_at >= REVOCATION_CACHE_TTL:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Перекрываем окно на минуту, чтобы не пропустить отзывы из долгих транзакций
+            execute_prepared(cur, 'auth_revoked_since', (_revoked_watermark - timedelta(minutes=1),))
+            for row in cur.fetchall():
+                _revoked[row['jti']] = row['exp']
+                _revoked_watermark = max(_revoked_watermark, row['revoked_at'])
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        for expired_jti in [key for key, exp in _revoked.items() if exp <= now]:
+            _revoked.pop(expired_jti, None)
+        _revoked_checked_at = now
+    
+    return jti in _revoked
+
+def session_lookup(session_token: str) -> Optional[Tuple[str, tuple]]:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        claims = decode_signed_token(session_token)
+        if not claims or is_token_revoked(claims['jti']):
+            return None
+        return 'signed', (claims['user_id'], datetime.utcfromtimestamp(claims['exp']))
+    
+    return 'session', (psycopg2.Binary(hash_session_token(session_token)), datetime.utcnow())
+
+def create_session(cur, user_id: int) -> Tuple[str, datetime]:
+    expires_at = datetime.utcnow() + timedelta(days=30)
+    
+    if SESSION_TOKEN_MODE == 'signed' and SESSION_SIGNING_KEY:
+        return issue_signed_token(user_id, expires_at), expires_at
+    
+    session_token = generate_session_token()
+    execute_prepared(cur, 'auth_insert_session', (user_id, psycopg2.Binary(hash_session_token(session_token)), expires_at, datetime.utcnow()))
+    return session_token, expires_at
+
 def generate_nikmail(email: Optional[str], phone: Optional[str]) -> str:
     if email:
         base = email.split('@')[0]
@@ -42,10 +337,389 @@ def validate_phone(phone: str) -> bool:
     pattern = r'^\+?[1-9]\d{1,14}$'
     return bool(re.match(pattern, phone.replace(' ', '').replace('-', '')))
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+class PreparedConnection(PgConnection):
+    '''Соединение, которое помнит, какие STATEMENTS уже подготовлены в его серверной сессии'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class ShardUnavailable(Exception):
+    '''Строки пользователя сейчас переносятся между шардами, запись придётся повторить'''
+
+_pools: Dict[str, ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_db_connection(dsn: Optional[str] = None):
+    dsn = dsn or DATABASE_URL
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, dsn,
+                    connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+                )
+    conn = pool.getconn()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    conn.dsn_key = dsn
+    return conn
+
+def release_db_connection(conn) -> None:
+    pool = _pools.get(getattr(conn, 'dsn_key', None))
+    if pool is None:
+        conn.close()
+        return
+    pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Серверную сессию сбросили (например, DISCARD ALL у пулера):
+        # забываем подготовленное и повторяем один раз, если ничего не теряем
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def lsn_to_int(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+def primary_tag(dsn: str) -> str:
+    # LSN разных основных баз несравнимы, поэтому метка называет свою базу
+    return hashlib.sha256(dsn.encode()).hexdigest()[:8]
+
+def parse_min_lsn(headers: Dict[str, Any]) -> Dict[str, int]:
+    '''X-Min-LSN: метки "<тег базы>:<lsn>" через запятую, полученные клиентом из X-Write-LSN'''
+    markers: Dict[str, int] = {}
+    value = headers.get('X-Min-LSN') or headers.get('x-min-lsn') or ''
+    
+    for marker in value.split(','):
+        tag, _, lsn = marker.strip().partition(':')
+        try:
+            markers[tag] = max(markers.get(tag, 0), lsn_to_int(lsn))
+        except ValueError:
+            continue
+    
+    return markers
+
+_replica_replayed: Dict[str, Tuple[float, int]] = {}
+
+def read_dsn(dsn: str, min_lsn: Dict[str, int]) -> str:
+    '''Реплика dsn, уже применившая последнюю запись клиента, иначе сама основная база'''
+    replicas = REPLICA_DSNS.get(dsn)
+    if not replicas:
+        return dsn
+    
+    replica = random.choice(replicas)
+    needed = min_lsn.get(primary_tag(dsn), 0)
+    if not needed:
+        return replica
+    
+    now = time.time()
+    checked_at, replayed = _replica_replayed.get(replica, (0.0, 0))
+    if replayed >= needed:
+        return replica
+    if now - checked_at < REPLICA_LAG_CACHE_TTL:
+        return dsn
+    
+    try:
+        conn = get_db_connection(replica)
+    except psycopg2.OperationalError:
+        return dsn
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT pg_last_wal_replay_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    replayed = lsn_to_int(lsn) if lsn else 0
+    _replica_replayed[replica] = (now, replayed)
+    return replica if replayed >= needed else dsn
+
+def commit_with_marker(conn) -> Optional[str]:
+    '''Коммитит и, если у базы есть реплики, возвращает метку X-Write-LSN для этого коммита'''
+    conn.commit()
+    if not REPLICA_DSNS.get(conn.dsn_key):
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+    
+    return f"{primary_tag(conn.dsn_key)}:{lsn}"
+
+def write_marker_headers(marker: Optional[str]) -> Dict[str, str]:
+    return {'X-Write-LSN': marker, 'Access-Control-Expose-Headers': 'X-Write-LSN'} if marker else {}
+
+# Лимиты запросов и ограничение параллельности. Код от _buckets до body_action одинаков во всех
+# функциях backend/, а remember_session_user и session_user — во всех, где есть сессии (кроме downloads):
+# функции деплоятся по отдельности и общего модуля у них нет. Правка вносится во все копии сразу;
+# своё у каждой функции только rate_limit_key и префикс ключа в take_token
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Берёт токен из корзины key; возвращает 0 или через сколько секунд появится следующий'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # Переполненное хранилище вытесняет дольше всех не виденную корзину, а не сбрасывает все лимиты
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # Та же корзина, но общая для всех контейнеров: пополнение и списание одним UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'auth_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # В ключе нет сырых токенов сессии: хранилище может быть общей таблицей
+    key = hashlib.sha256(f"auth:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # Недоступное хранилище лимитов не должно ронять запросы: считаем по месту
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Адрес клиента, который видит шлюз; X-Forwarded-For пишет сам клиент, и ключом лимита он быть не может.
+    None — вызов пришёл не через шлюз'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Тело запроса для лимитов, профилировщика и route; кривое тело или не объект читается как пустой объект'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+# Владельцы обычных сессий по хэшу токена, только как ключ лимита: записывает их полная проверка сессии,
+# а лимит лишь читает, так что собственная корзина пользователя не стоит лишнего запроса к базе.
+# Доступ по-прежнему решает проверка сессии, устаревшая запись влияет только на выбор корзины
+_session_users: "OrderedDict[bytes, int]" = OrderedDict()
+_session_users_lock = threading.Lock()
+
+def remember_session_user(session_token: str, user_id: Optional[int]) -> None:
+    '''Запоминает владельца проверенной сессии; user_id=None — сессии больше нет'''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    
+    token_hash = hash_session_token(session_token)
+    with _session_users_lock:
+        if user_id is None:
+            _session_users.pop(token_hash, None)
+            return
+        _session_users[token_hash] = user_id
+        _session_users.move_to_end(token_hash)
+        while len(_session_users) > RATE_LIMIT_LOCAL_MAX:
+            _session_users.popitem(last=False)
+
+def session_user(session_token: str) -> Optional[int]:
+    '''Пользователь токена без запроса к базе; None — токен в этом контейнере ещё не проверялся'''
+    claims = decode_signed_token(session_token)
+    if claims:
+        return claims['user_id']
+    
+    with _session_users_lock:
+        return _session_users.get(hash_session_token(session_token))
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(действие, клиент) для лимитов; None — запрос не ограничивается'''
+    action = body_action(body_data) or 'default'
+    
+    if action == 'sweep_sessions' and is_maintenance_request(event.get('headers') or {}):
+        return None
+    
+    session_token = body_data.get('session_token')
+    user_id = None
+    # Подбор паролей идёт без сессии, поэтому вход и регистрация считаются по адресу клиента
+    if action not in ('login', 'register') and isinstance(session_token, str) and session_token:
+        # Своя корзина у пользователя, чей токен уже проверен; непроверенный токен считается по адресу,
+        # иначе каждый выдуманный токен давал бы свежий лимит
+        user_id = session_user(session_token)
+    identity = f"user:{user_id}" if user_id else client_ip(event)
+    # Без адреса запрос не ограничивается: общая корзина на всех таких клиентов душила бы их разом
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Стек кадра в формате collapsed stacks: от корня к листу через точку с запятой'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Поток-сэмплер просыпается, только пока идёт хоть один профилируемый вызов
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Число разных стеков ограничено, чтобы профиль не съел память контейнера
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Решение принимается до любой работы: непрофилируемый вызов платит за пару проверок'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Накопленные стеки целиком: в PROFILE_DIR (файл перезаписывается) или в лог'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"auth-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE auth pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Оборачивает handler сэмплирующим профилировщиком и передаёт ему разобранное тело запроса'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # Тело разбирается здесь один раз и передаётся лимитам, профилировщику и route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Лимиты проверяются до любой работы с базой, перегрузка отвечает сразу, а не копится в очереди
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off снимает только лимиты, ограничение параллельных запросов к базе остаётся
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -54,7 +728,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -62,7 +736,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action')
             
             if action == 'register':
@@ -70,9 +743,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             elif action == 'login':
                 return login_user(body_data)
             elif action == 'verify_session':
-                return verify_session(body_data)
+                return verify_session(body_data, parse_min_lsn(event.get('headers') or {}))
             elif action == 'logout':
                 return logout_user(body_data)
+            elif action == 'bootstrap':
+                return bootstrap_user(body_data, parse_min_lsn(event.get('headers') or {}))
+            elif action == 'sweep_sessions':
+                return sweep_sessions(event.get('headers') or {}, body_data)
             else:
                 return {
                     'statusCode': 400,
@@ -131,88 +808,55 @@ def register_user(data: Dict[str, Any]) -> Dict[str, Any]:
     cur = conn.cursor()
     
     try:
-        if email:
-            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-            if cur.fetchone():
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email уже зарегистрирован'})
-                }
+        password_hash = hash_password(password)
+        now = datetime.utcnow()
+        expires_at = now + timedelta(days=30)
+        signed = SESSION_TOKEN_MODE == 'signed' and bool(SESSION_SIGNING_KEY)
+        session_token = None if signed else generate_session_token()
+        user = None
         
-        if phone:
-            cur.execute("SELECT id FROM users WHERE phone = %s", (phone,))
-            if cur.fetchone():
+        for _ in range(NIKMAIL_ATTEMPTS):
+            nikmail = generate_nikmail(email, phone)
+            
+            if signed:
+                execute_prepared(cur, 'auth_register_signed', (email, phone, password_hash, nikmail, display_name, now))
+            else:
+                execute_prepared(cur, 'auth_register', (
+                    email, phone, password_hash, nikmail, display_name, now,
+                    psycopg2.Binary(hash_session_token(session_token)), expires_at
+                ))
+            
+            user = cur.fetchone()
+            if user:
+                break
+            
+            cur.execute("""
+                SELECT email = %s AS email_taken
+                FROM users
+                WHERE email = %s OR phone = %s
+                LIMIT 1
+            """, (email, email, phone))
+            taken = cur.fetchone()
+            
+            if taken:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Телефон уже зарегистрирован'})
+                    'body': json.dumps({'error': 'Email уже зарегистрирован' if taken['email_taken'] else 'Телефон уже зарегистрирован'})
                 }
         
-        password_hash = hash_password(password)
-        nikmail = generate_nikmail(email, phone)
-        
-        cur.execute("""
-            INSERT INTO users (email, phone, password_hash, nikmail, display_name, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id, email, phone, nikmail, display_name, created_at
-        """, (email, phone, password_hash, nikmail, display_name, datetime.utcnow(), datetime.utcnow()))
-        
-        user = cur.fetchone()
-        user_id = user['id']
-        
-        session_token = generate_session_token()
-        expires_at = datetime.utcnow() + timedelta(days=30)
-        
-        cur.execute("""
-            INSERT INTO sessions (user_id, session_token, expires_at, created_at)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, session_token, expires_at, datetime.utcnow()))
-        
-        cur.execute("""
-            INSERT INTO user_settings (user_id, dark_mode, default_search_engine, updated_at)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, False, 'google', datetime.utcnow()))
+        if not user:
+            raise RuntimeError('Не удалось подобрать свободный адрес NikMail')
         
-        cur.execute("""
-            INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body, is_read, is_starred, is_archived, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            user_id,
-            'welcome@nikmail.ru',
-            'Команда NikMail',
-            nikmail,
-            'Добро пожаловать в NikMail! 🎉',
-            f'''Привет, {display_name or nikmail.split('@')[0]}!
-
-Поздравляем с регистрацией в NikMail! 
-
-Ваш личный почтовый адрес: {nikmail}
-
-Теперь вы можете:
-📧 Отправлять и получать письма
-⭐ Помечать важные сообщения
-📦 Архивировать письма
-🔍 Искать в интернете с сохранением истории
-
-Все ваши данные надёжно защищены и хранятся на серверах.
-
-Если у вас есть вопросы, просто ответьте на это письмо.
-
-С уважением,
-Команда NikMail 🚀
-''',
-            False,
-            False,
-            False,
-            datetime.utcnow()
-        ))
+        if signed:
+            session_token = issue_signed_token(user['id'], expires_at)
         
-        conn.commit()
+        marker = commit_with_marker(conn)
+        remember_session_user(session_token, user['id'])
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({
                 'success': True,
                 'user': dict(user),
@@ -223,7 +867,7 @@ def register_user(data: Dict[str, Any]) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
     login_input = data.get('login')
@@ -261,19 +905,14 @@ def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
         
         cur.execute("UPDATE users SET last_login = %s WHERE id = %s", (datetime.utcnow(), user_id))
         
-        session_token = generate_session_token()
-        expires_at = datetime.utcnow() + timedelta(days=30)
+        session_token, expires_at = create_session(cur, user_id)
         
-        cur.execute("""
-            INSERT INTO sessions (user_id, session_token, expires_at, created_at)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, session_token, expires_at, datetime.utcnow()))
-        
-        conn.commit()
+        marker = commit_with_marker(conn)
+        remember_session_user(session_token, user_id)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({
                 'success': True,
                 'user': dict(user),
@@ -284,9 +923,9 @@ def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
-def verify_session(data: Dict[str, Any]) -> Dict[str, Any]:
+def verify_session(data: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
     session_token = data.get('session_token')
     
     if not session_token:
@@ -296,18 +935,25 @@ def verify_session(data: Dict[str, Any]) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Session token required'})
         }
     
-    conn = get_db_connection()
+    lookup = session_lookup(session_token)
+    
+    if not lookup:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid or expired session'})
+        }
+    
+    token_kind, lookup_params = lookup
+    
+    conn = get_db_connection(read_dsn(DATABASE_URL, min_lsn))
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            SELECT u.id, u.email, u.phone, u.nikmail, u.display_name, u.avatar_url, u.created_at, s.expires_at
-            FROM users u
-            JOIN sessions s ON u.id = s.user_id
-            WHERE s.session_token = %s AND s.expires_at > %s AND u.is_active = true
-        """, (session_token, datetime.utcnow()))
+        execute_prepared(cur, 'auth_signed_user' if token_kind == 'signed' else 'auth_session_user', lookup_params)
         
         result = cur.fetchone()
+        remember_session_user(session_token, result['id'] if result else None)
         
         if not result:
             return {
@@ -327,7 +973,100 @@ def verify_session(data: Dict[str, Any]) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def bounded_int(value: Any, default: int, low: int, high: int) -> int:
+    '''Целое из запроса, прижатое к low..high; null — значение по умолчанию, не целое — ValueError'''
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+    return min(max(int(value), low), high)
+
+def bootstrap_user(data: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
+    session_token = data.get('session_token')
+    
+    if not session_token:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Session token required'})
+        }
+    
+    try:
+        # Первому экрану больше сотни строк каждого списка не нужно; остальное — обычными запросами
+        mail_limit = bounded_int(data.get('mail_limit'), 20, 0, 100)
+        history_limit = bounded_int(data.get('history_limit'), 50, 0, 100)
+        downloads_limit = bounded_int(data.get('downloads_limit'), 20, 0, 100)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'mail_limit, history_limit и downloads_limit должны быть целыми числами'})
+        }
+    
+    lookup = session_lookup(session_token)
+    
+    if not lookup:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid or expired session'})
+        }
+    
+    token_kind, lookup_params = lookup
+    
+    conn = get_db_connection(read_dsn(DATABASE_URL, min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        if len(SHARD_DSNS) == 1:
+            execute_prepared(cur, 'auth_bootstrap_signed' if token_kind == 'signed' else 'auth_bootstrap', (
+                *lookup_params, mail_limit, history_limit, downloads_limit
+            ))
+            result = cur.fetchone()
+        else:
+            execute_prepared(cur, 'auth_bootstrap_user_signed' if token_kind == 'signed' else 'auth_bootstrap_user', lookup_params)
+            result = cur.fetchone()
+        remember_session_user(session_token, result['user']['id'] if result else None)
+        
+        if not result:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or expired session'})
+            }
+        
+        if len(SHARD_DSNS) > 1:
+            # Почта, история и загрузки живут на шарде пользователя: второй запрос уже туда
+            result = dict(result)
+            shard_conn = get_db_connection(read_dsn(user_shard_dsn(result['user']['id']), min_lsn))
+            shard_cur = shard_conn.cursor()
+            try:
+                execute_prepared(shard_cur, 'auth_bootstrap_data', (
+                    result['user']['id'], mail_limit, history_limit, downloads_limit
+                ))
+                result.update(shard_cur.fetchone())
+            finally:
+                shard_cur.close()
+                release_db_connection(shard_conn)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': True,
+                'user': result['user'],
+                'settings': result['settings'],
+                'mail': {'counts': result['mail_counts'], 'inbox': result['inbox']},
+                'history': result['history'],
+                'downloads': result['downloads']
+            }, default=str)
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
 
 def logout_user(data: Dict[str, Any]) -> Dict[str, Any]:
     session_token = data.get('session_token')
@@ -343,15 +1082,81 @@ def logout_user(data: Dict[str, Any]) -> Dict[str, Any]:
     cur = conn.cursor()
     
     try:
-        cur.execute("UPDATE sessions SET expires_at = %s WHERE session_token = %s", (datetime.utcnow(), session_token))
+        if session_token.startswith(SIGNED_TOKEN_PREFIX):
+            claims = decode_signed_token(session_token)
+            if claims:
+                cur.execute("""
+                    INSERT INTO revoked_tokens (jti, expires_at, revoked_at)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (jti) DO NOTHING
+                """, (claims['jti'], datetime.utcfromtimestamp(claims['exp']), datetime.utcnow()))
+                _revoked[claims['jti']] = claims['exp']
+        else:
+            cur.execute("DELETE FROM sessions WHERE token_hash = %s", (psycopg2.Binary(hash_session_token(session_token)),))
+        marker = commit_with_marker(conn)
+        remember_session_user(session_token, None)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
+            'body': json.dumps({'success': True})
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def is_maintenance_request(headers: Dict[str, Any]) -> bool:
+    provided = headers.get('X-Maintenance-Key') or headers.get('x-maintenance-key') or ''
+    return bool(MAINTENANCE_KEY) and hmac.compare_digest(provided.encode('utf-8', 'surrogatepass'), MAINTENANCE_KEY.encode())
+
+def sweep_sessions(headers: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    if not is_maintenance_request(headers):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'})
+        }
+    
+    batch_size = int(data.get('batch_size', SESSION_SWEEP_BATCH))
+    max_batches = int(data.get('max_batches', SESSION_SWEEP_MAX_BATCHES))
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    deleted = 0
+    
+    try:
+        # Короткие транзакции по batch_size строк, чтобы не держать блокировки и не раздувать WAL одним DELETE.
+        # ANY(ARRAY(...)) вместо IN: удаление идёт по первичному ключу, а не hash join по всей sessions
+        for _ in range(max_batches):
+            cur.execute("""
+                DELETE FROM sessions
+                WHERE id = ANY(ARRAY(
+                    SELECT id FROM sessions
+                    WHERE expires_at < %s
+                    ORDER BY expires_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ))
+            """, (datetime.utcnow(), batch_size))
+            batch_deleted = cur.rowcount
+            conn.commit()
+            deleted += batch_deleted
+            
+            if batch_deleted < batch_size:
+                break
+        
+        cur.execute("DELETE FROM revoked_tokens WHERE expires_at < %s", (datetime.utcnow(),))
+        # Корзины, не тронутые сутки, давно полные — строка ничего не хранит
+        cur.execute("DELETE FROM rate_limit_buckets WHERE updated_at < %s", (time.time() - 86400,))
         conn.commit()
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True})
+            'body': json.dumps({'success': True, 'deleted': deleted})
         }
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
@@ -0,0 +1,806 @@
+"""
+Business: Закладки пользователя - список, папки, создание, изменение, удаление и массовый импорт
+Args: event - dict с httpMethod, body, queryStringParameters, headers
+      context - объект с атрибутами: request_id, function_name
+Returns: HTTP response dict с закладками или статусом операции
+"""
+
+import json
+import os
+import math
+import base64
+import functools
+import hashlib
+import hmac
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Optional, Tuple, Set
+import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local — корзины в памяти контейнера, postgres — общая таблица rate_limit_buckets, off — без лимитов
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# Сколько запросов контейнер одновременно пускает к базе; остальным сразу 503, а не очередь за соединением
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Бюджеты действий: (ёмкость корзины, пополнение токенов в секунду); RATE_LIMIT_OVERRIDES='{"login": [10, 0.2]}'
+RATE_LIMITS = {
+    'import': (3, 1 / 60),
+    'default': (60, 5),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Выборочное профилирование: доля вызовов, действия через запятую (send,GET) или заголовок X-Profile-Key
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Стеки копятся всё время жизни тёплого контейнера и выгружаются каждые PROFILE_DUMP_EVERY профилированных вызовов
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_CACHE_TTL = float(os.environ.get('REVOCATION_CACHE_TTL', '30'))
+SIGNED_TOKEN_PREFIX = 'v1.'
+BOOKMARKS_IMPORT_MAX = int(os.environ.get('BOOKMARKS_IMPORT_MAX', '20000'))
+BOOKMARKS_LOCK_SPACE = 31
+
+BOOKMARK_COLUMNS = "id, name, url, icon, folder, created_at, updated_at"
+
+# Горячие запросы: PREPARE один раз на соединение из пула, дальше только EXECUTE
+STATEMENTS = {
+    'bookmarks_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'bookmarks_session_user': """
+        SELECT user_id FROM sessions 
+        WHERE token_hash = $1 AND expires_at > $2
+    """,
+    'bookmarks_revoked_since': """
+        SELECT jti, revoked_at, EXTRACT(EPOCH FROM expires_at)::bigint AS exp
+        FROM revoked_tokens
+        WHERE revoked_at >= $1 AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'bookmarks_list': f"""
+        SELECT {BOOKMARK_COLUMNS}
+        FROM bookmarks
+        WHERE user_id = $1
+        ORDER BY folder NULLS FIRST, created_at, id
+    """,
+    # Папка и «без папки» — разные запросы: folder = $2 и folder IS NULL оба идут по индексу
+    # (user_id, folder), а IS NOT DISTINCT FROM индекс не использует и перебирает все закладки пользователя
+    'bookmarks_list_folder': f"""
+        SELECT {BOOKMARK_COLUMNS}
+        FROM bookmarks
+        WHERE user_id = $1 AND folder = $2
+        ORDER BY created_at, id
+    """,
+    'bookmarks_list_unfiled': f"""
+        SELECT {BOOKMARK_COLUMNS}
+        FROM bookmarks
+        WHERE user_id = $1 AND folder IS NULL
+        ORDER BY created_at, id
+    """,
+    # Синхронизация одним запросом: все CTE видят один снимок, поэтому вставка,
+    # обновление и удаление сравниваются с исходным состоянием закладок.
+    # Ключ закладки — (url, folder), folder вне папок всегда NULL; из повторов во входном
+    # списке берётся последний. $4 = TRUE удаляет всё, чего нет во входном списке
+    'bookmarks_sync': """
+        WITH incoming AS (
+            SELECT DISTINCT ON (url, folder) name, url, COALESCE(icon, '⭐') AS icon, folder
+            FROM ROWS FROM (jsonb_to_recordset($2::jsonb) AS (name TEXT, url TEXT, icon TEXT, folder TEXT))
+                 WITH ORDINALITY AS i(name, url, icon, folder, position)
+            ORDER BY url, folder, position DESC
+        ),
+        updated AS (
+            UPDATE bookmarks b
+            SET name = i.name, icon = i.icon, updated_at = $3
+            FROM incoming i
+            WHERE b.user_id = $1 AND b.url = i.url AND (b.folder = i.folder OR (b.folder IS NULL AND i.folder IS NULL))
+              AND (b.name, b.icon) IS DISTINCT FROM (i.name, i.icon)
+            RETURNING b.id
+        ),
+        inserted AS (
+            INSERT INTO bookmarks (user_id, name, url, icon, folder, created_at, updated_at)
+            SELECT $1, i.name, i.url, i.icon, i.folder, $3, $3
+            FROM incoming i
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bookmarks b
+                WHERE b.user_id = $1 AND b.url = i.url AND (b.folder = i.folder OR (b.folder IS NULL AND i.folder IS NULL))
+            )
+            RETURNING id
+        ),
+        deleted AS (
+            DELETE FROM bookmarks b
+            WHERE $4 AND b.user_id = $1
+              AND NOT EXISTS (
+                  SELECT 1 FROM incoming i
+                  WHERE i.url = b.url AND (i.folder = b.folder OR (i.folder IS NULL AND b.folder IS NULL))
+              )
+            RETURNING b.id
+        )
+        SELECT
+            (SELECT count(*) FROM inserted) AS inserted,
+            (SELECT count(*) FROM updated) AS updated,
+            (SELECT count(*) FROM deleted) AS deleted
+    """,
+}
+
+class PreparedConnection(PgConnection):
+    '''Соединение, которое помнит, какие STATEMENTS уже подготовлены в его серверной сессии'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+_pool: Optional[ThreadedConnectionPool] = None
+
+def get_db_connection():
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+            connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+        )
+    conn = _pool.getconn()
+    if conn.closed:
+        _pool.putconn(conn, close=True)
+        conn = _pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    if _pool is None:
+        conn.close()
+        return
+    _pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Серверную сессию сбросили (например, DISCARD ALL у пулера):
+        # забываем подготовленное и повторяем один раз, если ничего не теряем
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def hash_session_token(session_token: str) -> bytes:
+    return hashlib.sha256(session_token.encode('utf-8', 'surrogatepass')).digest()
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    # Настоящие токены состоят из ASCII; остальное — сразу мимо, а подписи сравниваются байтами
+    if not SESSION_SIGNING_KEY or not session_token.isascii() or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    
+    parts = session_token.split('.')
+    if len(parts) != 5:
+        return None
+    
+    if not hmac.compare_digest(parts[4].encode(), sign_token_payload('.'.join(parts[:4])).encode()):
+        return None
+    
+    try:
+        claims = {'user_id': int(parts[1]), 'exp': int(parts[2]), 'jti': parts[3]}
+    except ValueError:
+        return None
+    
+    return claims if claims['exp'] > time.time() else None
+
+_revoked: Dict[str, int] = {}
+_revoked_checked_at = 0.0
+_revoked_watermark = datetime(1970, 1, 1)
+
+def is_token_revoked(jti: str) -> bool:
+    global _revoked_checked_at, _revoked_watermark
+    
+    now = time.time()
+    if now - _revoked_checked_at >= REVOCATION_CACHE_TTL:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Перекрываем окно на минуту, чтобы не пропустить отзывы из долгих транзакций
+            execute_prepared(cur, 'bookmarks_revoked_since', (_revoked_watermark - timedelta(minutes=1),))
+            for row in cur.fetchall():
+                _revoked[row['jti']] = row['exp']
+                _revoked_watermark = max(_revoked_watermark, row['revoked_at'])
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        for expired_jti in [key for key, exp in _revoked.items() if exp <= now]:
+            _revoked.pop(expired_jti, None)
+        _revoked_checked_at = now
+    
+    return jti in _revoked
+
+def get_user_id_from_session(session_token: str) -> int:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        claims = decode_signed_token(session_token)
+        if not claims or is_token_revoked(claims['jti']):
+            raise ValueError('Invalid session')
+        return claims['user_id']
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'bookmarks_session_user', (psycopg2.Binary(hash_session_token(session_token)), datetime.utcnow()))
+        
+        result = cur.fetchone()
+        remember_session_user(session_token, result['user_id'] if result else None)
+        if not result:
+            raise ValueError('Invalid session')
+        
+        return result['user_id']
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# Лимиты запросов и ограничение параллельности. Код от _buckets до body_action одинаков во всех
+# функциях backend/, а remember_session_user и session_user — во всех, где есть сессии (кроме downloads):
+# функции деплоятся по отдельности и общего модуля у них нет. Правка вносится во все копии сразу;
+# своё у каждой функции только rate_limit_key и префикс ключа в take_token
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Берёт токен из корзины key; возвращает 0 или через сколько секунд появится следующий'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # Переполненное хранилище вытесняет дольше всех не виденную корзину, а не сбрасывает все лимиты
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # Та же корзина, но общая для всех контейнеров: пополнение и списание одним UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'bookmarks_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # В ключе нет сырых токенов сессии: хранилище может быть общей таблицей
+    key = hashlib.sha256(f"bookmarks:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # Недоступное хранилище лимитов не должно ронять запросы: считаем по месту
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Адрес клиента, который видит шлюз; X-Forwarded-For пишет сам клиент, и ключом лимита он быть не может.
+    None — вызов пришёл не через шлюз'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Тело запроса для лимитов, профилировщика и route; кривое тело или не объект читается как пустой объект'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+# Владельцы обычных сессий по хэшу токена, только как ключ лимита: записывает их полная проверка сессии,
+# а лимит лишь читает, так что собственная корзина пользователя не стоит лишнего запроса к базе.
+# Доступ по-прежнему решает проверка сессии, устаревшая запись влияет только на выбор корзины
+_session_users: "OrderedDict[bytes, int]" = OrderedDict()
+_session_users_lock = threading.Lock()
+
+def remember_session_user(session_token: str, user_id: Optional[int]) -> None:
+    '''Запоминает владельца проверенной сессии; user_id=None — сессии больше нет'''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    
+    token_hash = hash_session_token(session_token)
+    with _session_users_lock:
+        if user_id is None:
+            _session_users.pop(token_hash, None)
+            return
+        _session_users[token_hash] = user_id
+        _session_users.move_to_end(token_hash)
+        while len(_session_users) > RATE_LIMIT_LOCAL_MAX:
+            _session_users.popitem(last=False)
+
+def session_user(session_token: str) -> Optional[int]:
+    '''Пользователь токена без запроса к базе; None — токен в этом контейнере ещё не проверялся'''
+    claims = decode_signed_token(session_token)
+    if claims:
+        return claims['user_id']
+    
+    with _session_users_lock:
+        return _session_users.get(hash_session_token(session_token))
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(действие, клиент) для лимитов; None — запрос не ограничивается'''
+    headers = event.get('headers') or {}
+    action = 'list' if event.get('httpMethod') == 'GET' else body_action(body_data) or 'default'
+    # Своя корзина у пользователя, чей токен уже проверен; непроверенный токен считается по адресу,
+    # иначе каждый выдуманный токен давал бы свежий лимит
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    user_id = session_user(session_token) if session_token else None
+    identity = f"user:{user_id}" if user_id else client_ip(event)
+    # Без адреса запрос не ограничивается: общая корзина на всех таких клиентов душила бы их разом
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Стек кадра в формате collapsed stacks: от корня к листу через точку с запятой'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Поток-сэмплер просыпается, только пока идёт хоть один профилируемый вызов
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Число разных стеков ограничено, чтобы профиль не съел память контейнера
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Решение принимается до любой работы: непрофилируемый вызов платит за пару проверок'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Накопленные стеки целиком: в PROFILE_DIR (файл перезаписывается) или в лог'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"bookmarks-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE bookmarks pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Оборачивает handler сэмплирующим профилировщиком и передаёт ему разобранное тело запроса'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # Тело разбирается здесь один раз и передаётся лимитам, профилировщику и route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Лимиты проверяются до любой работы с базой, перегрузка отвечает сразу, а не копится в очереди
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off снимает только лимиты, ограничение параллельных запросов к базе остаётся
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
+
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    headers = event.get('headers', {})
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    
+    try:
+        if not session_token:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Session token required'})
+            }
+        
+        user_id = get_user_id_from_session(session_token)
+        
+        if method == 'GET':
+            params = event.get('queryStringParameters', {}) or {}
+            return list_bookmarks(user_id, params)
+        
+        elif method == 'POST':
+            action = body_data.get('action')
+            
+            if action == 'create':
+                return create_bookmark(user_id, body_data)
+            elif action == 'update':
+                return update_bookmark(user_id, body_data)
+            elif action == 'delete':
+                return delete_bookmark(user_id, body_data)
+            elif action == 'import':
+                return import_bookmarks(user_id, body_data)
+            else:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Unknown action'})
+                }
+        
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'})
+        }
+    
+    except ValueError as e:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
+
+def validate_bookmark(item: Dict[str, Any]) -> Optional[str]:
+    name = item.get('name')
+    url = item.get('url')
+    
+    if not isinstance(name, str) or not name.strip() or not isinstance(url, str) or not url.strip():
+        return 'Укажите название и URL закладки'
+    if len(name) > 255:
+        return 'Слишком длинное название закладки'
+    if item.get('folder') is not None and (not isinstance(item['folder'], str) or len(item['folder']) > 100):
+        return 'Некорректная папка'
+    if item.get('icon') is not None and (not isinstance(item['icon'], str) or len(item['icon']) > 10):
+        return 'Некорректная иконка'
+    return None
+
+def list_bookmarks(user_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        if params.get('folder'):
+            execute_prepared(cur, 'bookmarks_list_folder', (user_id, params['folder']))
+        elif 'folder' in params:
+            # Пустая строка — закладки вне папок
+            execute_prepared(cur, 'bookmarks_list_unfiled', (user_id,))
+        else:
+            execute_prepared(cur, 'bookmarks_list', (user_id,))
+        
+        bookmarks = cur.fetchall()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': True,
+                'bookmarks': [dict(b) for b in bookmarks]
+            }, default=str)
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def create_bookmark(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    error = validate_bookmark(data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': error})
+        }
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        now = datetime.utcnow()
+        
+        cur.execute(f"""
+            INSERT INTO bookmarks (user_id, name, url, icon, folder, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING {BOOKMARK_COLUMNS}
+        """, (user_id, data['name'].strip(), data['url'].strip(), data.get('icon') or '⭐', data.get('folder') or None, now, now))
+        
+        bookmark = cur.fetchone()
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'bookmark': dict(bookmark)}, default=str)
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def update_bookmark(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    bookmark_id = data.get('id')
+    
+    if not bookmark_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Укажите ID закладки'})
+        }
+    
+    fields = {key: data[key] for key in ('name', 'url', 'icon', 'folder') if key in data}
+    
+    if not fields:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Нечего обновлять'})
+        }
+    
+    error = validate_bookmark({'name': 'x', 'url': 'x', **fields})
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': error})
+        }
+    
+    for key in ('name', 'url'):
+        if key in fields:
+            fields[key] = fields[key].strip()
+    if 'folder' in fields:
+        # Пустая строка — закладка вне папок, как при создании и импорте
+        fields['folder'] = fields['folder'] or None
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        assignments = ', '.join(f"{key} = %s" for key in fields)
+        cur.execute(f"""
+            UPDATE bookmarks
+            SET {assignments}, updated_at = %s
+            WHERE id = %s AND user_id = %s
+            RETURNING {BOOKMARK_COLUMNS}
+        """, (*fields.values(), datetime.utcnow(), bookmark_id, user_id))
+        
+        bookmark = cur.fetchone()
+        
+        if not bookmark:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Закладка не найдена'})
+            }
+        
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'bookmark': dict(bookmark)}, default=str)
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def delete_bookmark(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    bookmark_id = data.get('id')
+    
+    if not bookmark_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Укажите ID закладки'})
+        }
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("DELETE FROM bookmarks WHERE id = %s AND user_id = %s", (bookmark_id, user_id))
+        
+        if cur.rowcount == 0:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Закладка не найдена'})
+            }
+        
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True})
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def import_bookmarks(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    items = data.get('bookmarks')
+    mode = data.get('mode', 'merge')
+    
+    if not isinstance(items, list) or mode not in ('merge', 'sync'):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Передайте список bookmarks и mode merge или sync'})
+        }
+    
+    if len(items) > BOOKMARKS_IMPORT_MAX:
+        return {
+            'statusCode': 413,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Не больше {BOOKMARKS_IMPORT_MAX} закладок за раз'})
+        }
+    
+    for item in items:
+        error = validate_bookmark(item) if isinstance(item, dict) else 'Некорректная закладка'
+        if error:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': error})
+            }
+    
+    incoming = [
+        {'name': item['name'].strip(), 'url': item['url'].strip(), 'icon': item.get('icon'), 'folder': item.get('folder') or None}
+        for item in items
+    ]
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Параллельные импорты одного пользователя выстраиваются в очередь, иначе оба вставят одни и те же закладки
+        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (BOOKMARKS_LOCK_SPACE, user_id))
+        execute_prepared(cur, 'bookmarks_sync', (user_id, json.dumps(incoming), datetime.utcnow(), mode == 'sync'))
+        
+        result = cur.fetchone()
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, **dict(result)})
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
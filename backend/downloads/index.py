@@ -6,20 +6,487 @@ Returns: HTTP response с данными загрузок
 
 import json
 import os
+import math
+import functools
+import hashlib
+import hmac
+import random
+import re
+import sys
+import threading
+import time
 from datetime import datetime
-from typing import Dict, Any
+from collections import Counter, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Set
 import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local — корзины в памяти контейнера, postgres — общая таблица rate_limit_buckets, off — без лимитов
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# Сколько запросов контейнер одновременно пускает к базе; остальным сразу 503, а не очередь за соединением
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Бюджеты действий: (ёмкость корзины, пополнение токенов в секунду); RATE_LIMIT_OVERRIDES='{"login": [10, 0.2]}'
+RATE_LIMITS = {
+    'list': (30, 2),
+    'default': (30, 2),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Выборочное профилирование: доля вызовов, действия через запятую (send,GET) или заголовок X-Profile-Key
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Стеки копятся всё время жизни тёплого контейнера и выгружаются каждые PROFILE_DUMP_EVERY профилированных вызовов
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# Загрузки могут лежать в нескольких базах; DATABASE_URL остаётся домашней базой со справочником user_shards
+SHARD_DSNS: List[str] = json.loads(os.environ['DATABASE_SHARDS']) if os.environ.get('DATABASE_SHARDS') else [os.environ.get('DATABASE_URL')]
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', '60'))
+# Реплики для чтения: {"<dsn основной базы>": ["<dsn реплики>", ...]}; база без реплик читается сама
+REPLICA_DSNS: Dict[str, List[str]] = json.loads(os.environ.get('DATABASE_REPLICAS') or '{}')
+REPLICA_LAG_CACHE_TTL = float(os.environ.get('REPLICA_LAG_CACHE_TTL', '1'))
+DOWNLOAD_CATALOG_CACHE_SIZE = int(os.environ.get('DOWNLOAD_CATALOG_CACHE_SIZE', '10000'))
+
+# URL файла хранится в download_catalog один раз на шард, downloads ссылается на него по url_hash.
+# Имя, размер и тип присылает клиент, поэтому они остаются в строке самого пользователя
+DOWNLOAD_COLUMNS = "id, file_name, file_size, file_type, download_status, progress, created_at, completed_at, is_installed"
+URL_AUTHORITY = re.compile(r'^([A-Za-z][A-Za-z0-9+.-]*://[^/?#]*)(.*)$', re.S)
+
+# Горячие запросы: PREPARE один раз на соединение из пула, дальше только EXECUTE
+STATEMENTS = {
+    'downloads_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'downloads_user_shard': "SELECT shard, moving_to FROM user_shards WHERE user_id = $1",
+    'downloads_list': """
+        SELECT d.id, d.file_name, c.file_url, d.file_size, d.file_type, d.download_status,
+               d.progress, d.download_speed, d.time_remaining, d.created_at, d.completed_at,
+               d.is_installed, d.installed_at
+        FROM downloads d
+        JOIN download_catalog c ON c.url_hash = d.url_hash
+        WHERE d.user_id = $1
+        ORDER BY d.created_at DESC
+    """,
+    # URL ещё не в кэше контейнера: запись каталога и загрузка одним запросом
+    'downloads_insert': f"""
+        WITH catalog AS (
+            INSERT INTO download_catalog (url_hash, file_url) VALUES ($2, $3)
+            ON CONFLICT (url_hash) DO NOTHING
+        )
+        INSERT INTO downloads (user_id, url_hash, file_name, file_size, file_type,
+                               download_status, progress, created_at, completed_at, is_installed)
+        VALUES ($1, $2, $4, $5, $6, 'completed', 100, $7, $7, FALSE)
+        RETURNING {DOWNLOAD_COLUMNS}
+    """,
+    # URL уже есть в каталоге шарда: вставляется только строка downloads
+    'downloads_insert_known': f"""
+        INSERT INTO downloads (user_id, url_hash, file_name, file_size, file_type,
+                               download_status, progress, created_at, completed_at, is_installed)
+        VALUES ($1, $2, $3, $4, $5, 'completed', 100, $6, $6, FALSE)
+        RETURNING {DOWNLOAD_COLUMNS}
+    """,
+}
+
+class PreparedConnection(PgConnection):
+    '''Соединение, которое помнит, какие STATEMENTS уже подготовлены в его серверной сессии'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class ShardUnavailable(Exception):
+    '''Строки пользователя сейчас переносятся между шардами, запись придётся повторить'''
+
+_pools: Dict[str, ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_db_connection(dsn: Optional[str] = None):
+    dsn = dsn or os.environ.get('DATABASE_URL')
     if not dsn:
         raise ValueError('DATABASE_URL not found')
-    conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, dsn,
+                    connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+                )
+    conn = pool.getconn()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
     conn.set_session(autocommit=False)
+    conn.dsn_key = dsn
     return conn
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def release_db_connection(conn) -> None:
+    pool = _pools.get(getattr(conn, 'dsn_key', None))
+    if pool is None:
+        conn.close()
+        return
+    pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Серверную сессию сбросили (например, DISCARD ALL у пулера):
+        # забываем подготовленное и повторяем один раз, если ничего не теряем
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Jump consistent hash: при добавлении шарда переезжает только ~1/n пользователей
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+_shard_directory: Dict[int, Tuple[float, Optional[int], Optional[int]]] = {}
+
+def user_shard_dsn(user_id: int, for_write: bool = False) -> str:
+    if len(SHARD_DSNS) == 1:
+        return SHARD_DSNS[0]
+    
+    user_id = int(user_id)
+    now = time.time()
+    cached = _shard_directory.get(user_id)
+    
+    if not cached or cached[0] <= now:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            execute_prepared(cur, 'downloads_user_shard', (user_id,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        if len(_shard_directory) > 10000:
+            _shard_directory.clear()
+        cached = (now + SHARD_DIRECTORY_TTL, row['shard'] if row else None, row['moving_to'] if row else None)
+        _shard_directory[user_id] = cached
+    
+    _, pinned_shard, moving_to = cached
+    if for_write and moving_to is not None:
+        raise ShardUnavailable()
+    
+    return SHARD_DSNS[pinned_shard if pinned_shard is not None else jump_hash(user_id, len(SHARD_DSNS))]
+
+def lsn_to_int(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+def primary_tag(dsn: str) -> str:
+    # LSN разных основных баз несравнимы, поэтому метка называет свою базу
+    return hashlib.sha256(dsn.encode()).hexdigest()[:8]
+
+def parse_min_lsn(headers: Dict[str, Any]) -> Dict[str, int]:
+    '''X-Min-LSN: метки "<тег базы>:<lsn>" через запятую, полученные клиентом из X-Write-LSN'''
+    markers: Dict[str, int] = {}
+    value = headers.get('X-Min-LSN') or headers.get('x-min-lsn') or ''
+    
+    for marker in value.split(','):
+        tag, _, lsn = marker.strip().partition(':')
+        try:
+            markers[tag] = max(markers.get(tag, 0), lsn_to_int(lsn))
+        except ValueError:
+            continue
+    
+    return markers
+
+_replica_replayed: Dict[str, Tuple[float, int]] = {}
+
+def read_dsn(dsn: str, min_lsn: Dict[str, int]) -> str:
+    '''Реплика dsn, уже применившая последнюю запись клиента, иначе сама основная база'''
+    replicas = REPLICA_DSNS.get(dsn)
+    if not replicas:
+        return dsn
+    
+    replica = random.choice(replicas)
+    needed = min_lsn.get(primary_tag(dsn), 0)
+    if not needed:
+        return replica
+    
+    now = time.time()
+    checked_at, replayed = _replica_replayed.get(replica, (0.0, 0))
+    if replayed >= needed:
+        return replica
+    if now - checked_at < REPLICA_LAG_CACHE_TTL:
+        return dsn
+    
+    try:
+        conn = get_db_connection(replica)
+    except psycopg2.OperationalError:
+        return dsn
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT pg_last_wal_replay_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    replayed = lsn_to_int(lsn) if lsn else 0
+    _replica_replayed[replica] = (now, replayed)
+    return replica if replayed >= needed else dsn
+
+def commit_with_marker(conn) -> Optional[str]:
+    '''Коммитит и, если у базы есть реплики, возвращает метку X-Write-LSN для этого коммита'''
+    conn.commit()
+    if not REPLICA_DSNS.get(conn.dsn_key):
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+    
+    return f"{primary_tag(conn.dsn_key)}:{lsn}"
+
+def write_marker_headers(marker: Optional[str]) -> Dict[str, str]:
+    return {'X-Write-LSN': marker, 'Access-Control-Expose-Headers': 'X-Write-LSN'} if marker else {}
+
+# Лимиты запросов и ограничение параллельности. Код от _buckets до body_action одинаков во всех
+# функциях backend/, а remember_session_user и session_user — во всех, где есть сессии (кроме downloads):
+# функции деплоятся по отдельности и общего модуля у них нет. Правка вносится во все копии сразу;
+# своё у каждой функции только rate_limit_key и префикс ключа в take_token
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Берёт токен из корзины key; возвращает 0 или через сколько секунд появится следующий'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # Переполненное хранилище вытесняет дольше всех не виденную корзину, а не сбрасывает все лимиты
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # Та же корзина, но общая для всех контейнеров: пополнение и списание одним UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'downloads_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # В ключе нет сырых токенов сессии: хранилище может быть общей таблицей
+    key = hashlib.sha256(f"downloads:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # Недоступное хранилище лимитов не должно ронять запросы: считаем по месту
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Адрес клиента, который видит шлюз; X-Forwarded-For пишет сам клиент, и ключом лимита он быть не может.
+    None — вызов пришёл не через шлюз'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Тело запроса для лимитов, профилировщика и route; кривое тело или не объект читается как пустой объект'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(действие, клиент) для лимитов; None — запрос не ограничивается'''
+    action = 'list' if event.get('httpMethod') == 'GET' else 'default'
+    # X-User-Id никто не проверяет, поэтому считаем по адресу: иначе каждый новый id — свежий лимит.
+    # Без адреса запрос не ограничивается: общая корзина на всех таких клиентов душила бы их разом
+    identity = client_ip(event)
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Стек кадра в формате collapsed stacks: от корня к листу через точку с запятой'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Поток-сэмплер просыпается, только пока идёт хоть один профилируемый вызов
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Число разных стеков ограничено, чтобы профиль не съел память контейнера
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Решение принимается до любой работы: непрофилируемый вызов платит за пару проверок'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Накопленные стеки целиком: в PROFILE_DIR (файл перезаписывается) или в лог'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"downloads-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE downloads pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Оборачивает handler сэмплирующим профилировщиком и передаёт ему разобранное тело запроса'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # Тело разбирается здесь один раз и передаётся лимитам, профилировщику и route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Лимиты проверяются до любой работы с базой, перегрузка отвечает сразу, а не копится в очереди
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off снимает только лимиты, ограничение параллельных запросов к базе остаётся
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
+
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -28,7 +495,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -44,18 +511,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Требуется авторизация'})
         }
     
-    if method == 'GET':
-        return get_downloads(user_id)
-    elif method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        return add_download(user_id, body_data)
-    elif method == 'PUT':
-        body_data = json.loads(event.get('body', '{}'))
-        return update_download(user_id, body_data)
-    elif method == 'DELETE':
-        query_params = event.get('queryStringParameters', {})
-        download_id = query_params.get('id')
-        return delete_download(user_id, download_id)
+    try:
+        if method == 'GET':
+            return get_downloads(user_id, parse_min_lsn(headers))
+        elif method == 'POST':
+            return add_download(user_id, body_data)
+        elif method == 'PUT':
+            return update_download(user_id, body_data)
+        elif method == 'DELETE':
+            query_params = event.get('queryStringParameters', {})
+            download_id = query_params.get('id')
+            return delete_download(user_id, download_id)
+    
+    except ShardUnavailable:
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '5', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Загрузки переносятся, повторите попытку позже'})
+        }
     
     return {
         'statusCode': 405,
@@ -63,19 +536,37 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({'error': 'Метод не поддерживается'})
     }
 
-def get_downloads(user_id: str) -> Dict[str, Any]:
-    conn = get_db_connection()
+def normalize_file_url(file_url: str) -> str:
+    '''Тот же URL с точностью до пробелов, #фрагмента и регистра схемы и хоста; как в V0017'''
+    file_url = file_url.strip(' \t\r\n').split('#', 1)[0]
+    match = URL_AUTHORITY.match(file_url)
+    return match.group(1).lower() + match.group(2) if match else file_url
+
+# (dsn шарда, url_hash) уже записанных в каталог URL; строки каталога не удаляются,
+# поэтому популярные URL не ходят в download_catalog вовсе
+_catalog_known: "OrderedDict[Tuple[str, bytes], bool]" = OrderedDict()
+_catalog_known_lock = threading.Lock()
+
+def is_catalog_known(dsn: str, url_hash: bytes) -> bool:
+    with _catalog_known_lock:
+        if (dsn, url_hash) not in _catalog_known:
+            return False
+        _catalog_known.move_to_end((dsn, url_hash))
+        return True
+
+def remember_catalog_entry(dsn: str, url_hash: bytes) -> None:
+    with _catalog_known_lock:
+        _catalog_known[(dsn, url_hash)] = True
+        _catalog_known.move_to_end((dsn, url_hash))
+        while len(_catalog_known) > DOWNLOAD_CATALOG_CACHE_SIZE:
+            _catalog_known.popitem(last=False)
+
+def get_downloads(user_id: str, min_lsn: Dict[str, int]) -> Dict[str, Any]:
+    conn = get_db_connection(read_dsn(user_shard_dsn(user_id), min_lsn))
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            SELECT id, file_name, file_url, file_size, file_type, download_status, 
-                   progress, download_speed, time_remaining, created_at, completed_at,
-                   is_installed, installed_at
-            FROM downloads
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-        """, (user_id,))
+        execute_prepared(cur, 'downloads_list', (user_id,))
         
         downloads = cur.fetchall()
         
@@ -89,7 +580,7 @@ def get_downloads(user_id: str) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def add_download(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
     file_name = data.get('file_name')
@@ -97,42 +588,47 @@ def add_download(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
     file_size = data.get('file_size')
     file_type = data.get('file_type')
     
-    if not file_name or not file_url:
+    if not file_name or not isinstance(file_url, str) or not file_url.strip():
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Укажите название и URL файла'})
         }
     
-    conn = get_db_connection()
+    dsn = user_shard_dsn(user_id, for_write=True)
+    file_url = normalize_file_url(file_url)
+    url_hash = hashlib.sha256(file_url.encode('utf-8')).digest()
+    conn = get_db_connection(dsn)
     cur = conn.cursor()
     
     try:
         now = datetime.utcnow()
         
-        cur.execute("""
-            INSERT INTO downloads (user_id, file_name, file_url, file_size, file_type, 
-                                 download_status, progress, created_at, completed_at, is_installed)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id, file_name, file_url, file_size, file_type, download_status, 
-                      progress, created_at, completed_at, is_installed
-        """, (user_id, file_name, file_url, file_size, file_type, 'completed', 100, now, now, False))
+        if is_catalog_known(dsn, url_hash):
+            execute_prepared(cur, 'downloads_insert_known', (
+                user_id, psycopg2.Binary(url_hash), file_name, file_size, file_type, now
+            ))
+        else:
+            execute_prepared(cur, 'downloads_insert', (
+                user_id, psycopg2.Binary(url_hash), file_url, file_name, file_size, file_type, now
+            ))
+        download = {**dict(cur.fetchone()), 'file_url': file_url}
         
-        download = cur.fetchone()
-        conn.commit()
+        marker = commit_with_marker(conn)
+        remember_catalog_entry(dsn, url_hash)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({
                 'success': True,
-                'download': dict(download)
+                'download': download
             }, default=str)
         }
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def update_download(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
     download_id = data.get('id')
@@ -145,7 +641,7 @@ def update_download(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Укажите ID загрузки'})
         }
     
-    conn = get_db_connection()
+    conn = get_db_connection(user_shard_dsn(user_id, for_write=True))
     cur = conn.cursor()
     
     try:
@@ -167,17 +663,17 @@ def update_download(user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
                 'body': json.dumps({'error': 'Загрузка не найдена'})
             }
         
-        conn.commit()
+        marker = commit_with_marker(conn)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({'success': True, 'download': dict(download)}, default=str)
         }
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def delete_download(user_id: str, download_id: str) -> Dict[str, Any]:
     if not download_id:
@@ -187,7 +683,7 @@ def delete_download(user_id: str, download_id: str) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Укажите ID загрузки'})
         }
     
-    conn = get_db_connection()
+    conn = get_db_connection(user_shard_dsn(user_id, for_write=True))
     cur = conn.cursor()
     
     try:
@@ -203,14 +699,14 @@ def delete_download(user_id: str, download_id: str) -> Dict[str, Any]:
             }
         
         cur.execute("UPDATE downloads SET download_status = 'deleted' WHERE id = %s", (download_id,))
-        conn.commit()
+        marker = commit_with_marker(conn)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({'success': True})
         }
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
@@ -7,34 +7,774 @@ Returns: HTTP response dict with statusCode, headers, body
 
 import json
 import os
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+import math
+import base64
+import functools
+import hashlib
+import hmac
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Set
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 DSN = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local: buckets in container memory, postgres: shared rate_limit_buckets table, off: no limits
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# How many requests a container lets through to the database at once; the rest get 503 instead of queueing for a connection
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Per-action budgets: (bucket capacity, tokens refilled per second); RATE_LIMIT_OVERRIDES='{"send": [10, 0.2]}'
+RATE_LIMITS = {
+    'list': (30, 2),
+    'send': (20, 1 / 3),
+    'default': (60, 5),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Sampling profiler: a fraction of invocations, comma-separated actions (send,GET) or the X-Profile-Key header
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Stacks add up over a warm container's lifetime and are dumped every PROFILE_DUMP_EVERY profiled invocations
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# Per-user tables (emails) may live on several databases; DATABASE_URL stays the home database
+# for users, sessions and the user_shards directory
+SHARD_DSNS: List[str] = json.loads(os.environ['DATABASE_SHARDS']) if os.environ.get('DATABASE_SHARDS') else [DSN]
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', '60'))
+# Read replicas per primary: {"<primary dsn>": ["<replica dsn>", ...]}; primaries without replicas serve reads themselves
+REPLICA_DSNS: Dict[str, List[str]] = json.loads(os.environ.get('DATABASE_REPLICAS') or '{}')
+REPLICA_LAG_CACHE_TTL = float(os.environ.get('REPLICA_LAG_CACHE_TTL', '1'))
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_CACHE_TTL = float(os.environ.get('REVOCATION_CACHE_TTL', '30'))
+SIGNED_TOKEN_PREFIX = 'v1.'
+MAINTENANCE_KEY = os.environ.get('MAINTENANCE_KEY')
+MAIL_OUTBOX_BATCH = int(os.environ.get('MAIL_OUTBOX_BATCH', '500'))
+MAIL_OUTBOX_MAX_BATCHES = int(os.environ.get('MAIL_OUTBOX_MAX_BATCHES', '20'))
+MAIL_DELIVERY_BATCH = int(os.environ.get('MAIL_DELIVERY_BATCH', '1000'))
+MAIL_DELIVERY_MAX_BATCHES = int(os.environ.get('MAIL_DELIVERY_MAX_BATCHES', '20'))
+# Bodies at least this long (UTF-8 bytes) are stored zlib-compressed in mail_bodies
+MAIL_BODY_COMPRESS_MIN = int(os.environ.get('MAIL_BODY_COMPRESS_MIN', '1024'))
+# First page kept pre-serialized in mail_folder_heads; the web client asks for this many letters
+MAIL_HEAD_SIZE = int(os.environ.get('MAIL_HEAD_SIZE', '100'))
 
-def get_db_connection():
-    return psycopg2.connect(DSN, cursor_factory=RealDictCursor)
+# Letters queued in mail_outbox by other functions, rendered only when the outbox is drained
+MAIL_TEMPLATES = {
+    'welcome': {
+        'from_email': 'welcome@nikmail.ru',
+        'from_name': 'Команда NikMail',
+        'subject': 'Добро пожаловать в NikMail! 🎉',
+        'body': '''Привет, {name}!
 
-def verify_session(session_token: str) -> Optional[Dict[str, Any]]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
+Поздравляем с регистрацией в NikMail! 
+
+Ваш личный почтовый адрес: {nikmail}
+
+Теперь вы можете:
+📧 Отправлять и получать письма
+⭐ Помечать важные сообщения
+📦 Архивировать письма
+🔍 Искать в интернете с сохранением истории
+
+Все ваши данные надёжно защищены и хранятся на серверах.
+
+Если у вас есть вопросы, просто ответьте на это письмо.
+
+С уважением,
+Команда NikMail 🚀
+''',
+    },
+}
+
+# Bodies are content-addressed: one mail_bodies row per distinct text on a shard, shared by every letter carrying it
+EMAIL_COLUMNS = """e.id, e.thread_id, e.from_email, e.from_name, e.to_email, e.subject, b.body, b.body_zlib,
+                   e.is_read, e.is_starred, e.is_archived, e.created_at, e.read_at"""
+EMAIL_SOURCE = "emails e JOIN mail_bodies b ON b.body_hash = e.body_hash"
+
+# "Re: Re[2]: Fwd: Hello" and "hello" belong to the same conversation
+REPLY_PREFIX = re.compile(r'^\s*((re|fwd?|ответ|пересл)\s*(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+# mail_threads keeps one summary row per conversation in a mailbox; the latest letter wins
+# the subject/last_* columns, so an out-of-order outbox delivery can't move a thread back in time
+THREAD_LATEST_COLUMNS = ('subject', 'last_email_id', 'last_from_email', 'last_from_name', 'last_at')
+THREAD_UPSERT = """
+    INSERT INTO mail_threads (user_id, thread_id, subject, participants, message_count, unread_count,
+                              last_email_id, last_from_email, last_from_name, last_at)
+    {rows}
+    ON CONFLICT (user_id, thread_id) DO UPDATE SET
+        message_count = mail_threads.message_count + EXCLUDED.message_count,
+        unread_count = mail_threads.unread_count + EXCLUDED.unread_count,
+        """ + ',\n        '.join(
+    f"{column} = CASE WHEN EXCLUDED.last_at >= mail_threads.last_at THEN EXCLUDED.{column} ELSE mail_threads.{column} END"
+    for column in THREAD_LATEST_COLUMNS
+)
+
+# Summary rebuilt from the letters themselves, for backfills and after a user moves shards
+THREAD_REBUILD_SQL = """
+    INSERT INTO mail_threads (user_id, thread_id, subject, participants, message_count, unread_count,
+                              last_email_id, last_from_email, last_from_name, last_at)
+    SELECT DISTINCT ON (user_id, thread_id)
+           user_id, thread_id, subject,
+           ARRAY(SELECT DISTINCT lower(trim(address)) FROM unnest(ARRAY[from_email, to_email]) address ORDER BY 1),
+           count(*) OVER thread, count(*) FILTER (WHERE is_read IS NOT TRUE) OVER thread,
+           id, from_email, from_name, created_at
+    FROM emails
+    WHERE user_id = ANY(%s) AND thread_id IS NOT NULL
+    WINDOW thread AS (PARTITION BY user_id, thread_id)
+    ORDER BY user_id, thread_id, created_at DESC, id DESC
+"""
+
+# Every write that changes a cached folder turns its head into a tombstone in the same transaction;
+# bumping generation tells a reader rebuilding the page concurrently that its copy is already stale
+HEAD_FOLDERS = ('inbox', 'starred', 'archived')
+HEAD_INVALIDATE = """
+    INSERT INTO mail_folder_heads AS h (user_id, folder)
+    {rows}
+    ON CONFLICT (user_id, folder) DO UPDATE SET emails = NULL, generation = h.generation + 1
+"""
+
+# Module-level constant rather than a format() at the call site, so tools/plan_check.py explains it too
+HEAD_INVALIDATE_USERS = HEAD_INVALIDATE.format(rows="""
+    SELECT user_id, folder FROM unnest(%s::int[]) user_id, unnest(%s::text[]) folder ORDER BY 1, 2
+""")
+
+# Hot statements, prepared once per pooled connection and run with EXECUTE
+STATEMENTS = {
+    'mail_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'mail_session_user': """
         SELECT u.id, u.email, u.phone, u.nikmail, u.display_name, u.avatar_url
         FROM users u
         JOIN sessions s ON u.id = s.user_id
-        WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
-    """, (session_token,))
+        WHERE s.token_hash = $1 AND s.expires_at > CURRENT_TIMESTAMP
+    """,
+    'mail_user_profile': """
+        SELECT id, email, phone, nikmail, display_name, avatar_url
+        FROM users
+        WHERE id = $1
+    """,
+    'mail_revoked_since': """
+        SELECT jti, revoked_at, EXTRACT(EPOCH FROM expires_at)::bigint AS exp
+        FROM revoked_tokens
+        WHERE revoked_at >= $1 AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'mail_user_shard': "SELECT shard, moving_to FROM user_shards WHERE user_id = $1",
+    'mail_user_by_nikmail': "SELECT id FROM users WHERE nikmail = $1",
+    'mail_list_inbox': f"""
+        SELECT {EMAIL_COLUMNS}
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1 AND e.is_archived = FALSE AND e.snoozed_until IS NULL
+        ORDER BY e.created_at DESC
+        LIMIT $2
+    """,
+    'mail_list_starred': f"""
+        SELECT {EMAIL_COLUMNS}
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1 AND e.is_starred = TRUE AND e.is_archived = FALSE
+        ORDER BY e.created_at DESC
+        LIMIT $2
+    """,
+    'mail_list_archived': f"""
+        SELECT {EMAIL_COLUMNS}
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1 AND e.is_archived = TRUE
+        ORDER BY e.created_at DESC
+        LIMIT $2
+    """,
+    'mail_list_all': f"""
+        SELECT {EMAIL_COLUMNS}
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1
+        ORDER BY e.created_at DESC
+        LIMIT $2
+    """,
+    'mail_list_snoozed': f"""
+        SELECT {EMAIL_COLUMNS}, e.snoozed_until
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1 AND e.snoozed_until IS NOT NULL
+        ORDER BY e.snoozed_until
+        LIMIT $2
+    """,
+    'mail_list_thread': f"""
+        SELECT {EMAIL_COLUMNS}
+        FROM {EMAIL_SOURCE}
+        WHERE e.user_id = $1 AND e.thread_id = $2
+        ORDER BY e.created_at DESC
+        LIMIT $3
+    """,
+    'mail_list_threads': """
+        SELECT thread_id, subject, participants, message_count, unread_count,
+               last_email_id, last_from_email, last_from_name, last_at
+        FROM mail_threads
+        WHERE user_id = $1
+        ORDER BY last_at DESC
+        LIMIT $2
+    """,
+    'mail_insert_email': """
+        WITH body AS (
+            INSERT INTO mail_bodies (body_hash, body, body_zlib)
+            VALUES ($6, $7, $8)
+            ON CONFLICT (body_hash) DO NOTHING
+        ), email AS (
+            INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body_hash, thread_id, is_read, is_starred, is_archived, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $10, $9, FALSE, FALSE, CURRENT_TIMESTAMP)
+            RETURNING id, user_id, thread_id, subject, from_email, from_name, is_read, created_at
+        ), head AS (""" + HEAD_INVALIDATE.format(rows="VALUES ($1, 'inbox')") + """
+        ), thread AS (""" + THREAD_UPSERT.format(rows="""
+            SELECT user_id, thread_id, subject, $11::text[], 1, CASE WHEN is_read THEN 0 ELSE 1 END,
+                   id, from_email, from_name, created_at
+            FROM email""") + """
+        )
+        SELECT id FROM email
+    """,
+    'mail_mark_read': """
+        WITH changed AS (
+            UPDATE emails
+            SET is_read = TRUE, read_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND user_id = $2 AND is_read IS NOT TRUE
+            RETURNING user_id, thread_id
+        ), head AS (""" + HEAD_INVALIDATE.format(rows=f"""
+            SELECT user_id, folder FROM changed, unnest(ARRAY{list(HEAD_FOLDERS)}) folder ORDER BY folder""") + """
+        )
+        UPDATE mail_threads t
+        SET unread_count = GREATEST(t.unread_count - 1, 0)
+        FROM changed c
+        WHERE t.user_id = c.user_id AND t.thread_id = c.thread_id
+    """,
+    'mail_head_get': "SELECT generation, emails FROM mail_folder_heads WHERE user_id = $1 AND folder = $2",
+    # $4 is the generation the page was built against, NULL if there was no row yet:
+    # a head invalidated in between keeps its tombstone and the next read tries again
+    'mail_head_store': """
+        INSERT INTO mail_folder_heads AS h (user_id, folder, emails, built_at)
+        VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, folder) DO UPDATE SET emails = EXCLUDED.emails, built_at = EXCLUDED.built_at
+        WHERE h.generation = $4 AND h.emails IS NULL
+    """,
+}
+
+FOLDER_STATEMENTS = {
+    'inbox': 'mail_list_inbox',
+    'starred': 'mail_list_starred',
+    'archived': 'mail_list_archived',
+    'snoozed': 'mail_list_snoozed',
+}
+
+class PreparedConnection(PgConnection):
+    '''Connection that remembers which STATEMENTS are prepared on its server session'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class ShardUnavailable(Exception):
+    '''The user's rows are being moved between shards, writes have to wait'''
+
+_pools: Dict[str, ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_db_connection(dsn: Optional[str] = None):
+    dsn = dsn or DSN
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, dsn,
+                    connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+                )
+    conn = pool.getconn()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    conn.dsn_key = dsn
+    return conn
+
+def release_db_connection(conn) -> None:
+    pool = _pools.get(getattr(conn, 'dsn_key', None))
+    if pool is None:
+        conn.close()
+        return
+    pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
     
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # The server session was reset under us (e.g. DISCARD ALL by a pooler):
+        # forget everything prepared and retry once if nothing else is lost
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Jump consistent hash: growing the shard list remaps only about 1/n of the users
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+_shard_directory: Dict[int, Tuple[float, Optional[int], Optional[int]]] = {}
+
+def user_shard_dsn(user_id: int, for_write: bool = False) -> str:
+    if len(SHARD_DSNS) == 1:
+        return SHARD_DSNS[0]
+    
+    user_id = int(user_id)
+    now = time.time()
+    cached = _shard_directory.get(user_id)
+    
+    if not cached or cached[0] <= now:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            execute_prepared(cur, 'mail_user_shard', (user_id,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        if len(_shard_directory) > 10000:
+            _shard_directory.clear()
+        cached = (now + SHARD_DIRECTORY_TTL, row['shard'] if row else None, row['moving_to'] if row else None)
+        _shard_directory[user_id] = cached
+    
+    _, pinned_shard, moving_to = cached
+    if for_write and moving_to is not None:
+        raise ShardUnavailable()
+    
+    return SHARD_DSNS[pinned_shard if pinned_shard is not None else jump_hash(user_id, len(SHARD_DSNS))]
+
+def lsn_to_int(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+def primary_tag(dsn: str) -> str:
+    # LSNs of different primaries are not comparable, so every marker names its primary
+    return hashlib.sha256(dsn.encode()).hexdigest()[:8]
+
+def parse_min_lsn(headers: Dict[str, Any]) -> Dict[str, int]:
+    '''X-Min-LSN: comma-separated "<primary tag>:<lsn>" markers the client got from X-Write-LSN'''
+    markers: Dict[str, int] = {}
+    value = headers.get('X-Min-LSN') or headers.get('x-min-lsn') or ''
+    
+    for marker in value.split(','):
+        tag, _, lsn = marker.strip().partition(':')
+        try:
+            markers[tag] = max(markers.get(tag, 0), lsn_to_int(lsn))
+        except ValueError:
+            continue
+    
+    return markers
+
+_replica_replayed: Dict[str, Tuple[float, int]] = {}
+
+def read_dsn(dsn: str, min_lsn: Dict[str, int]) -> str:
+    '''A replica of dsn that has replayed the client's last write, or dsn itself'''
+    replicas = REPLICA_DSNS.get(dsn)
+    if not replicas:
+        return dsn
+    
+    replica = random.choice(replicas)
+    needed = min_lsn.get(primary_tag(dsn), 0)
+    if not needed:
+        return replica
+    
+    now = time.time()
+    checked_at, replayed = _replica_replayed.get(replica, (0.0, 0))
+    if replayed >= needed:
+        return replica
+    if now - checked_at < REPLICA_LAG_CACHE_TTL:
+        return dsn
+    
+    try:
+        conn = get_db_connection(replica)
+    except psycopg2.OperationalError:
+        return dsn
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT pg_last_wal_replay_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+        release_db_connection(conn)
     
+    replayed = lsn_to_int(lsn) if lsn else 0
+    _replica_replayed[replica] = (now, replayed)
+    return replica if replayed >= needed else dsn
+
+def commit_with_marker(conn) -> Optional[str]:
+    '''Commits and, if the primary has replicas, returns the X-Write-LSN marker for the commit'''
+    conn.commit()
+    if not REPLICA_DSNS.get(conn.dsn_key):
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+    
+    return f"{primary_tag(conn.dsn_key)}:{lsn}"
+
+def write_marker_headers(marker: Optional[str]) -> Dict[str, str]:
+    return {'X-Write-LSN': marker, 'Access-Control-Expose-Headers': 'X-Write-LSN'} if marker else {}
+
+def hash_session_token(session_token: str) -> bytes:
+    return hashlib.sha256(session_token.encode('utf-8', 'surrogatepass')).digest()
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    # Real tokens are ASCII; anything else is rejected up front, and signatures are compared as bytes
+    if not SESSION_SIGNING_KEY or not session_token.isascii() or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    
+    parts = session_token.split('.')
+    if len(parts) != 5:
+        return None
+    
+    if not hmac.compare_digest(parts[4].encode(), sign_token_payload('.'.join(parts[:4])).encode()):
+        return None
+    
+    try:
+        claims = {'user_id': int(parts[1]), 'exp': int(parts[2]), 'jti': parts[3]}
+    except ValueError:
+        return None
+    
+    return claims if claims['exp'] > time.time() else None
+
+_revoked: Dict[str, int] = {}
+_revoked_checked_at = 0.0
+_revoked_watermark = datetime(1970, 1, 1)
+
+def is_token_revoked(jti: str) -> bool:
+    global _revoked_checked_at, _revoked_watermark
+    
+    now = time.time()
+    if now - _revoked_checked_at >= REVOCATION_CACHE_TTL:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Overlap the window by a minute so revocations from slow transactions aren't missed
+            execute_prepared(cur, 'mail_revoked_since', (_revoked_watermark - timedelta(minutes=1),))
+            for row in cur.fetchall():
+                _revoked[row['jti']] = row['exp']
+                _revoked_watermark = max(_revoked_watermark, row['revoked_at'])
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        for expired_jti in [key for key, exp in _revoked.items() if exp <= now]:
+            _revoked.pop(expired_jti, None)
+        _revoked_checked_at = now
+    
+    return jti in _revoked
+
+def verify_session(session_token: str, min_lsn: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        # Verified in-process; the profile is loaded only by actions that need it
+        claims = decode_signed_token(session_token)
+        if not claims or is_token_revoked(claims['jti']):
+            return None
+        return {'id': claims['user_id']}
+    
+    conn = get_db_connection(read_dsn(DSN, min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_session_user', (psycopg2.Binary(hash_session_token(session_token)),))
+        user = cur.fetchone()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    remember_session_user(session_token, user['id'] if user else None)
     return dict(user) if user else None
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+# Rate limits and the concurrency cap. The code from _buckets to body_action is identical in every
+# function under backend/, and remember_session_user and session_user in every one with sessions (all but
+# downloads): functions deploy separately and share no module. Change every copy at once; only
+# rate_limit_key and the key prefix in take_token are each function's own
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Takes a token from bucket key; returns 0 or the seconds until the next token'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # A full store drops the longest-idle bucket, never all of them: other clients keep their limits
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # The same bucket shared by every container: refill and take in a single UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # Keys never carry raw session tokens, the store may be a shared table
+    key = hashlib.sha256(f"mail:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # An unavailable limiter store must not fail requests: fall back to the local buckets
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Client address as the gateway sees it; X-Forwarded-For is written by the client and can't key a limit.
+    None when there is no gateway context'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Body for the limiter, the profiler and route; a malformed one or a non-object reads as an empty object'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+# Owners of database sessions by token hash, used only as limiter keys: the full session check writes
+# them and the limiter only reads them, so a user's own bucket costs no extra database round trip.
+# Access is still decided by the session check; a stale entry only picks which bucket is charged
+_session_users: "OrderedDict[bytes, int]" = OrderedDict()
+_session_users_lock = threading.Lock()
+
+def remember_session_user(session_token: str, user_id: Optional[int]) -> None:
+    '''Records the owner of a checked session; user_id=None means the session is gone'''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    
+    token_hash = hash_session_token(session_token)
+    with _session_users_lock:
+        if user_id is None:
+            _session_users.pop(token_hash, None)
+            return
+        _session_users[token_hash] = user_id
+        _session_users.move_to_end(token_hash)
+        while len(_session_users) > RATE_LIMIT_LOCAL_MAX:
+            _session_users.popitem(last=False)
+
+def session_user(session_token: str) -> Optional[int]:
+    '''The token's user without a database round trip; None if this container hasn't checked the token yet'''
+    claims = decode_signed_token(session_token)
+    if claims:
+        return claims['user_id']
+    
+    with _session_users_lock:
+        return _session_users.get(hash_session_token(session_token))
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(action, client) for the limiter; None means the request is not limited'''
+    headers = event.get('headers') or {}
+    if is_maintenance_request(headers):
+        return None
+    
+    action = 'list' if event.get('httpMethod') == 'GET' else body_action(body_data) or 'default'
+    # A user whose token has been checked gets their own bucket; anything unverified is counted
+    # by address, or every made-up token would get a fresh bucket
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    user_id = session_user(session_token) if session_token else None
+    identity = f"user:{user_id}" if user_id else client_ip(event)
+    # Without an address the request isn't limited: one shared bucket would throttle all such clients together
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Frame stack in collapsed-stack format: root to leaf joined with semicolons'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# The sampler thread only wakes up while at least one profiled invocation is running
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Distinct stacks are capped so a profile can't eat the container's memory
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Decided before any work: an unprofiled invocation pays for a couple of checks'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Whole aggregate so far: to PROFILE_DIR (file is overwritten) or to the log'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"mail-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE mail pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Wraps handler with the sampling profiler and hands it the parsed request body'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # The body is parsed here once and handed on to the limiter, the profiler and route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Limits are checked before any database work, and overload answers at once instead of queueing
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off drops the limits only; the cap on concurrent database work stays
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': False, 'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
+
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -43,7 +783,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -52,6 +792,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     headers = event.get('headers', {})
     session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
     
+    if method == 'POST' and is_maintenance_request(headers):
+        return handle_maintenance_action(body_data.get('action'), body_data)
+    
     if not session_token:
         return {
             'statusCode': 401,
@@ -59,7 +802,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'success': False, 'error': 'Требуется авторизация'})
         }
     
-    user = verify_session(session_token)
+    min_lsn = parse_min_lsn(headers)
+    user = verify_session(session_token, min_lsn)
     if not user:
         return {
             'statusCode': 401,
@@ -67,155 +811,582 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'success': False, 'error': 'Сессия истекла'})
         }
     
-    if method == 'GET':
-        params = event.get('queryStringParameters') or {}
-        folder = params.get('folder', 'inbox')
-        limit = int(params.get('limit', '50'))
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
+    try:
+        if method == 'GET':
+            params = event.get('queryStringParameters') or {}
+            if params.get('action') == 'threads':
+                return list_threads(user, params, min_lsn)
+            return list_emails(user, params, min_lsn)
         
-        if folder == 'inbox':
-            cur.execute("""
-                SELECT id, from_email, from_name, to_email, subject, body, 
-                       is_read, is_starred, is_archived, created_at, read_at
-                FROM emails
-                WHERE user_id = %s AND is_archived = FALSE
-                ORDER BY created_at DESC
-                LIMIT %s
-            """, (user['id'], limit))
-        elif folder == 'starred':
-            cur.execute("""
-                SELECT id, from_email, from_name, to_email, subject, body, 
-                       is_read, is_starred, is_archived, created_at, read_at
-                FROM emails
-                WHERE user_id = %s AND is_starred = TRUE AND is_archived = FALSE
-                ORDER BY created_at DESC
-                LIMIT %s
-            """, (user['id'], limit))
-        elif folder == 'archived':
+        if method == 'POST':
+            return handle_action(user, body_data.get('action'), body_data)
+    
+    except ShardUnavailable:
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '5', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Почтовый ящик переносится, повторите попытку позже'})
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': False, 'error': 'Метод не поддерживается'})
+    }
+
+def is_maintenance_request(headers: Dict[str, Any]) -> bool:
+    provided = headers.get('X-Maintenance-Key') or headers.get('x-maintenance-key') or ''
+    return bool(MAINTENANCE_KEY) and hmac.compare_digest(provided.encode('utf-8', 'surrogatepass'), MAINTENANCE_KEY.encode())
+
+def pack_body(body_text: str) -> Tuple[bytes, Optional[str], Optional[bytes]]:
+    '''(hash, plain, compressed) for a mail_bodies row; exactly one of plain/compressed is set'''
+    raw = body_text.encode()
+    body_hash = hashlib.sha256(raw).digest()
+    
+    if len(raw) >= MAIL_BODY_COMPRESS_MIN:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return body_hash, None, compressed
+    
+    return body_hash, body_text, None
+
+def unpack_body(email: Dict[str, Any]) -> Dict[str, Any]:
+    compressed = email.pop('body_zlib', None)
+    if email.get('body') is None and compressed is not None:
+        email['body'] = zlib.decompress(compressed).decode()
+    return email
+
+def parse_due_time(value: Any) -> Optional[datetime]:
+    '''ISO-8601 time from the client as naive UTC, like the rest of the stored timestamps'''
+    if not value:
+        return None
+    moment = datetime.fromisoformat(str(value))
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def enqueue_delivery(due_at: datetime, kind: str, user_id: int, payload: Dict[str, Any]) -> int:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            INSERT INTO mail_delivery_queue (due_at, kind, user_id, payload)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        """, (due_at, kind, user_id, json.dumps(payload)))
+        queued_id = cur.fetchone()['id']
+        conn.commit()
+        return queued_id
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def normalize_subject(subject: str) -> str:
+    return ' '.join(REPLY_PREFIX.sub('', subject or '').lower().split())
+
+def thread_key(subject: str, from_email: str, to_email: str) -> Tuple[int, List[str]]:
+    '''Thread id shared by both sides of a conversation: normalized subject plus the set of addresses'''
+    participants = sorted({address.strip().lower() for address in (from_email, to_email) if address})
+    digest = hashlib.sha256((normalize_subject(subject) + '\n' + ','.join(participants)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True), participants
+
+def render_template(template: str, payload: Dict[str, Any]) -> tuple:
+    letter = MAIL_TEMPLATES[template]
+    nikmail = payload['nikmail']
+    body = letter['body'].format(name=payload.get('display_name') or nikmail.split('@')[0], nikmail=nikmail)
+    return letter['from_email'], letter['from_name'], nikmail, letter['subject'], body
+
+def invalidate_heads(cur, user_ids: List[int], folders: Tuple[str, ...] = HEAD_FOLDERS) -> None:
+    '''Tombstones the cached first pages of these mailboxes; heads are locked after emails and before threads'''
+    cur.execute(HEAD_INVALIDATE_USERS, (sorted(set(user_ids)), list(folders)))
+
+def write_letters(cur, letters: List[tuple]) -> None:
+    '''Batch insert of (user_id, from_email, from_name, to_email, subject, body, is_read, created_at) letters on one shard'''
+    rows = []
+    bodies: Dict[bytes, tuple] = {}
+    participants: Dict[Tuple[int, int], List[str]] = {}
+    
+    for user_id, from_email, from_name, to_email, subject, body_text, is_read, created_at in letters:
+        body_hash, body, body_zlib = pack_body(body_text)
+        thread_id, thread_participants = thread_key(subject, from_email, to_email)
+        participants[(user_id, thread_id)] = thread_participants
+        bodies[body_hash] = (psycopg2.Binary(body_hash), body, psycopg2.Binary(body_zlib) if body_zlib else None)
+        rows.append((
+            user_id, from_email, from_name, to_email, subject, psycopg2.Binary(body_hash),
+            thread_id, is_read, False, False, created_at
+        ))
+    
+    # Rows go in key order: parallel deliver_due workers then take row locks in the same
+    # order and wait for each other instead of deadlocking on shared bodies and threads
+    execute_values(cur, """
+        INSERT INTO mail_bodies (body_hash, body, body_zlib) VALUES %s
+        ON CONFLICT (body_hash) DO NOTHING
+    """, [bodies[body_hash] for body_hash in sorted(bodies)])
+    inserted = execute_values(cur, """
+        INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body_hash, thread_id, is_read, is_starred, is_archived, created_at)
+        VALUES %s
+        RETURNING id, user_id, thread_id, subject, from_email, from_name, is_read, created_at
+    """, rows, fetch=True)
+    invalidate_heads(cur, [row['user_id'] for row in inserted], ('inbox',))
+    
+    # One summary row per conversation: ON CONFLICT can't touch the same thread twice in a statement
+    threads: Dict[Tuple[int, int], list] = {}
+    for row in sorted(inserted, key=lambda row: (row['created_at'], row['id'])):
+        key = (row['user_id'], row['thread_id'])
+        message_count, unread_count = (threads[key][4], threads[key][5]) if key in threads else (0, 0)
+        threads[key] = [row['user_id'], row['thread_id'], row['subject'], participants[key],
+                        message_count + 1, unread_count + (0 if row['is_read'] else 1),
+                        row['id'], row['from_email'], row['from_name'], row['created_at']]
+    execute_values(cur, THREAD_UPSERT.format(rows='VALUES %s'), [tuple(threads[key]) for key in sorted(threads)])
+
+def apply_by_shard(conn, work: Dict[str, Tuple[List[tuple], List[int]]]) -> None:
+    '''Writes letters and wakes snoozed mailboxes shard by shard'''
+    for dsn, (letters, wake_user_ids) in work.items():
+        # On the home database this commits together with the caller's queue cleanup;
+        # other shards commit first, so a crash in between can only deliver twice
+        shard_conn = conn if dsn == DSN else get_db_connection(dsn)
+        shard_cur = shard_conn.cursor()
+        try:
+            if letters:
+                write_letters(shard_cur, letters)
+            if wake_user_ids:
+                shard_cur.execute("""
+                    UPDATE emails SET snoozed_until = NULL
+                    WHERE user_id = ANY(%s) AND snoozed_until <= %s
+                """, (wake_user_ids, datetime.utcnow()))
+                invalidate_heads(shard_cur, wake_user_ids, ('inbox',))
+            if shard_conn is not conn:
+                shard_conn.commit()
+        finally:
+            shard_cur.close()
+            if shard_conn is not conn:
+                release_db_connection(shard_conn)
+
+def drain_outbox(batch_size: int, max_batches: int) -> int:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    delivered = 0
+    
+    try:
+        for _ in range(max_batches):
             cur.execute("""
-                SELECT id, from_email, from_name, to_email, subject, body, 
-                       is_read, is_starred, is_archived, created_at, read_at
-                FROM emails
-                WHERE user_id = %s AND is_archived = TRUE
-                ORDER BY created_at DESC
+                SELECT id, user_id, template, payload, created_at
+                FROM mail_outbox
+                ORDER BY id
                 LIMIT %s
-            """, (user['id'], limit))
-        else:
+                FOR UPDATE SKIP LOCKED
+            """, (batch_size,))
+            items = cur.fetchall()
+            
+            work: Dict[str, Tuple[List[tuple], List[int]]] = {}
+            done_ids = []
+            for item in items:
+                try:
+                    dsn = user_shard_dsn(item['user_id'], for_write=True)
+                except ShardUnavailable:
+                    continue
+                work.setdefault(dsn, ([], []))[0].append(
+                    (item['user_id'], *render_template(item['template'], item['payload']), False, item['created_at'])
+                )
+                done_ids.append(item['id'])
+            
+            apply_by_shard(conn, work)
+            
+            if done_ids:
+                cur.execute("DELETE FROM mail_outbox WHERE id = ANY(%s)", (done_ids,))
+            conn.commit()
+            delivered += len(done_ids)
+            
+            if len(items) < batch_size or not done_ids:
+                break
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return delivered
+
+def deliver_due(batch_size: int, max_batches: int) -> int:
+    '''Worker for mail_delivery_queue: any number of these can run at once, SKIP LOCKED hands each its own rows'''
+    conn = get_db_connection()
+    cur = conn.cursor()
+    delivered = 0
+    
+    try:
+        for _ in range(max_batches):
             cur.execute("""
-                SELECT id, from_email, from_name, to_email, subject, body, 
-                       is_read, is_starred, is_archived, created_at, read_at
-                FROM emails
-                WHERE user_id = %s
-                ORDER BY created_at DESC
+                SELECT id, due_at, kind, user_id, payload
+                FROM mail_delivery_queue
+                WHERE due_at <= %s
+                ORDER BY due_at, id
                 LIMIT %s
-            """, (user['id'], limit))
-        
-        emails = [dict(row) for row in cur.fetchall()]
-        
-        for email in emails:
-            if email.get('created_at'):
-                email['created_at'] = email['created_at'].isoformat()
-            if email.get('read_at'):
-                email['read_at'] = email['read_at'].isoformat()
-        
+                FOR UPDATE SKIP LOCKED
+            """, (datetime.utcnow(), batch_size))
+            items = cur.fetchall()
+            if not items:
+                break
+            
+            # Recipients of scheduled letters are resolved at delivery time, in one query per batch
+            addresses = list({item['payload']['to_email'] for item in items if item['kind'] == 'send'})
+            recipients = {}
+            if addresses:
+                cur.execute("SELECT id, nikmail FROM users WHERE nikmail = ANY(%s)", (addresses,))
+                recipients = {row['nikmail']: row['id'] for row in cur.fetchall()}
+            
+            work: Dict[str, Tuple[List[tuple], List[int]]] = {}
+            done_ids = []
+            for item in items:
+                payload = item['payload']
+                letters = []
+                
+                if item['kind'] == 'send':
+                    if payload['to_email'] in recipients:
+                        letters.append((recipients[payload['to_email']], payload['from_email'], payload['from_name'],
+                                        payload['to_email'], payload['subject'], payload['body'], False, item['due_at']))
+                    letters.append((item['user_id'], payload['from_email'], 'Я',
+                                    payload['to_email'], payload['subject'], payload['body'], True, item['due_at']))
+                elif item['kind'] == 'system_send':
+                    letters.append((item['user_id'], payload['from_email'], payload['from_name'],
+                                    payload['to_email'], payload['subject'], payload['body'], False, item['due_at']))
+                
+                try:
+                    targets = [(user_shard_dsn(letter[0], for_write=True), letter) for letter in letters]
+                    wake_dsn = user_shard_dsn(item['user_id'], for_write=True) if item['kind'] == 'wake' else None
+                except ShardUnavailable:
+                    continue
+                
+                for dsn, letter in targets:
+                    work.setdefault(dsn, ([], []))[0].append(letter)
+                if wake_dsn:
+                    work.setdefault(wake_dsn, ([], []))[1].append(item['user_id'])
+                done_ids.append(item['id'])
+            
+            apply_by_shard(conn, work)
+            
+            if done_ids:
+                cur.execute("DELETE FROM mail_delivery_queue WHERE id = ANY(%s)", (done_ids,))
+            conn.commit()
+            delivered += len(done_ids)
+            
+            if len(items) < batch_size or not done_ids:
+                break
+    finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+    
+    return delivered
+
+def rebuild_threads(batch_size: int, max_batches: int) -> int:
+    '''Assigns thread ids to letters written before threading and rebuilds their owners' summaries'''
+    threaded = 0
+    
+    for dsn in dict.fromkeys(SHARD_DSNS):
+        conn = get_db_connection(dsn)
+        cur = conn.cursor()
         
+        try:
+            for _ in range(max_batches):
+                cur.execute("""
+                    SELECT id, user_id, from_email, to_email, subject
+                    FROM emails
+                    WHERE thread_id IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (batch_size,))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                
+                execute_values(cur, """
+                    UPDATE emails SET thread_id = batch.thread_id
+                    FROM (VALUES %s) AS batch (id, thread_id)
+                    WHERE emails.id = batch.id
+                """, [(row['id'], thread_key(row['subject'], row['from_email'], row['to_email'])[0]) for row in rows])
+                
+                user_ids = sorted({row['user_id'] for row in rows})
+                invalidate_heads(cur, user_ids)
+                cur.execute("DELETE FROM mail_threads WHERE user_id = ANY(%s)", (user_ids,))
+                cur.execute(THREAD_REBUILD_SQL, (user_ids,))
+                conn.commit()
+                threaded += len(rows)
+                
+                if len(rows) < batch_size:
+                    break
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    
+    return threaded
+
+def handle_maintenance_action(action: Optional[str], body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if action == 'rebuild_threads':
+        threaded = rebuild_threads(
+            int(body_data.get('batch_size', MAIL_OUTBOX_BATCH)),
+            int(body_data.get('max_batches', MAIL_OUTBOX_MAX_BATCHES))
+        )
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'emails': emails})
+            'body': json.dumps({'success': True, 'threaded': threaded})
         }
     
-    if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        action = body_data.get('action')
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
+    if action == 'deliver_due':
+        delivered = deliver_due(
+            int(body_data.get('batch_size', MAIL_DELIVERY_BATCH)),
+            int(body_data.get('max_batches', MAIL_DELIVERY_MAX_BATCHES))
+        )
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'delivered': delivered})
+        }
+    
+    if action == 'drain_outbox':
+        delivered = drain_outbox(
+            int(body_data.get('batch_size', MAIL_OUTBOX_BATCH)),
+            int(body_data.get('max_batches', MAIL_OUTBOX_MAX_BATCHES))
+        )
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'delivered': delivered})
+        }
+    
+    return {
+        'statusCode': 400,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': False, 'error': 'Неизвестное действие'})
+    }
+
+def load_user_profile(user: Dict[str, Any]) -> Dict[str, Any]:
+    if 'nikmail' in user:
+        return user
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_user_profile', (user['id'],))
+        profile = cur.fetchone()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return dict(profile) if profile else user
+
+def serialize_emails(rows: List[Dict[str, Any]]) -> str:
+    emails = [unpack_body(dict(row)) for row in rows]
+    
+    for email in emails:
+        if email.get('thread_id') is not None:
+            email['thread_id'] = str(email['thread_id'])
+        if email.get('created_at'):
+            email['created_at'] = email['created_at'].isoformat()
+        if email.get('read_at'):
+            email['read_at'] = email['read_at'].isoformat()
+        if email.get('snoozed_until'):
+            email['snoozed_until'] = email['snoozed_until'].isoformat()
+    
+    return json.dumps(emails)
+
+def store_head(user_id: int, folder: str, emails: str, generation: Optional[int]) -> None:
+    try:
+        dsn = user_shard_dsn(user_id, for_write=True)
+    except ShardUnavailable:
+        # The mailbox is being copied to another shard; a head written here would be deleted with it
+        return
+    
+    conn = get_db_connection(dsn)
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_head_store', (user_id, folder, emails, generation))
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def list_emails(user: Dict[str, Any], params: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
+    folder = params.get('folder', 'inbox')
+    limit = int(params.get('limit', '50'))
+    cacheable = not params.get('thread_id') and folder in HEAD_FOLDERS and limit == MAIL_HEAD_SIZE
+    head = None
+    
+    conn = get_db_connection(read_dsn(user_shard_dsn(user['id']), min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        if cacheable:
+            execute_prepared(cur, 'mail_head_get', (user['id'], folder))
+            head = cur.fetchone()
         
-        if action == 'send':
-            to_email = body_data.get('to_email')
-            subject = body_data.get('subject', '')
-            body_text = body_data.get('body', '')
-            
-            if not to_email:
-                cur.close()
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': False, 'error': 'Укажите получателя'})
-                }
-            
-            if to_email.endswith('@nikmail.ru'):
-                recipient_nikmail = to_email
-                cur.execute("SELECT id FROM users WHERE nikmail = %s", (recipient_nikmail,))
-                recipient = cur.fetchone()
-                
-                if recipient:
-                    cur.execute("""
-                        INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body, is_read, is_starred, is_archived, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, FALSE, FALSE, FALSE, CURRENT_TIMESTAMP)
-                        RETURNING id
-                    """, (
-                        recipient['id'],
-                        user['nikmail'],
-                        user.get('display_name') or user['nikmail'].split('@')[0],
-                        to_email,
-                        subject,
-                        body_text
-                    ))
-                    conn.commit()
-            
-            cur.execute("""
-                INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body, is_read, is_starred, is_archived, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, TRUE, FALSE, FALSE, CURRENT_TIMESTAMP)
-                RETURNING id
-            """, (
-                user['id'],
-                user['nikmail'],
-                'Я',
-                to_email,
-                subject,
-                body_text
-            ))
-            conn.commit()
-            email_id = cur.fetchone()['id']
-            
-            cur.close()
-            conn.close()
-            
+        if head and head['emails'] is not None:
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Письмо отправлено', 'email_id': email_id})
+                'body': '{"success": true, "emails": ' + head['emails'] + '}'
             }
         
-        elif action == 'mark_read':
-            email_id = body_data.get('email_id')
-            
-            cur.execute("""
-                UPDATE emails 
-                SET is_read = TRUE, read_at = CURRENT_TIMESTAMP
-                WHERE id = %s AND user_id = %s
-            """, (email_id, user['id']))
-            conn.commit()
-            
-            cur.close()
-            conn.close()
+        if params.get('thread_id'):
+            execute_prepared(cur, 'mail_list_thread', (user['id'], int(params['thread_id']), limit))
+        else:
+            execute_prepared(cur, FOLDER_STATEMENTS.get(folder, 'mail_list_all'), (user['id'], limit))
+        emails = serialize_emails(cur.fetchall())
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    if cacheable:
+        # Built on whatever served the read, replica included: the generation check on the primary
+        # rejects the page if any write to this folder committed after the head was read
+        store_head(user['id'], folder, emails, head['generation'] if head else None)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': '{"success": true, "emails": ' + emails + '}'
+    }
+
+def list_threads(user: Dict[str, Any], params: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
+    limit = int(params.get('limit', '50'))
+    
+    conn = get_db_connection(read_dsn(user_shard_dsn(user['id']), min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_list_threads', (user['id'], limit))
+        threads = [dict(row) for row in cur.fetchall()]
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    for thread in threads:
+        # JSON numbers lose precision past 2^53, and thread ids use all 64 bits
+        thread['thread_id'] = str(thread['thread_id'])
+        thread['last_at'] = thread['last_at'].isoformat()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': True, 'threads': threads})
+    }
+
+def find_user_by_nikmail(nikmail: str) -> Optional[Dict[str, Any]]:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'mail_user_by_nikmail', (nikmail,))
+        return cur.fetchone()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def deliver_emails(dsn: str, letters: List[tuple]) -> Tuple[List[int], Optional[str]]:
+    '''Writes (user_id, from_email, from_name, to_email, subject, body, is_read) letters on one shard in one transaction'''
+    conn = get_db_connection(dsn)
+    cur = conn.cursor()
+    
+    try:
+        email_ids = []
+        for user_id, from_email, from_name, to_email, subject, body_text, is_read in letters:
+            body_hash, body, body_zlib = pack_body(body_text)
+            thread_id, participants = thread_key(subject, from_email, to_email)
+            execute_prepared(cur, 'mail_insert_email', (
+                user_id, from_email, from_name, to_email, subject,
+                psycopg2.Binary(body_hash), body, psycopg2.Binary(body_zlib) if body_zlib else None, is_read,
+                thread_id, participants
+            ))
+            email_ids.append(cur.fetchone()['id'])
+        return email_ids, commit_with_marker(conn)
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def send_email(user: Dict[str, Any], body_data: Dict[str, Any]) -> Dict[str, Any]:
+    to_email = body_data.get('to_email')
+    subject = body_data.get('subject', '')
+    body_text = body_data.get('body', '')
+    
+    if not to_email:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Укажите получателя'})
+        }
+    
+    try:
+        send_at = parse_due_time(body_data.get('send_at'))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Некорректное время отправки'})
+        }
+    
+    user = load_user_profile(user)
+    
+    if send_at and send_at > datetime.utcnow():
+        # Both copies are written by deliver_due; the recipient is looked up then, not now
+        scheduled_id = enqueue_delivery(send_at, 'send', user['id'], {
+            'from_email': user['nikmail'],
+            'from_name': user.get('display_name') or user['nikmail'].split('@')[0],
+            'to_email': to_email,
+            'subject': subject,
+            'body': body_text,
+        })
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'message': 'Письмо запланировано', 'scheduled_id': scheduled_id, 'send_at': send_at.isoformat()})
+        }
+    
+    recipient = find_user_by_nikmail(to_email) if to_email.endswith('@nikmail.ru') else None
+    
+    # Both shards are resolved before anything is written: a move in progress on either side
+    # answers 503 while nothing has been delivered yet, so the client's retry can't duplicate the letter
+    sender_dsn = user_shard_dsn(user['id'], for_write=True)
+    recipient_dsn = user_shard_dsn(recipient['id'], for_write=True) if recipient else None
+    
+    letters = [(user['id'], user['nikmail'], 'Я', to_email, subject, body_text, True)]
+    if recipient:
+        recipient_copy = (recipient['id'], user['nikmail'], user.get('display_name') or user['nikmail'].split('@')[0],
+                          to_email, subject, body_text, False)
+        if recipient_dsn == sender_dsn:
+            letters.insert(0, recipient_copy)
+        else:
+            deliver_emails(recipient_dsn, [recipient_copy])
+    
+    # The sender reads from their own shard, so their copy's marker is the one to hand back;
+    # on a shared shard both copies commit in this one transaction
+    email_ids, marker = deliver_emails(sender_dsn, letters)
+    email_id = email_ids[-1]
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
+        'body': json.dumps({'success': True, 'message': 'Письмо отправлено', 'email_id': email_id})
+    }
+
+def update_email(user: Dict[str, Any], action: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    email_id = body_data.get('email_id')
+    
+    conn = get_db_connection(user_shard_dsn(user['id'], for_write=True))
+    cur = conn.cursor()
+    
+    try:
+        if action == 'mark_read':
+            execute_prepared(cur, 'mail_mark_read', (email_id, user['id']))
+            marker = commit_with_marker(conn)
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
                 'body': json.dumps({'success': True, 'message': 'Помечено как прочитанное'})
             }
         
         elif action == 'toggle_star':
-            email_id = body_data.get('email_id')
-            
             cur.execute("""
                 UPDATE emails 
                 SET is_starred = NOT is_starred
@@ -223,92 +1394,150 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 RETURNING is_starred
             """, (email_id, user['id']))
             result = cur.fetchone()
-            conn.commit()
+            if result:
+                invalidate_heads(cur, [user['id']])
+            marker = commit_with_marker(conn)
             
             is_starred = result['is_starred'] if result else False
             
-            cur.close()
-            conn.close()
-            
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
                 'body': json.dumps({'success': True, 'is_starred': is_starred})
             }
         
-        elif action == 'archive':
-            email_id = body_data.get('email_id')
-            
-            cur.execute("""
-                UPDATE emails 
-                SET is_archived = TRUE
-                WHERE id = %s AND user_id = %s
-            """, (email_id, user['id']))
-            conn.commit()
-            
-            cur.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Письмо архивировано'})
-            }
-        
-        elif action == 'system_send':
-            to_nikmail = body_data.get('to_nikmail')
-            subject = body_data.get('subject', '')
-            body_text = body_data.get('body', '')
-            from_email = body_data.get('from_email', 'system@nikmail.ru')
-            from_name = body_data.get('from_name', 'NikMail Система')
-            
-            cur.execute("SELECT id FROM users WHERE nikmail = %s", (to_nikmail,))
-            recipient = cur.fetchone()
-            
-            if not recipient:
-                cur.close()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': False, 'error': 'Пользователь не найден'})
-                }
-            
-            cur.execute("""
-                INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body, is_read, is_starred, is_archived, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, FALSE, FALSE, FALSE, CURRENT_TIMESTAMP)
-                RETURNING id
-            """, (
-                recipient['id'],
-                from_email,
-                from_name,
-                to_nikmail,
-                subject,
-                body_text
-            ))
-            conn.commit()
-            email_id = cur.fetchone()['id']
-            
-            cur.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Письмо доставлено', 'email_id': email_id})
-            }
+        cur.execute("""
+            UPDATE emails 
+            SET is_archived = TRUE
+            WHERE id = %s AND user_id = %s
+        """, (email_id, user['id']))
+        if cur.rowcount:
+            invalidate_heads(cur, [user['id']])
+        marker = commit_with_marker(conn)
         
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
+            'body': json.dumps({'success': True, 'message': 'Письмо архивировано'})
+        }
+    
+    finally:
         cur.close()
-        conn.close()
-        
+        release_db_connection(conn)
+
+def system_send(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    to_nikmail = body_data.get('to_nikmail')
+    subject = body_data.get('subject', '')
+    body_text = body_data.get('body', '')
+    from_email = body_data.get('from_email', 'system@nikmail.ru')
+    from_name = body_data.get('from_name', 'NikMail Система')
+    
+    try:
+        send_at = parse_due_time(body_data.get('send_at'))
+    except ValueError:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': False, 'error': 'Неизвестное действие'})
+            'body': json.dumps({'success': False, 'error': 'Некорректное время отправки'})
+        }
+    
+    recipient = find_user_by_nikmail(to_nikmail)
+    
+    if not recipient:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Пользователь не найден'})
+        }
+    
+    if send_at and send_at > datetime.utcnow():
+        scheduled_id = enqueue_delivery(send_at, 'system_send', recipient['id'], {
+            'from_email': from_email,
+            'from_name': from_name,
+            'to_email': to_nikmail,
+            'subject': subject,
+            'body': body_text,
+        })
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'message': 'Письмо запланировано', 'scheduled_id': scheduled_id, 'send_at': send_at.isoformat()})
         }
     
+    (email_id,), _ = deliver_emails(
+        user_shard_dsn(recipient['id'], for_write=True),
+        [(recipient['id'], from_email, from_name, to_nikmail, subject, body_text, False)]
+    )
+    
     return {
-        'statusCode': 405,
+        'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': False, 'error': 'Метод не поддерживается'})
+        'body': json.dumps({'success': True, 'message': 'Письмо доставлено', 'email_id': email_id})
+    }
+
+def snooze_email(user: Dict[str, Any], body_data: Dict[str, Any]) -> Dict[str, Any]:
+    email_id = body_data.get('email_id')
+    
+    try:
+        until = parse_due_time(body_data.get('until'))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Некорректное время'})
+        }
+    
+    if until and until <= datetime.utcnow():
+        until = None
+    
+    # The wake-up is queued before the letter is hidden, so a failure in between never strands it;
+    # the worker only wakes snoozes that are actually due, so a stale wake-up is harmless
+    if until:
+        enqueue_delivery(until, 'wake', user['id'], {})
+    
+    conn = get_db_connection(user_shard_dsn(user['id'], for_write=True))
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            UPDATE emails
+            SET snoozed_until = %s
+            WHERE id = %s AND user_id = %s
+            RETURNING id
+        """, (until, email_id, user['id']))
+        
+        if not cur.fetchone():
+            conn.rollback()
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': False, 'error': 'Письмо не найдено'})
+            }
+        
+        invalidate_heads(cur, [user['id']], ('inbox',))
+        marker = commit_with_marker(conn)
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
+        'body': json.dumps({'success': True, 'snoozed_until': until.isoformat() if until else None})
+    }
+
+def handle_action(user: Dict[str, Any], action: Optional[str], body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if action == 'send':
+        return send_email(user, body_data)
+    elif action == 'snooze':
+        return snooze_email(user, body_data)
+    elif action in ('mark_read', 'toggle_star', 'archive'):
+        return update_email(user, action, body_data)
+    elif action == 'system_send':
+        return system_send(body_data)
+    
+    return {
+        'statusCode': 400,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': False, 'error': 'Неизвестное действие'})
     }
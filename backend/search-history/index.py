@@ -7,36 +7,621 @@ Returns: HTTP response dict с историей поиска или статус
 
 import json
 import os
-from datetime import datetime
-from typing import Dict, Any, List
+import math
+import base64
+import functools
+import hashlib
+import hmac
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Set
 import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local — корзины в памяти контейнера, postgres — общая таблица rate_limit_buckets, off — без лимитов
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# Сколько запросов контейнер одновременно пускает к базе; остальным сразу 503, а не очередь за соединением
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Бюджеты действий: (ёмкость корзины, пополнение токенов в секунду); RATE_LIMIT_OVERRIDES='{"login": [10, 0.2]}'
+RATE_LIMITS = {
+    'add': (30, 2),
+    'default': (60, 5),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Выборочное профилирование: доля вызовов, действия через запятую (send,GET) или заголовок X-Profile-Key
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Стеки копятся всё время жизни тёплого контейнера и выгружаются каждые PROFILE_DUMP_EVERY профилированных вызовов
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# Пользовательские таблицы (emails, search_history, downloads) могут лежать в нескольких базах;
+# DATABASE_URL остаётся домашней базой для users, sessions и справочника user_shards
+SHARD_DSNS: List[str] = json.loads(os.environ['DATABASE_SHARDS']) if os.environ.get('DATABASE_SHARDS') else [DATABASE_URL]
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', '60'))
+# Реплики для чтения: {"<dsn основной базы>": ["<dsn реплики>", ...]}; база без реплик читается сама
+REPLICA_DSNS: Dict[str, List[str]] = json.loads(os.environ.get('DATABASE_REPLICAS') or '{}')
+REPLICA_LAG_CACHE_TTL = float(os.environ.get('REPLICA_LAG_CACHE_TTL', '1'))
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_CACHE_TTL = float(os.environ.get('REVOCATION_CACHE_TTL', '30'))
+SIGNED_TOKEN_PREFIX = 'v1.'
+# Окно дневной статистики и длина списка частых запросов в действии analytics
+ANALYTICS_DAYS = int(os.environ.get('ANALYTICS_DAYS', '30'))
+ANALYTICS_TOP_QUERIES = int(os.environ.get('ANALYTICS_TOP_QUERIES', '10'))
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+# Горячие запросы: PREPARE один раз на соединение из пула, дальше только EXECUTE
+STATEMENTS = {
+    'history_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'history_session_user': """
+        SELECT user_id FROM sessions 
+        WHERE token_hash = $1 AND expires_at > $2
+    """,
+    'history_revoked_since': """
+        SELECT jti, revoked_at, EXTRACT(EPOCH FROM expires_at)::bigint AS exp
+        FROM revoked_tokens
+        WHERE revoked_at >= $1 AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'history_user_shard': "SELECT shard, moving_to FROM user_shards WHERE user_id = $1",
+    # Запись вместе со сводками аналитики: поиски за день по поисковику и счётчик запроса
+    'history_insert': """
+        WITH entry AS (
+            INSERT INTO search_history (user_id, search_query, search_engine, created_at, is_incognito)
+            VALUES ($1, $2, $3, $4, $5)
+            RETURNING id, user_id, search_query, search_engine, created_at, is_incognito
+        ), daily AS (
+            INSERT INTO search_daily_stats (user_id, day, search_engine, searches)
+            SELECT user_id, created_at::date, COALESCE(search_engine, 'google'), 1
+            FROM entry WHERE NOT is_incognito
+            ON CONFLICT (user_id, day, search_engine) DO UPDATE SET searches = search_daily_stats.searches + 1
+        ), top AS (
+            INSERT INTO search_top_queries (user_id, normalized_query, search_query, searches, last_searched_at)
+            SELECT user_id, left(lower(trim(search_query)), 256), search_query, 1, created_at
+            FROM entry WHERE NOT is_incognito
+            ON CONFLICT (user_id, normalized_query) DO UPDATE SET
+                searches = search_top_queries.searches + 1,
+                search_query = EXCLUDED.search_query,
+                last_searched_at = GREATEST(search_top_queries.last_searched_at, EXCLUDED.last_searched_at)
+        )
+        SELECT id, search_query, search_engine, created_at FROM entry
+    """,
+    'history_list': """
+        SELECT id, search_query, search_engine, created_at
+        FROM search_history
+        WHERE user_id = $1 AND is_incognito = false
+        ORDER BY created_at DESC
+        LIMIT $2
+    """,
+    'history_daily_stats': """
+        SELECT day, search_engine, searches
+        FROM search_daily_stats
+        WHERE user_id = $1 AND day >= $2
+        ORDER BY day
+    """,
+    'history_top_queries': """
+        SELECT search_query, searches, last_searched_at
+        FROM search_top_queries
+        WHERE user_id = $1
+        ORDER BY searches DESC, last_searched_at DESC
+        LIMIT $2
+    """,
+}
 
-def get_user_id_from_session(session_token: str) -> int:
-    conn = get_db_connection()
+class PreparedConnection(PgConnection):
+    '''Соединение, которое помнит, какие STATEMENTS уже подготовлены в его серверной сессии'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class ShardUnavailable(Exception):
+    '''Строки пользователя сейчас переносятся между шардами, запись придётся повторить'''
+
+_pools: Dict[str, ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_db_connection(dsn: Optional[str] = None):
+    dsn = dsn or DATABASE_URL
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, dsn,
+                    connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+                )
+    conn = pool.getconn()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    conn.dsn_key = dsn
+    return conn
+
+def release_db_connection(conn) -> None:
+    pool = _pools.get(getattr(conn, 'dsn_key', None))
+    if pool is None:
+        conn.close()
+        return
+    pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Серверную сессию сбросили (например, DISCARD ALL у пулера):
+        # забываем подготовленное и повторяем один раз, если ничего не теряем
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Jump consistent hash: при добавлении шарда переезжает только ~1/n пользователей
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+_shard_directory: Dict[int, Tuple[float, Optional[int], Optional[int]]] = {}
+
+def user_shard_dsn(user_id: int, for_write: bool = False) -> str:
+    if len(SHARD_DSNS) == 1:
+        return SHARD_DSNS[0]
+    
+    user_id = int(user_id)
+    now = time.time()
+    cached = _shard_directory.get(user_id)
+    
+    if not cached or cached[0] <= now:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            execute_prepared(cur, 'history_user_shard', (user_id,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        if len(_shard_directory) > 10000:
+            _shard_directory.clear()
+        cached = (now + SHARD_DIRECTORY_TTL, row['shard'] if row else None, row['moving_to'] if row else None)
+        _shard_directory[user_id] = cached
+    
+    _, pinned_shard, moving_to = cached
+    if for_write and moving_to is not None:
+        raise ShardUnavailable()
+    
+    return SHARD_DSNS[pinned_shard if pinned_shard is not None else jump_hash(user_id, len(SHARD_DSNS))]
+
+def lsn_to_int(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+def primary_tag(dsn: str) -> str:
+    # LSN разных основных баз несравнимы, поэтому метка называет свою базу
+    return hashlib.sha256(dsn.encode()).hexdigest()[:8]
+
+def parse_min_lsn(headers: Dict[str, Any]) -> Dict[str, int]:
+    '''X-Min-LSN: метки "<тег базы>:<lsn>" через запятую, полученные клиентом из X-Write-LSN'''
+    markers: Dict[str, int] = {}
+    value = headers.get('X-Min-LSN') or headers.get('x-min-lsn') or ''
+    
+    for marker in value.split(','):
+        tag, _, lsn = marker.strip().partition(':')
+        try:
+            markers[tag] = max(markers.get(tag, 0), lsn_to_int(lsn))
+        except ValueError:
+            continue
+    
+    return markers
+
+_replica_replayed: Dict[str, Tuple[float, int]] = {}
+
+def read_dsn(dsn: str, min_lsn: Dict[str, int]) -> str:
+    '''Реплика dsn, уже применившая последнюю запись клиента, иначе сама основная база'''
+    replicas = REPLICA_DSNS.get(dsn)
+    if not replicas:
+        return dsn
+    
+    replica = random.choice(replicas)
+    needed = min_lsn.get(primary_tag(dsn), 0)
+    if not needed:
+        return replica
+    
+    now = time.time()
+    checked_at, replayed = _replica_replayed.get(replica, (0.0, 0))
+    if replayed >= needed:
+        return replica
+    if now - checked_at < REPLICA_LAG_CACHE_TTL:
+        return dsn
+    
+    try:
+        conn = get_db_connection(replica)
+    except psycopg2.OperationalError:
+        return dsn
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            SELECT user_id FROM sessions 
-            WHERE session_token = %s AND expires_at > %s
-        """, (session_token, datetime.utcnow()))
+        cur.execute("SELECT pg_last_wal_replay_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    replayed = lsn_to_int(lsn) if lsn else 0
+    _replica_replayed[replica] = (now, replayed)
+    return replica if replayed >= needed else dsn
+
+def commit_with_marker(conn) -> Optional[str]:
+    '''Коммитит и, если у базы есть реплики, возвращает метку X-Write-LSN для этого коммита'''
+    conn.commit()
+    if not REPLICA_DSNS.get(conn.dsn_key):
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        lsn = cur.fetchone()['lsn']
+        conn.rollback()
+    finally:
+        cur.close()
+    
+    return f"{primary_tag(conn.dsn_key)}:{lsn}"
+
+def write_marker_headers(marker: Optional[str]) -> Dict[str, str]:
+    return {'X-Write-LSN': marker, 'Access-Control-Expose-Headers': 'X-Write-LSN'} if marker else {}
+
+def hash_session_token(session_token: str) -> bytes:
+    return hashlib.sha256(session_token.encode('utf-8', 'surrogatepass')).digest()
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    # Настоящие токены состоят из ASCII; остальное — сразу мимо, а подписи сравниваются байтами
+    if not SESSION_SIGNING_KEY or not session_token.isascii() or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    
+    parts = session_token.split('.')
+    if len(parts) != 5:
+        return None
+    
+    if not hmac.compare_digest(parts[4].encode(), sign_token_payload('.'.join(parts[:4])).encode()):
+        return None
+    
+    try:
+        claims = {'user_id': int(parts[1]), 'exp': int(parts[2]), 'jti': parts[3]}
+    except ValueError:
+        return None
+    
+    return claims if claims['exp'] > time.time() else None
+
+_revoked: Dict[str, int] = {}
+_revoked_checked_at = 0.0
+_revoked_watermark = datetime(1970, 1, 1)
+
+def is_token_revoked(jti: str) -> bool:
+    global _revoked_checked_at, _revoked_watermark
+    
+    now = time.time()
+    if now - _revoked_checked_at >= REVOCATION_CACHE_TTL:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Перекрываем окно на минуту, чтобы не пропустить отзывы из долгих транзакций
+            execute_prepared(cur, 'history_revoked_since', (_revoked_watermark - timedelta(minutes=1),))
+            for row in cur.fetchall():
+                _revoked[row['jti']] = row['exp']
+                _revoked_watermark = max(_revoked_watermark, row['revoked_at'])
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        for expired_jti in [key for key, exp in _revoked.items() if exp <= now]:
+            _revoked.pop(expired_jti, None)
+        _revoked_checked_at = now
+    
+    return jti in _revoked
+
+def get_user_id_from_session(session_token: str, min_lsn: Dict[str, int]) -> int:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        claims = decode_signed_token(session_token)
+        if not claims or is_token_revoked(claims['jti']):
+            raise ValueError('Invalid session')
+        return claims['user_id']
+    
+    conn = get_db_connection(read_dsn(DATABASE_URL, min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'history_session_user', (psycopg2.Binary(hash_session_token(session_token)), datetime.utcnow()))
         
         result = cur.fetchone()
+        remember_session_user(session_token, result['user_id'] if result else None)
         if not result:
             raise ValueError('Invalid session')
         
         return result['user_id']
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Лимиты запросов и ограничение параллельности. Код от _buckets до body_action одинаков во всех
+# функциях backend/, а remember_session_user и session_user — во всех, где есть сессии (кроме downloads):
+# функции деплоятся по отдельности и общего модуля у них нет. Правка вносится во все копии сразу;
+# своё у каждой функции только rate_limit_key и префикс ключа в take_token
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Берёт токен из корзины key; возвращает 0 или через сколько секунд появится следующий'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # Переполненное хранилище вытесняет дольше всех не виденную корзину, а не сбрасывает все лимиты
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # Та же корзина, но общая для всех контейнеров: пополнение и списание одним UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'history_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # В ключе нет сырых токенов сессии: хранилище может быть общей таблицей
+    key = hashlib.sha256(f"history:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # Недоступное хранилище лимитов не должно ронять запросы: считаем по месту
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Адрес клиента, который видит шлюз; X-Forwarded-For пишет сам клиент, и ключом лимита он быть не может.
+    None — вызов пришёл не через шлюз'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Тело запроса для лимитов, профилировщика и route; кривое тело или не объект читается как пустой объект'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+# Владельцы обычных сессий по хэшу токена, только как ключ лимита: записывает их полная проверка сессии,
+# а лимит лишь читает, так что собственная корзина пользователя не стоит лишнего запроса к базе.
+# Доступ по-прежнему решает проверка сессии, устаревшая запись влияет только на выбор корзины
+_session_users: "OrderedDict[bytes, int]" = OrderedDict()
+_session_users_lock = threading.Lock()
+
+def remember_session_user(session_token: str, user_id: Optional[int]) -> None:
+    '''Запоминает владельца проверенной сессии; user_id=None — сессии больше нет'''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    
+    token_hash = hash_session_token(session_token)
+    with _session_users_lock:
+        if user_id is None:
+            _session_users.pop(token_hash, None)
+            return
+        _session_users[token_hash] = user_id
+        _session_users.move_to_end(token_hash)
+        while len(_session_users) > RATE_LIMIT_LOCAL_MAX:
+            _session_users.popitem(last=False)
+
+def session_user(session_token: str) -> Optional[int]:
+    '''Пользователь токена без запроса к базе; None — токен в этом контейнере ещё не проверялся'''
+    claims = decode_signed_token(session_token)
+    if claims:
+        return claims['user_id']
+    
+    with _session_users_lock:
+        return _session_users.get(hash_session_token(session_token))
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(действие, клиент) для лимитов; None — запрос не ограничивается'''
+    headers = event.get('headers') or {}
+    action = 'get' if event.get('httpMethod') == 'GET' else body_action(body_data) or 'default'
+    # Своя корзина у пользователя, чей токен уже проверен; непроверенный токен считается по адресу,
+    # иначе каждый выдуманный токен давал бы свежий лимит
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    user_id = session_user(session_token) if session_token else None
+    identity = f"user:{user_id}" if user_id else client_ip(event)
+    # Без адреса запрос не ограничивается: общая корзина на всех таких клиентов душила бы их разом
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Стек кадра в формате collapsed stacks: от корня к листу через точку с запятой'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+# Поток-сэмплер просыпается, только пока идёт хоть один профилируемый вызов
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Число разных стеков ограничено, чтобы профиль не съел память контейнера
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Решение принимается до любой работы: непрофилируемый вызов платит за пару проверок'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Накопленные стеки целиком: в PROFILE_DIR (файл перезаписывается) или в лог'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"history-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE history pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Оборачивает handler сэмплирующим профилировщиком и передаёт ему разобранное тело запроса'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # Тело разбирается здесь один раз и передаётся лимитам, профилировщику и route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Лимиты проверяются до любой работы с базой, перегрузка отвечает сразу, а не копится в очереди
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off снимает только лимиты, ограничение параллельных запросов к базе остаётся
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
+
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -45,7 +630,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, X-Min-LSN',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -53,18 +638,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     headers = event.get('headers', {})
     session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    min_lsn = parse_min_lsn(headers)
     
     try:
         if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action')
             
             if action == 'add':
-                return add_search_history(session_token, body_data)
+                return add_search_history(session_token, body_data, min_lsn)
             elif action == 'get':
-                return get_search_history(session_token, body_data)
+                return get_search_history(session_token, body_data, min_lsn)
             elif action == 'clear':
-                return clear_search_history(session_token)
+                return clear_search_history(session_token, min_lsn)
+            elif action == 'analytics':
+                return get_search_analytics(session_token, body_data, min_lsn)
             else:
                 return {
                     'statusCode': 400,
@@ -74,8 +661,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         elif method == 'GET':
             params = event.get('queryStringParameters', {}) or {}
-            limit = int(params.get('limit', 50))
-            return get_search_history(session_token, {'limit': limit})
+            if params.get('action') == 'analytics':
+                return get_search_analytics(session_token, params, min_lsn)
+            return get_search_history(session_token, params, min_lsn)
         
         return {
             'statusCode': 405,
@@ -89,6 +677,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': str(e)})
         }
+    except ShardUnavailable:
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '5', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'История переносится, повторите попытку позже'})
+        }
     except Exception as e:
         return {
             'statusCode': 500,
@@ -96,7 +690,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': str(e)})
         }
 
-def add_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, Any]:
+def add_search_history(session_token: str, data: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
     if not session_token:
         return {
             'statusCode': 401,
@@ -122,24 +716,20 @@ def add_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, An
             'body': json.dumps({'success': True, 'message': 'Incognito mode - not saved'})
         }
     
-    user_id = get_user_id_from_session(session_token)
+    user_id = get_user_id_from_session(session_token, min_lsn)
     
-    conn = get_db_connection()
+    conn = get_db_connection(user_shard_dsn(user_id, for_write=True))
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            INSERT INTO search_history (user_id, search_query, search_engine, created_at, is_incognito)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id, search_query, search_engine, created_at
-        """, (user_id, search_query, search_engine, datetime.utcnow(), is_incognito))
+        execute_prepared(cur, 'history_insert', (user_id, search_query, search_engine, datetime.utcnow(), is_incognito))
         
         result = cur.fetchone()
-        conn.commit()
+        marker = commit_with_marker(conn)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({
                 'success': True,
                 'history': dict(result)
@@ -148,9 +738,17 @@ def add_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, An
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def bounded_int(value: Any, default: int, low: int, high: int) -> int:
+    '''Целое из запроса, прижатое к low..high; null — значение по умолчанию, не целое — ValueError'''
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+    return min(max(int(value), low), high)
 
-def get_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, Any]:
+def get_search_history(session_token: str, data: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
     if not session_token:
         return {
             'statusCode': 401,
@@ -158,20 +756,23 @@ def get_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, An
             'body': json.dumps({'error': 'Session token required'})
         }
     
-    user_id = get_user_id_from_session(session_token)
-    limit = data.get('limit', 50)
+    # Ошибка разбора здесь — это 400, а не ValueError, который route превращает в 401 «сессия недействительна»
+    try:
+        limit = bounded_int(data.get('limit'), 50, 0, 1000)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'limit должен быть целым числом'})
+        }
     
-    conn = get_db_connection()
+    user_id = get_user_id_from_session(session_token, min_lsn)
+    
+    conn = get_db_connection(read_dsn(user_shard_dsn(user_id), min_lsn))
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            SELECT id, search_query, search_engine, created_at
-            FROM search_history
-            WHERE user_id = %s AND is_incognito = false
-            ORDER BY created_at DESC
-            LIMIT %s
-        """, (user_id, limit))
+        execute_prepared(cur, 'history_list', (user_id, limit))
         
         history = cur.fetchall()
         
@@ -186,9 +787,9 @@ def get_search_history(session_token: str, data: Dict[str, Any]) -> Dict[str, An
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
-def clear_search_history(session_token: str) -> Dict[str, Any]:
+def clear_search_history(session_token: str, min_lsn: Dict[str, int]) -> Dict[str, Any]:
     if not session_token:
         return {
             'statusCode': 401,
@@ -196,21 +797,82 @@ def clear_search_history(session_token: str) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Session token required'})
         }
     
-    user_id = get_user_id_from_session(session_token)
+    user_id = get_user_id_from_session(session_token, min_lsn)
     
-    conn = get_db_connection()
+    conn = get_db_connection(user_shard_dsn(user_id, for_write=True))
     cur = conn.cursor()
     
     try:
         cur.execute("UPDATE search_history SET is_incognito = true WHERE user_id = %s", (user_id,))
-        conn.commit()
+        # Очищенная история не должна всплывать и в аналитике
+        cur.execute("DELETE FROM search_daily_stats WHERE user_id = %s", (user_id,))
+        cur.execute("DELETE FROM search_top_queries WHERE user_id = %s", (user_id,))
+        marker = commit_with_marker(conn)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **write_marker_headers(marker)},
             'body': json.dumps({'success': True, 'message': 'History cleared'})
         }
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def get_search_analytics(session_token: str, data: Dict[str, Any], min_lsn: Dict[str, int]) -> Dict[str, Any]:
+    if not session_token:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Session token required'})
+        }
+    
+    try:
+        days = bounded_int(data.get('days'), ANALYTICS_DAYS, 1, 366)
+        top_limit = bounded_int(data.get('top'), ANALYTICS_TOP_QUERIES, 1, 50)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'days и top должны быть целыми числами'})
+        }
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    
+    user_id = get_user_id_from_session(session_token, min_lsn)
+    
+    conn = get_db_connection(read_dsn(user_shard_dsn(user_id), min_lsn))
+    cur = conn.cursor()
+    
+    try:
+        # Только сводки: не больше days × число поисковиков строк и top_limit строк, сколько бы ни было истории
+        execute_prepared(cur, 'history_daily_stats', (user_id, since))
+        daily_rows = cur.fetchall()
+        execute_prepared(cur, 'history_top_queries', (user_id, top_limit))
+        top_queries = cur.fetchall()
+        
+        per_day: Dict[str, int] = {}
+        per_engine: Dict[str, int] = {}
+        for row in daily_rows:
+            day = row['day'].isoformat()
+            per_day[day] = per_day.get(day, 0) + row['searches']
+            per_engine[row['search_engine']] = per_engine.get(row['search_engine'], 0) + row['searches']
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': True,
+                'since': since.isoformat(),
+                'total': sum(per_day.values()),
+                'daily': [{'day': day, 'searches': count} for day, count in per_day.items()],
+                'engines': sorted(
+                    ({'search_engine': engine, 'searches': count} for engine, count in per_engine.items()),
+                    key=lambda item: item['searches'], reverse=True
+                ),
+                'top_queries': [dict(row) for row in top_queries]
+            }, default=str)
+        }
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
@@ -0,0 +1,636 @@
+"""
+Business: Настройки браузера пользователя - чтение через кэш контейнера и частичное обновление
+Args: event - dict с httpMethod, body, queryStringParameters, headers
+      context - объект с атрибутами: request_id, function_name
+Returns: HTTP response dict с настройками или статусом операции
+"""
+
+import json
+import os
+import math
+import base64
+import functools
+import hashlib
+import hmac
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Optional, Tuple, Set
+import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import connection as PgConnection, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+# local — корзины в памяти контейнера, postgres — общая таблица rate_limit_buckets, off — без лимитов
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_LOCAL_MAX = int(os.environ.get('RATE_LIMIT_LOCAL_MAX', '10000'))
+# Сколько запросов контейнер одновременно пускает к базе; остальным сразу 503, а не очередь за соединением
+DB_CONCURRENCY_MAX = int(os.environ.get('DB_CONCURRENCY_MAX', str(DB_POOL_MAX)))
+# Бюджеты действий: (ёмкость корзины, пополнение токенов в секунду); RATE_LIMIT_OVERRIDES='{"login": [10, 0.2]}'
+RATE_LIMITS = {
+    'update': (30, 2),
+    'default': (60, 5),
+}
+RATE_LIMITS.update({action: tuple(budget) for action, budget in json.loads(os.environ.get('RATE_LIMIT_OVERRIDES') or '{}').items()})
+# Выборочное профилирование: доля вызовов, действия через запятую (send,GET) или заголовок X-Profile-Key
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_ACTIONS = set(filter(None, os.environ.get('PROFILE_ACTIONS', '').split(',')))
+PROFILE_KEY = os.environ.get('PROFILE_KEY')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS', '5000'))
+# Стеки копятся всё время жизни тёплого контейнера и выгружаются каждые PROFILE_DUMP_EVERY профилированных вызовов
+PROFILE_DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+REVOCATION_CACHE_TTL = float(os.environ.get('REVOCATION_CACHE_TTL', '30'))
+SIGNED_TOKEN_PREFIX = 'v1.'
+SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', '1000'))
+
+SETTINGS_COLUMNS = "dark_mode, default_search_engine, settings_json, version"
+
+# Горячие запросы: PREPARE один раз на соединение из пула, дальше только EXECUTE
+STATEMENTS = {
+    'settings_take_token': """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES ($1, $2::float8 - 1, $4::float8)
+        ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) - 1,
+            updated_at = $4::float8
+        WHERE LEAST($2::float8, b.tokens + ($4::float8 - b.updated_at) * $3::float8) >= 1
+        RETURNING tokens
+    """,
+    'settings_session_user': """
+        SELECT user_id FROM sessions 
+        WHERE token_hash = $1 AND expires_at > $2
+    """,
+    'settings_revoked_since': """
+        SELECT jti, revoked_at, EXTRACT(EPOCH FROM expires_at)::bigint AS exp
+        FROM revoked_tokens
+        WHERE revoked_at >= $1 AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'settings_version': "SELECT version FROM user_settings WHERE user_id = $1",
+    'settings_get': f"SELECT {SETTINGS_COLUMNS} FROM user_settings WHERE user_id = $1",
+    # Частичное обновление: settings_json сливается с патчем на стороне БД (||),
+    # ключи из $5 удаляются, version растёт и сбрасывает кэши всех контейнеров
+    'settings_patch': f"""
+        INSERT INTO user_settings (user_id, dark_mode, default_search_engine, settings_json, updated_at, version)
+        VALUES ($1, COALESCE($2, FALSE), COALESCE($3, 'google'), $4::jsonb - $5::text[], $6, 1)
+        ON CONFLICT (user_id) DO UPDATE SET
+            dark_mode = COALESCE($2, user_settings.dark_mode),
+            default_search_engine = COALESCE($3, user_settings.default_search_engine),
+            settings_json = (COALESCE(user_settings.settings_json, '{{}}'::jsonb) || $4::jsonb) - $5::text[],
+            updated_at = $6,
+            version = user_settings.version + 1
+        RETURNING {SETTINGS_COLUMNS}
+    """,
+}
+
+class PreparedConnection(PgConnection):
+    '''Соединение, которое помнит, какие STATEMENTS уже подготовлены в его серверной сессии'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+_pool: Optional[ThreadedConnectionPool] = None
+
+def get_db_connection():
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+            connection_factory=PreparedConnection, cursor_factory=RealDictCursor
+        )
+    conn = _pool.getconn()
+    if conn.closed:
+        _pool.putconn(conn, close=True)
+        conn = _pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    if _pool is None:
+        conn.close()
+        return
+    _pool.putconn(conn, close=bool(conn.closed))
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    conn = cur.connection
+    was_idle = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+    
+    sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(sql, params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Серверную сессию сбросили (например, DISCARD ALL у пулера):
+        # забываем подготовленное и повторяем один раз, если ничего не теряем
+        conn.rollback()
+        conn.prepared.clear()
+        if not was_idle:
+            raise
+        cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+        conn.prepared.add(name)
+        cur.execute(sql, params or None)
+
+def hash_session_token(session_token: str) -> bytes:
+    return hashlib.sha256(session_token.encode('utf-8', 'surrogatepass')).digest()
+
+def sign_token_payload(payload: str) -> str:
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    # Настоящие токены состоят из ASCII; остальное — сразу мимо, а подписи сравниваются байтами
+    if not SESSION_SIGNING_KEY or not session_token.isascii() or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    
+    parts = session_token.split('.')
+    if len(parts) != 5:
+        return None
+    
+    if not hmac.compare_digest(parts[4].encode(), sign_token_payload('.'.join(parts[:4])).encode()):
+        return None
+    
+    try:
+        claims = {'user_id': int(parts[1]), 'exp': int(parts[2]), 'jti': parts[3]}
+    except ValueError:
+        return None
+    
+    return claims if claims['exp'] > time.time() else None
+
+_revoked: Dict[str, int] = {}
+_revoked_checked_at = 0.0
+_revoked_watermark = datetime(1970, 1, 1)
+
+def is_token_revoked(jti: str) -> bool:
+    global _revoked_checked_at, _revoked_watermark
+    
+    now = time.time()
+    if now - _revoked_checked_at >= REVOCATION_CACHE_TTL:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Перекрываем окно на минуту, чтобы не пропустить отзывы из долгих транзакций
+            execute_prepared(cur, 'settings_revoked_since', (_revoked_watermark - timedelta(minutes=1),))
+            for row in cur.fetchall():
+                _revoked[row['jti']] = row['exp']
+                _revoked_watermark = max(_revoked_watermark, row['revoked_at'])
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        
+        for expired_jti in [key for key, exp in _revoked.items() if exp <= now]:
+            _revoked.pop(expired_jti, None)
+        _revoked_checked_at = now
+    
+    return jti in _revoked
+
+def get_user_id_from_session(session_token: str) -> int:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        claims = decode_signed_token(session_token)
+        if not claims or is_token_revoked(claims['jti']):
+            raise ValueError('Invalid session')
+        return claims['user_id']
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'settings_session_user', (psycopg2.Binary(hash_session_token(session_token)), datetime.utcnow()))
+        
+        result = cur.fetchone()
+        remember_session_user(session_token, result['user_id'] if result else None)
+        if not result:
+            raise ValueError('Invalid session')
+        
+        return result['user_id']
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# user_id -> (version, готовое JSON-тело ответа); актуальность сверяется по user_settings.version
+_settings_cache: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+
+def cache_settings(user_id: int, row: Dict[str, Any]) -> Tuple[int, str]:
+    entry = (row['version'], json.dumps({
+        'success': True,
+        'settings': {
+            'dark_mode': row['dark_mode'],
+            'default_search_engine': row['default_search_engine'],
+            'settings_json': row['settings_json'] or {}
+        },
+        'version': row['version']
+    }))
+    _settings_cache[user_id] = entry
+    _settings_cache.move_to_end(user_id)
+    while len(_settings_cache) > SETTINGS_CACHE_SIZE:
+        _settings_cache.popitem(last=False)
+    return entry
+
+# Лимиты запросов и ограничение параллельности. Код от _buckets до body_action одинаков во всех
+# функциях backend/, а remember_session_user и session_user — во всех, где есть сессии (кроме downloads):
+# функции деплоятся по отдельности и общего модуля у них нет. Правка вносится во все копии сразу;
+# своё у каждой функции только rate_limit_key и префикс ключа в take_token
+_buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_CONCURRENCY_MAX)
+
+def take_token_local(key: str, capacity: float, rate: float) -> float:
+    '''Берёт токен из корзины key; возвращает 0 или через сколько секунд появится следующий'''
+    now = time.monotonic()
+    
+    with _buckets_lock:
+        tokens, updated_at = _buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        
+        if tokens < 1:
+            _buckets[key] = (tokens, now)
+            _buckets.move_to_end(key)
+            return (1 - tokens) / rate
+        
+        _buckets[key] = (tokens - 1, now)
+        _buckets.move_to_end(key)
+        # Переполненное хранилище вытесняет дольше всех не виденную корзину, а не сбрасывает все лимиты
+        while len(_buckets) > RATE_LIMIT_LOCAL_MAX:
+            _buckets.popitem(last=False)
+        return 0.0
+
+def take_token_postgres(key: str, capacity: float, rate: float) -> float:
+    # Та же корзина, но общая для всех контейнеров: пополнение и списание одним UPSERT
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'settings_take_token', (key, capacity, rate, time.time()))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    return 0.0 if row else 1 / rate
+
+def take_token(action: str, identity: str) -> float:
+    capacity, rate = RATE_LIMITS.get(action) or RATE_LIMITS['default']
+    # В ключе нет сырых токенов сессии: хранилище может быть общей таблицей
+    key = hashlib.sha256(f"settings:{action}:{identity}".encode()).hexdigest()[:32]
+    
+    if RATE_LIMIT_STORE == 'postgres':
+        try:
+            return take_token_postgres(key, capacity, rate)
+        except psycopg2.Error:
+            # Недоступное хранилище лимитов не должно ронять запросы: считаем по месту
+            return take_token_local(key, capacity, rate)
+    return take_token_local(key, capacity, rate)
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''Адрес клиента, который видит шлюз; X-Forwarded-For пишет сам клиент, и ключом лимита он быть не может.
+    None — вызов пришёл не через шлюз'''
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+def request_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Тело запроса для лимитов, профилировщика и route; кривое тело или не объект читается как пустой объект'''
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return {}
+    return body_data if isinstance(body_data, dict) else {}
+
+def body_action(body_data: Dict[str, Any]) -> Optional[str]:
+    action = body_data.get('action')
+    return action if isinstance(action, str) else None
+
+# Владельцы обычных сессий по хэшу токена, только как ключ лимита: записывает их полная проверка сессии,
+# а лимит лишь читает, так что собственная корзина пользователя не стоит лишнего запроса к базе.
+# Доступ по-прежнему решает проверка сессии, устаревшая запись влияет только на выбор корзины
+_session_users: "OrderedDict[bytes, int]" = OrderedDict()
+_session_users_lock = threading.Lock()
+
+def remember_session_user(session_token: str, user_id: Optional[int]) -> None:
+    '''Запоминает владельца проверенной сессии; user_id=None — сессии больше нет'''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    
+    token_hash = hash_session_token(session_token)
+    with _session_users_lock:
+        if user_id is None:
+            _session_users.pop(token_hash, None)
+            return
+        _session_users[token_hash] = user_id
+        _session_users.move_to_end(token_hash)
+        while len(_session_users) > RATE_LIMIT_LOCAL_MAX:
+            _session_users.popitem(last=False)
+
+def session_user(session_token: str) -> Optional[int]:
+    '''Пользователь токена без запроса к базе; None — токен в этом контейнере ещё не проверялся'''
+    claims = decode_signed_token(session_token)
+    if claims:
+        return claims['user_id']
+    
+    with _session_users_lock:
+        return _session_users.get(hash_session_token(session_token))
+
+def rate_limit_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(действие, клиент) для лимитов; None — запрос не ограничивается'''
+    headers = event.get('headers') or {}
+    action = 'get' if event.get('httpMethod') == 'GET' else body_action(body_data) or 'default'
+    # Своя корзина у пользователя, чей токен уже проверен; непроверенный токен считается по адресу,
+    # иначе каждый выдуманный токен давал бы свежий лимит
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    user_id = session_user(session_token) if session_token else None
+    identity = f"user:{user_id}" if user_id else client_ip(event)
+    # Без адреса запрос не ограничивается: общая корзина на всех таких клиентов душила бы их разом
+    return (action, identity) if identity else None
+
+_profile_stacks: Counter = Counter()
+_profile_threads: Set[int] = set()
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profile_sampler: Optional[threading.Thread] = None
+_profiled_invocations = 0
+
+def collapse_stack(frame) -> str:
+    '''Стек кадра в формате collapsed stacks: от корня к листу через точку с запятой'''
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Поток-сэмплер просыпается, только пока идёт хоть один профилируемый вызов
+def sample_profiled_threads() -> None:
+    while True:
+        _profile_wakeup.wait()
+        frames = sys._current_frames()
+        
+        with _profile_lock:
+            if not _profile_threads:
+                _profile_wakeup.clear()
+                continue
+            for thread_id in _profile_threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                # Число разных стеков ограничено, чтобы профиль не съел память контейнера
+                if stack not in _profile_stacks and len(_profile_stacks) >= PROFILE_MAX_STACKS:
+                    stack = '(other)'
+                _profile_stacks[stack] += 1
+        
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def should_profile(event: Dict[str, Any], body_data: Dict[str, Any]) -> bool:
+    '''Решение принимается до любой работы: непрофилируемый вызов платит за пару проверок'''
+    if PROFILE_KEY:
+        headers = event.get('headers') or {}
+        profile_key = headers.get('X-Profile-Key') or headers.get('x-profile-key')
+        if profile_key and hmac.compare_digest(profile_key.encode('utf-8', 'surrogatepass'), PROFILE_KEY.encode()):
+            return True
+    if PROFILE_ACTIONS:
+        action = body_action(body_data) or (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod')
+        if action in PROFILE_ACTIONS:
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def dump_profile() -> None:
+    '''Накопленные стеки целиком: в PROFILE_DIR (файл перезаписывается) или в лог'''
+    with _profile_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_profile_stacks.items())]
+        invocations = _profiled_invocations
+    
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"settings-{os.getpid()}.folded"), 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+    else:
+        print(f"PROFILE settings pid={os.getpid()} invocations={invocations}\n" + '\n'.join(lines), flush=True)
+
+def profiled(func):
+    '''Оборачивает handler сэмплирующим профилировщиком и передаёт ему разобранное тело запроса'''
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        global _profile_sampler, _profiled_invocations
+        
+        # Тело разбирается здесь один раз и передаётся лимитам, профилировщику и route
+        body_data = request_body(event)
+        if not should_profile(event, body_data):
+            return func(event, context, body_data)
+        
+        thread_id = threading.get_ident()
+        with _profile_lock:
+            if _profile_sampler is None:
+                _profile_sampler = threading.Thread(target=sample_profiled_threads, daemon=True)
+                _profile_sampler.start()
+            _profile_threads.add(thread_id)
+            _profile_wakeup.set()
+        
+        try:
+            return func(event, context, body_data)
+        finally:
+            with _profile_lock:
+                _profile_threads.discard(thread_id)
+                _profiled_invocations += 1
+                dump_due = _profiled_invocations % PROFILE_DUMP_EVERY == 0
+            if dump_due:
+                dump_profile()
+    
+    return wrapper
+
+@profiled
+def handler(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return route(event, context, body_data)
+    
+    # Лимиты проверяются до любой работы с базой, перегрузка отвечает сразу, а не копится в очереди
+    if not _db_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Retry-After': '1', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Сервер перегружен, повторите попытку'})
+        }
+    
+    try:
+        # RATE_LIMIT_STORE=off снимает только лимиты, ограничение параллельных запросов к базе остаётся
+        limit_key = rate_limit_key(event, body_data) if RATE_LIMIT_STORE != 'off' else None
+        retry_after = take_token(*limit_key) if limit_key else 0.0
+        
+        if retry_after:
+            return {
+                'statusCode': 429,
+                'headers': {'Content-Type': 'application/json', 'Retry-After': str(math.ceil(retry_after)), 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Слишком много запросов, попробуйте позже'})
+            }
+        
+        return route(event, context, body_data)
+    finally:
+        _db_slots.release()
+
+def route(event: Dict[str, Any], context: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, If-None-Match',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    headers = event.get('headers', {})
+    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    
+    try:
+        if not session_token:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Session token required'})
+            }
+        
+        user_id = get_user_id_from_session(session_token)
+        
+        if method == 'GET':
+            return get_settings(user_id, headers.get('If-None-Match') or headers.get('if-none-match'))
+        
+        elif method == 'POST':
+            action = body_data.get('action')
+            
+            if action == 'update':
+                return update_settings(user_id, body_data)
+            else:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Unknown action'})
+                }
+        
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'})
+        }
+    
+    except ValueError as e:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
+
+def get_settings(user_id: int, if_none_match: Optional[str]) -> Dict[str, Any]:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        cached = _settings_cache.get(user_id)
+        entry = None
+        
+        if cached:
+            # Дешёвая проверка версии вместо чтения всего документа
+            execute_prepared(cur, 'settings_version', (user_id,))
+            current = cur.fetchone()
+            if current and current['version'] == cached[0]:
+                entry = cached
+                _settings_cache.move_to_end(user_id)
+        
+        if entry is None:
+            execute_prepared(cur, 'settings_get', (user_id,))
+            row = cur.fetchone()
+            
+            if not row:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Настройки не найдены'})
+                }
+            
+            entry = cache_settings(user_id, row)
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    version, body = entry
+    etag = f'"{version}"'
+    
+    if if_none_match == etag:
+        return {
+            'statusCode': 304,
+            'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*'},
+            'body': ''
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'ETag': etag, 'Access-Control-Allow-Origin': '*'},
+        'body': body
+    }
+
+def update_settings(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    dark_mode = data.get('dark_mode')
+    default_search_engine = data.get('default_search_engine')
+    patch = data.get('settings') or {}
+    remove = data.get('remove') or []
+    
+    if dark_mode is not None and not isinstance(dark_mode, bool):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'dark_mode должен быть true или false'})
+        }
+    
+    if default_search_engine is not None and (not isinstance(default_search_engine, str) or len(default_search_engine) > 50):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Некорректная поисковая система'})
+        }
+    
+    if not isinstance(patch, dict) or not isinstance(remove, list) or not all(isinstance(key, str) for key in remove):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'settings должен быть объектом, remove — списком ключей'})
+        }
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        execute_prepared(cur, 'settings_patch', (
+            user_id, dark_mode, default_search_engine, json.dumps(patch), remove, datetime.utcnow()
+        ))
+        row = cur.fetchone()
+        conn.commit()
+    
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    version, body = cache_settings(user_id, row)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'ETag': f'"{version}"', 'Access-Control-Allow-Origin': '*'},
+        'body': body
+    }
@@ -0,0 +1,16 @@
+-- Сессии ищутся по SHA-256 токена: ключ фиксированной ширины (32 байта)
+-- вместо строки токена, а user_id и expires_at лежат прямо в индексе,
+-- так что проверка сессии обходится index-only scan.
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS token_hash BYTEA;
+
+UPDATE sessions SET token_hash = sha256(convert_to(session_token, 'UTF8')) WHERE token_hash IS NULL;
+
+ALTER TABLE sessions ALTER COLUMN token_hash SET NOT NULL;
+
+DROP INDEX IF EXISTS idx_sessions_token;
+ALTER TABLE sessions DROP COLUMN session_token;
+
+CREATE UNIQUE INDEX idx_sessions_token_hash ON sessions(token_hash) INCLUDE (user_id, expires_at);
+
+-- Для пакетной очистки истёкших сессий
+CREATE INDEX idx_sessions_expires_at ON sessions(expires_at);
@@ -0,0 +1,10 @@
+-- Отозванные подписанные токены (logout в режиме SESSION_TOKEN_MODE=signed).
+-- Хранятся только до истечения срока самого токена.
+CREATE TABLE revoked_tokens (
+    jti VARCHAR(32) PRIMARY KEY,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at);
+CREATE INDEX idx_revoked_tokens_expires_at ON revoked_tokens(expires_at);
@@ -0,0 +1,9 @@
+-- Очередь писем, которые пишет не сам пользователь (приветственное письмо при регистрации).
+-- Регистрация только кладёт строку сюда, функция mail вычитывает очередь пачками.
+CREATE TABLE mail_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    template VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,2 @@
+-- Список закладок одной папки пользователя
+CREATE INDEX idx_bookmarks_user_folder ON bookmarks(user_id, folder);
@@ -0,0 +1,6 @@
+-- Версия настроек: растёт при каждом изменении, по ней контейнеры функции settings
+-- проверяют свой кэш, не перечитывая весь settings_json
+ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+DROP INDEX IF EXISTS idx_user_settings_user_id;
+CREATE INDEX idx_user_settings_user_id ON user_settings(user_id) INCLUDE (version);
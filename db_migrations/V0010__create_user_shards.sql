@@ -0,0 +1,16 @@
+-- Справочник размещения пользователей по шардам (DATABASE_SHARDS).
+-- По умолчанию шард вычисляется jump-хэшем от user_id; строка здесь закрепляет
+-- пользователя за конкретным шардом, а moving_to означает, что идёт перенос
+-- и запись в его пользовательские таблицы временно закрыта.
+-- Читается только в домашней базе (DATABASE_URL).
+CREATE TABLE user_shards (
+    user_id INTEGER PRIMARY KEY,
+    shard SMALLINT NOT NULL,
+    moving_to SMALLINT,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Строки истории и загрузок могут жить на шарде без таблицы users,
+-- ссылочная целостность между базами не проверяется (как у emails)
+ALTER TABLE search_history DROP CONSTRAINT IF EXISTS search_history_user_id_fkey;
+ALTER TABLE downloads DROP CONSTRAINT IF EXISTS downloads_user_id_fkey;
@@ -0,0 +1,24 @@
+-- Тексты писем хранятся один раз на шард и адресуются SHA-256 от исходного текста (UTF-8).
+-- Крупные тексты лежат сжатыми zlib в body_zlib, остальные как есть в body.
+CREATE TABLE mail_bodies (
+    body_hash BYTEA PRIMARY KEY,
+    body TEXT,
+    body_zlib BYTEA,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT mail_body_present CHECK (body IS NOT NULL OR body_zlib IS NOT NULL)
+);
+
+INSERT INTO mail_bodies (body_hash, body)
+SELECT DISTINCT sha256(convert_to(body, 'UTF8')), body
+FROM emails
+ON CONFLICT (body_hash) DO NOTHING;
+
+ALTER TABLE emails ADD COLUMN body_hash BYTEA;
+UPDATE emails SET body_hash = sha256(convert_to(body, 'UTF8'));
+
+ALTER TABLE emails ALTER COLUMN body_hash SET NOT NULL;
+ALTER TABLE emails ADD CONSTRAINT emails_body_hash_fkey FOREIGN KEY (body_hash) REFERENCES mail_bodies(body_hash);
+-- Нужен проверке внешнего ключа при удалении осиротевших текстов
+CREATE INDEX idx_emails_body_hash ON emails(body_hash);
+
+ALTER TABLE emails DROP COLUMN body;
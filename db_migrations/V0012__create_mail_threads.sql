@@ -0,0 +1,22 @@
+-- Переписки: thread_id вычисляется при записи письма из нормализованной темы и участников
+-- (одинаков у копий отправителя и получателя), а mail_threads хранит готовую сводку по каждой
+-- переписке ящика, чтобы список переписок не группировал письма при чтении.
+-- Старые письма получают thread_id maintenance-действием rebuild_threads функции mail.
+ALTER TABLE emails ADD COLUMN thread_id BIGINT;
+CREATE INDEX idx_emails_user_thread ON emails(user_id, thread_id, created_at DESC);
+
+CREATE TABLE mail_threads (
+    user_id INTEGER NOT NULL,
+    thread_id BIGINT NOT NULL,
+    subject VARCHAR(500) NOT NULL,
+    participants TEXT[] NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    last_email_id INTEGER NOT NULL,
+    last_from_email VARCHAR(255) NOT NULL,
+    last_from_name VARCHAR(255),
+    last_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, thread_id)
+);
+
+CREATE INDEX idx_mail_threads_user_last ON mail_threads(user_id, last_at DESC);
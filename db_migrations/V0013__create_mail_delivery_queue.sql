@@ -0,0 +1,19 @@
+-- Отложенные действия почты: письма с send_at и пробуждение отложенных (snooze) писем.
+-- Очередь живёт в домашней базе рядом с mail_outbox и вычитывается воркерами
+-- (maintenance-действие deliver_due) через FOR UPDATE SKIP LOCKED по индексу due_at.
+CREATE TABLE mail_delivery_queue (
+    id BIGSERIAL PRIMARY KEY,
+    due_at TIMESTAMP NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    user_id INTEGER NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_mail_delivery_queue_due ON mail_delivery_queue(due_at, id);
+
+-- Воркеры удаляют строки из головы индекса; частая очистка не даёт им пробираться через мёртвые версии
+ALTER TABLE mail_delivery_queue SET (autovacuum_vacuum_scale_factor = 0.01, autovacuum_vacuum_threshold = 1000);
+
+ALTER TABLE emails ADD COLUMN snoozed_until TIMESTAMP;
+CREATE INDEX idx_emails_snoozed ON emails(user_id, snoozed_until) WHERE snoozed_until IS NOT NULL;
@@ -0,0 +1,8 @@
+-- Общее хранилище корзин токенов для ограничения частоты запросов (RATE_LIMIT_STORE=postgres).
+-- UNLOGGED: состояние лимитов не пишется в WAL и может потеряться при сбое — это допустимо.
+-- bucket_key — хэш функции, действия и клиента; updated_at — эпоха в секундах.
+CREATE UNLOGGED TABLE rate_limit_buckets (
+    bucket_key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at DOUBLE PRECISION NOT NULL
+);
@@ -0,0 +1,24 @@
+-- Индексы под реальные предикаты списков: user_id + фильтр папки + ORDER BY created_at DESC.
+-- Одиночные индексы по is_read/is_archived/created_at ни один запрос не использовал,
+-- а по user_id приходилось читать весь ящик и сортировать ради первых N строк.
+-- Проверяется tools/plan_check.py.
+
+DROP INDEX IF EXISTS idx_emails_user_id;
+DROP INDEX IF EXISTS idx_emails_created_at;
+DROP INDEX IF EXISTS idx_emails_is_read;
+DROP INDEX IF EXISTS idx_emails_is_archived;
+
+CREATE INDEX idx_emails_user_created ON emails(user_id, created_at DESC);
+CREATE INDEX idx_emails_user_inbox ON emails(user_id, created_at DESC) WHERE is_archived = FALSE AND snoozed_until IS NULL;
+CREATE INDEX idx_emails_user_starred ON emails(user_id, created_at DESC) WHERE is_starred = TRUE AND is_archived = FALSE;
+CREATE INDEX idx_emails_user_archived ON emails(user_id, created_at DESC) WHERE is_archived = TRUE;
+
+-- Письма без thread_id остаются только до конца rebuild_threads: индекс почти всегда пуст
+CREATE INDEX idx_emails_unthreaded ON emails(id) WHERE thread_id IS NULL;
+
+DROP INDEX IF EXISTS idx_search_history_created_at;
+CREATE INDEX idx_search_history_user_visible ON search_history(user_id, created_at DESC) WHERE is_incognito = false;
+
+DROP INDEX IF EXISTS idx_downloads_user_id;
+DROP INDEX IF EXISTS idx_downloads_created_at;
+CREATE INDEX idx_downloads_user_created ON downloads(user_id, created_at DESC);
@@ -0,0 +1,38 @@
+-- Сводки истории поиска для аналитики: поиски по дням и поисковикам и частые запросы.
+-- Поддерживаются при каждой записи (history_insert в search-history), поэтому
+-- действие analytics читает только их и не проходит по search_history пользователя.
+-- Живут на шарде пользователя рядом с search_history; инкогнито-запросы не учитываются.
+
+CREATE TABLE search_daily_stats (
+    user_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    search_engine VARCHAR(50) NOT NULL,
+    searches INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day, search_engine)
+);
+
+-- normalized_query — запрос в нижнем регистре, обрезанный до 256 символов: ключ для подсчёта повторов
+CREATE TABLE search_top_queries (
+    user_id INTEGER NOT NULL,
+    normalized_query VARCHAR(256) NOT NULL,
+    search_query TEXT NOT NULL,
+    searches INTEGER NOT NULL DEFAULT 0,
+    last_searched_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, normalized_query)
+);
+
+CREATE INDEX idx_search_top_queries_rank ON search_top_queries(user_id, searches DESC, last_searched_at DESC);
+
+INSERT INTO search_daily_stats (user_id, day, search_engine, searches)
+SELECT user_id, created_at::date, COALESCE(search_engine, 'google'), count(*)
+FROM search_history
+WHERE is_incognito = false
+GROUP BY 1, 2, 3;
+
+INSERT INTO search_top_queries (user_id, normalized_query, search_query, searches, last_searched_at)
+SELECT DISTINCT ON (user_id, left(lower(trim(search_query)), 256))
+       user_id, left(lower(trim(search_query)), 256), search_query,
+       count(*) OVER (PARTITION BY user_id, left(lower(trim(search_query)), 256)), created_at
+FROM search_history
+WHERE is_incognito = false
+ORDER BY user_id, left(lower(trim(search_query)), 256), created_at DESC, id DESC;
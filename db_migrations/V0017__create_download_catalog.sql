@@ -0,0 +1,38 @@
+-- Каталог URL загрузок: адрес файла хранится один раз на шард, а строки downloads
+-- ссылаются на него по url_hash. Популярные файлы (браузеры, установщики) больше не
+-- повторяют один и тот же длинный URL в каждой загрузке каждого пользователя.
+-- Имя, размер и тип файла присылает клиент, поэтому они остаются в downloads: то, что
+-- записал один пользователь, другим не показывается.
+--
+-- url_hash = sha256 нормализованного URL: без пробелов по краям и #фрагмента,
+-- схема и хост в нижнем регистре. В каталоге лежит сам нормализованный URL.
+-- Функция downloads нормализует так же (normalize_file_url). Строки каталога не удаляются.
+
+CREATE TABLE download_catalog (
+    url_hash BYTEA PRIMARY KEY,
+    file_url TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE downloads ADD COLUMN url_hash BYTEA;
+
+WITH normalized AS (
+    SELECT id, COALESCE(lower(substring(url FROM '^[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*')) || substring(url FROM '^[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*(.*)$'), url) AS file_url
+    FROM (SELECT id, split_part(btrim(file_url, E' \t\r\n'), '#', 1) AS url FROM downloads) u
+), hashed AS (
+    UPDATE downloads d
+    SET url_hash = sha256(convert_to(n.file_url, 'UTF8'))
+    FROM normalized n
+    WHERE n.id = d.id
+    RETURNING d.url_hash, n.file_url, d.created_at
+)
+INSERT INTO download_catalog (url_hash, file_url, created_at)
+SELECT url_hash, min(file_url), min(created_at)
+FROM hashed
+GROUP BY url_hash;
+
+ALTER TABLE downloads ALTER COLUMN url_hash SET NOT NULL;
+ALTER TABLE downloads ADD CONSTRAINT downloads_url_hash_fkey FOREIGN KEY (url_hash) REFERENCES download_catalog(url_hash);
+CREATE INDEX idx_downloads_url_hash ON downloads(url_hash);
+
+ALTER TABLE downloads DROP COLUMN file_url;
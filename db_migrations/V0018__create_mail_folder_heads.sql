@@ -0,0 +1,14 @@
+-- Кэш первых страниц почты: готовый JSON первых MAIL_HEAD_SIZE писем папок inbox, starred
+-- и archived, так что самый частый GET почты — чтение одной строки по ключу.
+-- Живёт на шарде пользователя рядом с emails. Каждая запись, меняющая папку, в своей же
+-- транзакции обнуляет emails и увеличивает generation; чтение при промахе строит страницу
+-- заново и сохраняет её, только если generation за это время не изменился.
+
+CREATE TABLE mail_folder_heads (
+    user_id INTEGER NOT NULL,
+    folder VARCHAR(16) NOT NULL,
+    generation BIGINT NOT NULL DEFAULT 0,
+    emails TEXT,
+    built_at TIMESTAMP,
+    PRIMARY KEY (user_id, folder)
+);
@@ -0,0 +1,3 @@
+-- Закладка вне папок хранится с folder = NULL. Раньше create и update сохраняли
+-- пустую строку как есть, и такие закладки не совпадали с импортом по (url, folder).
+UPDATE bookmarks SET folder = NULL WHERE folder = '';
@@ -0,0 +1,29 @@
+const WRITE_LSN_KEY = 'write_lsn';
+
+// Метки последних записей ("<тег базы>:<lsn>" из X-Write-LSN). Пока реплика их не догнала,
+// функции читают с основной базы — пользователь сразу видит своё письмо, загрузку или запрос.
+function loadMarkers(): Record<string, string> {
+  try {
+    return JSON.parse(localStorage.getItem(WRITE_LSN_KEY) || '{}');
+  } catch {
+    return {};
+  }
+}
+
+export async function apiFetch(input: string, init: RequestInit = {}): Promise<Response> {
+  const headers = new Headers(init.headers);
+  const markers = Object.entries(loadMarkers()).map(([tag, lsn]) => `${tag}:${lsn}`);
+  if (markers.length > 0) {
+    headers.set('X-Min-LSN', markers.join(','));
+  }
+
+  const response = await fetch(input, { ...init, headers });
+
+  const written = response.headers.get('X-Write-LSN');
+  if (written) {
+    const [tag, lsn] = written.split(':');
+    localStorage.setItem(WRITE_LSN_KEY, JSON.stringify({ ...loadMarkers(), [tag]: lsn }));
+  }
+
+  return response;
+}
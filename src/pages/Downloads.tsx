@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
+import { apiFetch } from '@/lib/api';
 import Icon from '@/components/ui/icon';
 
 interface Download {
@@ -35,7 +36,7 @@ export default function Downloads() {
     }
 
     try {
-      const response = await fetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
+      const response = await apiFetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
         headers: {
           'X-User-Id': user.id.toString()
         }
@@ -76,7 +77,7 @@ export default function Downloads() {
     const user = JSON.parse(localStorage.getItem('user') || '{}');
     
     try {
-      const response = await fetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
+      const response = await apiFetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
         method: 'PUT',
         headers: {
           'Content-Type': 'application/json',
@@ -102,7 +103,7 @@ export default function Downloads() {
     if (!confirm('Удалить эту загрузку?')) return;
 
     try {
-      const response = await fetch(`https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403?id=${downloadId}`, {
+      const response = await apiFetch(`https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403?id=${downloadId}`, {
         method: 'DELETE',
         headers: {
           'X-User-Id': user.id.toString()
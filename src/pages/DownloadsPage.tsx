@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
+import { apiFetch } from '@/lib/api';
 import Icon from '@/components/ui/icon';
 
 interface Download {
@@ -31,7 +32,7 @@ export default function DownloadsPage() {
 
   const loadDownloads = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
+      const response = await apiFetch('https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403', {
         method: 'GET',
         headers: {
           'X-User-Id': userId.toString()
@@ -94,7 +95,7 @@ export default function DownloadsPage() {
 
   const handleDelete = async (downloadId: number) => {
     try {
-      const response = await fetch(`https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403?id=${downloadId}`, {
+      const response = await apiFetch(`https://functions.poehali.dev/54d87de2-f3c7-4bbf-9d6b-236713ff4403?id=${downloadId}`, {
         method: 'DELETE',
         headers: {
           'X-User-Id': userId.toString()
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
+import { apiFetch } from '@/lib/api';
 
 const AUTH_API = 'https://functions.poehali.dev/44a8cf08-8c5f-4811-a6e2-d90d06b3b81f';
 const SEARCH_HISTORY_API = 'https://functions.poehali.dev/2b513cfe-e8a0-4a7d-afc3-c574697503ca';
@@ -72,8 +73,7 @@ const Index = () => {
 
   useEffect(() => {
     if (sessionToken) {
-      verifySession();
-      loadSearchHistory();
+      bootstrapSession();
     }
   }, [sessionToken]);
 
@@ -85,13 +85,13 @@ const Index = () => {
     localStorage.setItem('nikbrowser_bookmarks', JSON.stringify(bookmarks));
   }, [bookmarks]);
 
-  const verifySession = async () => {
+  const bootstrapSession = async () => {
     try {
-      const response = await fetch(AUTH_API, {
+      const response = await apiFetch(AUTH_API, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          action: 'verify_session',
+          action: 'bootstrap',
           session_token: sessionToken
         })
       });
@@ -101,11 +101,14 @@ const Index = () => {
       if (data.success) {
         setUser(data.user);
         localStorage.setItem('nikbrowser_user', JSON.stringify(data.user));
+        if (!incognito) {
+          setSearchHistory(data.history);
+        }
       } else {
         handleLogout();
       }
     } catch (error) {
-      console.error('Session verification failed:', error);
+      console.error('Session bootstrap failed:', error);
     }
   };
 
@@ -113,7 +116,7 @@ const Index = () => {
     if (!sessionToken || incognito) return;
     
     try {
-      const response = await fetch(`${SEARCH_HISTORY_API}?limit=50`, {
+      const response = await apiFetch(`${SEARCH_HISTORY_API}?limit=50`, {
         method: 'GET',
         headers: {
           'X-Session-Token': sessionToken
@@ -136,7 +139,7 @@ const Index = () => {
     setAuthLoading(true);
     
     try {
-      const response = await fetch(AUTH_API, {
+      const response = await apiFetch(AUTH_API, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -173,7 +176,7 @@ const Index = () => {
     setAuthLoading(true);
     
     try {
-      const response = await fetch(AUTH_API, {
+      const response = await apiFetch(AUTH_API, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -205,7 +208,7 @@ const Index = () => {
   const handleLogout = async () => {
     if (sessionToken) {
       try {
-        await fetch(AUTH_API, {
+        await apiFetch(AUTH_API, {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
           body: JSON.stringify({
@@ -230,7 +233,7 @@ const Index = () => {
     if (searchQuery.trim()) {
       if (sessionToken && !incognito) {
         try {
-          await fetch(SEARCH_HISTORY_API, {
+          await apiFetch(SEARCH_HISTORY_API, {
             method: 'POST',
             headers: {
               'Content-Type': 'application/json',
@@ -257,7 +260,7 @@ const Index = () => {
   const clearHistory = async () => {
     if (sessionToken) {
       try {
-        await fetch(SEARCH_HISTORY_API, {
+        await apiFetch(SEARCH_HISTORY_API, {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
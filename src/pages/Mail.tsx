@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
+import { apiFetch } from '@/lib/api';
 
 const MAIL_API = 'https://functions.poehali.dev/0eb93557-9a24-403f-b222-fdbfbed32c54';
 
@@ -63,7 +64,7 @@ const Mail = () => {
   const loadEmails = async () => {
     setLoading(true);
     try {
-      const response = await fetch(`${MAIL_API}?folder=${folder}&limit=100`, {
+      const response = await apiFetch(`${MAIL_API}?folder=${folder}&limit=100`, {
         method: 'GET',
         headers: {
           'X-Session-Token': sessionToken!
@@ -89,7 +90,7 @@ const Mail = () => {
     }
 
     try {
-      const response = await fetch(MAIL_API, {
+      const response = await apiFetch(MAIL_API, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -120,7 +121,7 @@ const Mail = () => {
 
   const markAsRead = async (emailId: number) => {
     try {
-      await fetch(MAIL_API, {
+      await apiFetch(MAIL_API, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -140,7 +141,7 @@ const Mail = () => {
 
   const toggleStar = async (emailId: number) => {
     try {
-      await fetch(MAIL_API, {
+      await apiFetch(MAIL_API, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -160,7 +161,7 @@ const Mail = () => {
 
   const archiveEmail = async (emailId: number) => {
     try {
-      await fetch(MAIL_API, {
+      await apiFetch(MAIL_API, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -0,0 +1,334 @@
+"""
+Локальный шлюз для всех функций backend/: нагрузочные и soak-тесты без облака.
+
+    python tools/dev_server.py [--port 8000] [--mode thread|process] [--max-containers 8]
+                               [--idle-ttl 300] [--cold-start-delay 0]
+
+Каждая папка backend/*/index.py с функцией handler доступна по пути
+/<имя функции>, например http://127.0.0.1:8000/mail?folder=inbox. HTTP-запрос
+переводится в event того же вида, что отдаёт платформа (httpMethod, headers,
+body, queryStringParameters, requestContext), ответ handler — обратно в HTTP.
+
+Функции работают как на платформе: контейнер обрабатывает один запрос за раз,
+свободные контейнеры переиспользуются (тёплый старт, пулы соединений и кэши
+модуля живы), новый контейнер заново импортирует модуль (холодный старт).
+Контейнер, простоявший без запросов дольше --idle-ttl, выбрасывается.
+Если все --max-containers контейнеров функции заняты дольше --queue-timeout,
+запрос получает 429, как при исчерпании лимита параллельности.
+
+--mode thread — контейнеры это отдельные экземпляры модуля в одном процессе
+(быстро стартуют, но делят GIL), --mode process — отдельные процессы,
+ближе к настоящей изоляции и честнее для CPU-нагрузки.
+
+Переменные окружения (DATABASE_URL, DATABASE_SHARDS, ...) функции берут из
+окружения шлюза. GET /_stats отдаёт счётчики по функциям: запросы, холодные
+старты, ошибки, живые контейнеры и перцентили задержки.
+"""
+
+import argparse
+import base64
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+_module_ids = itertools.count(1)
+
+def discover_functions() -> List[str]:
+    return sorted(path.parent.name for path in BACKEND_DIR.glob('*/index.py'))
+
+def load_handler(function: str):
+    # Уникальное имя модуля: у каждого контейнера свои глобальные пулы и кэши
+    spec = importlib.util.spec_from_file_location(
+        f"dev_{function.replace('-', '_')}_{next(_module_ids)}", BACKEND_DIR / function / 'index.py'
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+def make_context(function: str, request_id: str) -> SimpleNamespace:
+    return SimpleNamespace(request_id=request_id, function_name=function, function_version='local', memory_limit_in_mb=128)
+
+def invoke(handler, function: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return handler(event, make_context(function, event['requestContext']['requestId']))
+    except Exception:
+        traceback.print_exc()
+        return {'statusCode': 502, 'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'error': 'Function crashed'}), 'crashed': True}
+
+def process_worker(function: str, channel) -> None:
+    handler = load_handler(function)
+    channel.send('ready')
+    while True:
+        event = channel.recv()
+        if event is None:
+            return
+        channel.send(invoke(handler, function, event))
+
+class ThreadContainer:
+    '''Экземпляр модуля функции в процессе шлюза'''
+    def __init__(self, function: str):
+        self.function = function
+        self.handler = load_handler(function)
+        self.last_used = time.monotonic()
+    
+    def invoke(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        return invoke(self.handler, self.function, event)
+    
+    def stop(self) -> None:
+        pass
+
+class ProcessContainer:
+    '''Функция в отдельном процессе, события и ответы ходят через Pipe'''
+    def __init__(self, function: str):
+        self.function = function
+        self.channel, child = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=process_worker, args=(function, child), daemon=True
+        )
+        self.process.start()
+        # Без копии child в шлюзе смерть процесса видна как EOFError, а не вечное ожидание
+        child.close()
+        
+        try:
+            self.channel.recv()
+        except EOFError:
+            # Процесс упал при импорте модуля функции, трассировка уже в его stderr
+            self.process.join(timeout=5)
+            raise RuntimeError(f'Function {function} failed to start') from None
+        self.last_used = time.monotonic()
+    
+    def invoke(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            self.channel.send(event)
+            return self.channel.recv()
+        except (EOFError, OSError):
+            return {'statusCode': 502, 'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'error': 'Function process died'}), 'crashed': True}
+    
+    def stop(self) -> None:
+        try:
+            self.channel.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+class FunctionHost:
+    '''Тёплые контейнеры одной функции и лимит их числа'''
+    def __init__(self, function: str, options: argparse.Namespace):
+        self.function = function
+        self.options = options
+        self.container_class = ProcessContainer if options.mode == 'process' else ThreadContainer
+        self.idle: List[Any] = []
+        self.running = 0
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.cold_starts = 0
+        self.errors = 0
+        self.throttled = 0
+        self.latencies = deque(maxlen=10000)
+    
+    def acquire(self) -> Optional[Any]:
+        deadline = time.monotonic() + self.options.queue_timeout
+        expired = []
+        
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.idle and now - self.idle[0].last_used > self.options.idle_ttl:
+                    expired.append(self.idle.pop(0))
+                    self.running -= 1
+                
+                # Последний освободившийся контейнер самый тёплый
+                if self.idle:
+                    container = self.idle.pop()
+                    break
+                if self.running < self.options.max_containers:
+                    self.running += 1
+                    container = None
+                    break
+                if now >= deadline or not self.condition.wait(deadline - now):
+                    self.throttled += 1
+                    return None
+            
+            if container is None:
+                self.cold_starts += 1
+        
+        for old in expired:
+            old.stop()
+        
+        if container is None:
+            try:
+                time.sleep(self.options.cold_start_delay)
+                container = self.container_class(self.function)
+            except BaseException:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify()
+                raise
+        return container
+    
+    def release(self, container: Any, crashed: bool) -> None:
+        container.last_used = time.monotonic()
+        
+        with self.condition:
+            if crashed:
+                self.running -= 1
+            else:
+                self.idle.append(container)
+            self.condition.notify()
+        
+        if crashed:
+            container.stop()
+    
+    def handle(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        
+        try:
+            container = self.acquire()
+        except Exception:
+            # Ошибка импорта или упавший процесс: клиент получает 502, как при падении handler
+            traceback.print_exc()
+            container = None
+            response = {'statusCode': 502, 'headers': {'Content-Type': 'application/json'},
+                        'body': json.dumps({'error': 'Function failed to start'})}
+        else:
+            if container is None:
+                return {'statusCode': 429, 'headers': {'Content-Type': 'application/json', 'Retry-After': '1'},
+                        'body': json.dumps({'error': 'Too many concurrent requests'})}
+            
+            response = container.invoke(event)
+            crashed = bool(response.pop('crashed', False))
+            self.release(container, crashed)
+        
+        with self.condition:
+            self.requests += 1
+            self.errors += response.get('statusCode', 200) >= 500
+            self.latencies.append(time.perf_counter() - started)
+        return response
+    
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            latencies = sorted(self.latencies)
+            result = {
+                'requests': self.requests,
+                'cold_starts': self.cold_starts,
+                'errors': self.errors,
+                'throttled': self.throttled,
+                'containers': self.running,
+                'idle': len(self.idle),
+            }
+        for name, q in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            result[name] = round(latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000, 1) if latencies else None
+        return result
+    
+    def stop(self) -> None:
+        with self.condition:
+            containers, self.idle = self.idle, []
+        for container in containers:
+            container.stop()
+
+def make_event(method: str, path: str, headers: Dict[str, str], body: bytes, client_ip: str) -> Dict[str, Any]:
+    url = urlsplit(path)
+    query = dict(parse_qsl(url.query, keep_blank_values=True))
+    
+    try:
+        text, is_base64 = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text, is_base64 = base64.b64encode(body).decode(), True
+    
+    return {
+        'httpMethod': method,
+        'path': url.path,
+        'headers': headers,
+        'queryStringParameters': query,
+        'body': text,
+        'isBase64Encoded': is_base64,
+        'requestContext': {'requestId': uuid.uuid4().hex, 'identity': {'sourceIp': client_ip}},
+    }
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    hosts: Dict[str, FunctionHost] = {}
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+    
+    def dispatch(self) -> None:
+        function = urlsplit(self.path).path.strip('/').split('/')[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        
+        if function == '_stats' and self.command == 'GET':
+            response = {'statusCode': 200, 'headers': {'Content-Type': 'application/json'},
+                        'body': json.dumps({name: host.stats() for name, host in self.hosts.items()})}
+        elif function in self.hosts:
+            event = make_event(self.command, self.path, dict(self.headers.items()), body, self.client_address[0])
+            response = self.hosts[function].handle(event)
+        else:
+            response = {'statusCode': 404, 'headers': {'Content-Type': 'application/json'},
+                        'body': json.dumps({'error': f'Unknown function: {function}'})}
+        
+        payload = response.get('body') or ''
+        payload = base64.b64decode(payload) if response.get('isBase64Encoded') else payload.encode('utf-8')
+        
+        self.send_response(response.get('statusCode', 200))
+        for name, value in (response.get('headers') or {}).items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = dispatch
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Локальный шлюз функций backend/')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--max-containers', type=int, default=8, help='контейнеров на функцию')
+    parser.add_argument('--idle-ttl', type=float, default=300, help='секунд до выгрузки простаивающего контейнера')
+    parser.add_argument('--cold-start-delay', type=float, default=0, help='добавочная задержка холодного старта, с')
+    parser.add_argument('--queue-timeout', type=float, default=10, help='сколько ждать свободный контейнер до 429, с')
+    parser.add_argument('--functions', nargs='*', help='только эти функции (по умолчанию все из backend/)')
+    parser.add_argument('--verbose', action='store_true', help='писать каждый запрос в лог')
+    options = parser.parse_args()
+    
+    functions = options.functions or discover_functions()
+    GatewayHandler.hosts = {function: FunctionHost(function, options) for function in functions}
+    
+    server = ThreadingHTTPServer((options.host, options.port), GatewayHandler)
+    server.daemon_threads = True
+    server.verbose = options.verbose
+    
+    base_url = f"http://{options.host}:{server.server_port}"
+    print(json.dumps({function: f"{base_url}/{function}" for function in functions}, indent=2, ensure_ascii=False))
+    print(f"Режим {options.mode}, до {options.max_containers} контейнеров на функцию; статистика: {base_url}/_stats", flush=True)
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for host in GatewayHandler.hosts.values():
+            host.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Прогон backend/<функция>/tests.json локально, без облака.
+
+    python tools/function_tests.py [функция ...]
+
+DATABASE_URL должен указывать на свежую базу с применёнными db_migrations:
+кейсы auth регистрируют фиксированные адреса и ждут 200. Кейсы функции идут
+по порядку через её handler с одного адреса клиента, как тестовый прогон
+платформы; модуль импортируется заново для каждой функции (холодный старт),
+так что лимиты и кэши у каждого файла свои.
+
+Кейсы, которым нужен вошедший пользователь, шлют X-Session-Token: tests-session.
+Перед файлом каждой функции заводится новый пользователь с сессией под этим
+токеном, поэтому закладки, настройки и история каждого прогона начинаются
+с нуля, а кейсы внутри файла видят изменения друг друга.
+
+Сравнение как у платформы: expectedStatus, expectedHeaders и expectedBody
+с bodyMatcher partial — лишние поля ответа не мешают, "string", "number",
+"boolean", "object" и "array" проверяют только тип, список сверяется по
+первым элементам. Код выхода 1, если хоть один кейс не прошёл.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import uuid
+from typing import Any, Dict
+
+import psycopg2
+
+from dev_server import discover_functions, load_handler, make_context, make_event, BACKEND_DIR
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+TEST_SESSION_TOKEN = 'tests-session'
+TEST_CLIENT_IP = '198.51.100.7'
+
+TYPE_NAMES = {'string': str, 'number': (int, float), 'boolean': bool, 'object': dict, 'array': list}
+
+def create_test_session() -> None:
+    '''Новый пользователь, которому принадлежит TEST_SESSION_TOKEN; прежний владелец токена его теряет'''
+    if not DATABASE_URL:
+        sys.exit('DATABASE_URL не задан')
+    
+    suffix = uuid.uuid4().hex[:12]
+    token_hash = hashlib.sha256(TEST_SESSION_TOKEN.encode()).digest()
+    
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM sessions WHERE token_hash = %s", (token_hash,))
+            cur.execute("""
+                INSERT INTO users (email, password_hash, nikmail, display_name, created_at, updated_at)
+                VALUES (%s, '', %s, 'Tests', now(), now())
+                RETURNING id
+            """, (f"tests-{suffix}@example.com", f"tests-{suffix}@nikmail.ru"))
+            cur.execute("""
+                INSERT INTO sessions (user_id, token_hash, expires_at, created_at)
+                VALUES (%s, %s, now() + interval '1 hour', now())
+            """, (cur.fetchone()[0], token_hash))
+    finally:
+        conn.close()
+
+def matches(expected: Any, actual: Any) -> bool:
+    if isinstance(expected, str) and expected in TYPE_NAMES:
+        return isinstance(actual, TYPE_NAMES[expected]) and not (expected == 'number' and isinstance(actual, bool))
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(key in actual and matches(value, actual[key]) for key, value in expected.items())
+    if isinstance(expected, list):
+        return (isinstance(actual, list) and len(actual) >= len(expected)
+                and all(matches(item, actual_item) for item, actual_item in zip(expected, actual)))
+    return expected == actual
+
+def run_case(handler, function: str, case: Dict[str, Any]) -> str:
+    '''Пустая строка, если ответ совпал с ожидаемым, иначе что именно не так'''
+    body = json.dumps(case['body']).encode() if 'body' in case else b''
+    event = make_event(case['method'], case.get('path', '/'), case.get('headers') or {}, body, TEST_CLIENT_IP)
+    response = handler(event, make_context(function, event['requestContext']['requestId']))
+    
+    status = response.get('statusCode', 200)
+    if status != case['expectedStatus']:
+        return f"статус {status}, ждали {case['expectedStatus']}: {(response.get('body') or '')[:200]}"
+    
+    headers = response.get('headers') or {}
+    for name, value in (case.get('expectedHeaders') or {}).items():
+        if headers.get(name) != value:
+            return f"заголовок {name}: {headers.get(name)!r}, ждали {value!r}"
+    
+    if 'expectedBody' in case:
+        actual = json.loads(response['body']) if response.get('body') else None
+        if not matches(case['expectedBody'], actual):
+            return f"тело {(response.get('body') or '')[:200]}"
+    return ''
+
+def run_function(function: str) -> int:
+    cases = json.loads((BACKEND_DIR / function / 'tests.json').read_text(encoding='utf-8'))['tests']
+    create_test_session()
+    handler = load_handler(function)
+    
+    failures = 0
+    for case in cases:
+        problem = run_case(handler, function, case)
+        failures += bool(problem)
+        print(f"FAIL {function}: {case['name']}: {problem}" if problem else f"ok   {function}: {case['name']}")
+    return failures
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Прогон tests.json функций backend/')
+    parser.add_argument('functions', nargs='*', help='только эти функции (по умолчанию все из backend/)')
+    args = parser.parse_args()
+    
+    functions = args.functions or [function for function in discover_functions() if (BACKEND_DIR / function / 'tests.json').exists()]
+    failures = sum(run_function(function) for function in functions)
+    print(f"Не прошли: {failures}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
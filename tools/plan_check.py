@@ -0,0 +1,285 @@
+"""
+Проверка планов запросов функций backend/ на базе, заполненной до боевых объёмов.
+
+    python tools/plan_check.py seed [--users N]
+    python tools/plan_check.py check [--max-cost COST] [--verbose]
+
+DATABASE_URL должен указывать на отдельную базу с применёнными db_migrations —
+seed наполняет её синтетическими пользователями, письмами, историей и т.д.
+и отказывается работать, если в users уже есть строки.
+
+check собирает все SQL функций: реестры STATEMENTS (модули импортируются,
+поэтому проверяется ровно тот текст, что уходит в PREPARE) и строковые
+запросы из вызовов cur.execute (%s заменяются на $1, $2, ...). Для каждого
+строится generic-план — тот, который Postgres кэширует для подготовленного
+запроса, — через EXPLAIN (FORMAT JSON) EXECUTE. Запрос не проходит, если
+в плане есть Seq Scan по таблице, Sort под Limit (LIMIT без индекса
+в порядке ORDER BY) или оценка стоимости выше --max-cost.
+Код выхода 1, если хоть один запрос не прошёл, — так проверку можно ставить
+в CI после каждой миграции.
+
+Запросы, собранные на лету (f-строкой, .format(), склейкой или в локальной
+переменной), проверить статически нельзя: они перечисляются как пропущенные,
+а не теряются молча.
+"""
+
+import argparse
+import ast
+import importlib.util
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import psycopg2
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+FUNCTIONS = ['auth', 'mail', 'search-history', 'downloads', 'bookmarks', 'settings']
+PLAN_MAX_COST = float(os.environ.get('PLAN_MAX_COST', '5000'))
+
+# Таблицы, где полный проход — осознанное решение, с причиной
+SEQ_SCAN_ALLOWED = {
+    # Ночная чистка sweep_sessions; индекс по updated_at сделал бы каждый UPSERT лимитера не-HOT обновлением
+    'rate_limit_buckets': 'чистка корзин раз в сутки',
+}
+
+# Синтетические данные: объёмы на одного пользователя и доли флагов подобраны
+# под распределения, которые видит продакшен
+SEED_SQL = """
+    INSERT INTO users (email, phone, password_hash, nikmail, display_name, created_at, updated_at)
+    SELECT 'user' || g || '@example.com', CASE WHEN g % 2 = 0 THEN '+7' || lpad(g::text, 10, '0') END,
+           md5(g::text), 'user' || g, 'User ' || g, now() - g * interval '1 minute', now()
+    FROM generate_series(1, {users}) g;
+
+    INSERT INTO sessions (user_id, token_hash, expires_at, created_at)
+    SELECT id, sha256(convert_to(id || ':' || k, 'UTF8')), now() + (k - 2) * interval '30 days', now()
+    FROM users, generate_series(1, 3) k;
+
+    INSERT INTO user_settings (user_id, dark_mode, default_search_engine, settings_json, updated_at)
+    SELECT id, id % 3 = 0, 'google', '{{"homepage": "https://example.com"}}', now() FROM users;
+
+    INSERT INTO user_shards (user_id, shard)
+    SELECT id, 0 FROM users WHERE id % 10 = 0;
+
+    INSERT INTO revoked_tokens (jti, expires_at, revoked_at)
+    SELECT md5('jti' || g), now() + (g % 60 - 30) * interval '1 day', now() - (g % 30) * interval '1 day'
+    FROM generate_series(1, {users} / 2) g;
+
+    INSERT INTO mail_bodies (body_hash, body)
+    SELECT sha256(convert_to('Текст письма ' || g, 'UTF8')), 'Текст письма ' || g
+    FROM generate_series(0, {bodies} - 1) g;
+
+    INSERT INTO emails (user_id, from_email, from_name, to_email, subject, body_hash, thread_id,
+                        is_read, is_starred, is_archived, created_at, snoozed_until)
+    SELECT u.id, 'sender' || (g % 997) || '@example.com', 'Sender ' || (g % 997), 'user' || u.id || '@nikmail.ru',
+           'Тема ' || (g % 10), sha256(convert_to('Текст письма ' || (g % {bodies}), 'UTF8')),
+           CASE WHEN g % 1000 <> 0 THEN u.id::bigint * 100 + g % 10 END,
+           g % 3 <> 0, g % 20 = 0, g % 10 = 0, now() - g * interval '1 second',
+           CASE WHEN g % 100 = 1 THEN now() + interval '1 day' END
+    FROM users u, generate_series(1, {emails}) g;
+
+    INSERT INTO mail_threads (user_id, thread_id, subject, participants, message_count, unread_count,
+                              last_email_id, last_from_email, last_from_name, last_at)
+    SELECT user_id, thread_id, max(subject), ARRAY[max(from_email), max(to_email)], count(*),
+           count(*) FILTER (WHERE NOT is_read), max(id), max(from_email), max(from_name), max(created_at)
+    FROM emails
+    WHERE thread_id IS NOT NULL
+    GROUP BY user_id, thread_id;
+
+    INSERT INTO mail_folder_heads (user_id, folder, generation, emails, built_at)
+    SELECT u.id, folder, 0, CASE WHEN u.id % 2 = 0 THEN '[]' END, now()
+    FROM users u, unnest(ARRAY['inbox', 'starred', 'archived']) folder;
+
+    INSERT INTO mail_outbox (user_id, template, payload, created_at)
+    SELECT id, 'welcome', '{{}}', now() FROM users WHERE id % 5 = 0;
+
+    INSERT INTO mail_delivery_queue (due_at, kind, user_id, payload)
+    SELECT now() + (id % 1000) * interval '1 minute', 'send', id, '{{}}' FROM users;
+
+    INSERT INTO search_history (user_id, search_query, search_engine, created_at, is_incognito)
+    SELECT u.id, 'запрос ' || (g % 500), 'google', now() - g * interval '1 minute', g % 20 = 0
+    FROM users u, generate_series(1, {history}) g;
+
+    INSERT INTO search_daily_stats (user_id, day, search_engine, searches)
+    SELECT user_id, created_at::date, search_engine, count(*)
+    FROM search_history WHERE is_incognito = false
+    GROUP BY 1, 2, 3;
+
+    INSERT INTO search_top_queries (user_id, normalized_query, search_query, searches, last_searched_at)
+    SELECT user_id, search_query, search_query, count(*), max(created_at)
+    FROM search_history WHERE is_incognito = false
+    GROUP BY 1, 2;
+
+    INSERT INTO download_catalog (url_hash, file_url)
+    SELECT sha256(convert_to('https://example.com/file' || g || '.zip', 'UTF8')), 'https://example.com/file' || g || '.zip'
+    FROM generate_series(0, {catalog} - 1) g;
+
+    INSERT INTO downloads (user_id, url_hash, file_name, file_size, file_type, download_status, progress,
+                           created_at, completed_at, is_installed)
+    SELECT u.id, sha256(convert_to('https://example.com/file' || ((u.id * {downloads} + g) % {catalog}) || '.zip', 'UTF8')),
+           'file' || g || '.zip', 1048576, 'application/zip', CASE WHEN g % 7 = 0 THEN 'deleted' ELSE 'completed' END,
+           100, now() - g * interval '1 hour', now() - g * interval '1 hour', g % 4 = 0
+    FROM users u, generate_series(1, {downloads}) g;
+
+    INSERT INTO bookmarks (user_id, name, url, icon, folder, created_at, updated_at)
+    SELECT u.id, 'Закладка ' || g, 'https://example.com/' || g, '⭐',
+           CASE WHEN g % 3 <> 0 THEN 'Папка ' || (g % 4) END, now() - g * interval '1 day', now()
+    FROM users u, generate_series(1, {bookmarks}) g;
+
+    INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at)
+    SELECT md5('bucket' || g), 10, extract(epoch FROM now()) - g FROM generate_series(1, {users}) g;
+"""
+
+def connect():
+    if not DATABASE_URL:
+        sys.exit('DATABASE_URL не задан')
+    return psycopg2.connect(DATABASE_URL)
+
+def seed(users: int) -> None:
+    conn = connect()
+    cur = conn.cursor()
+    
+    cur.execute("SELECT EXISTS (SELECT 1 FROM users)")
+    if cur.fetchone()[0]:
+        sys.exit('В users уже есть строки: seed запускается только на пустой базе')
+    
+    sizes = {'users': users, 'emails': 40, 'bodies': users * 10, 'history': 40, 'downloads': 10, 'catalog': users * 5, 'bookmarks': 20}
+    print(f"Заполняем базу: {users} пользователей, {users * sizes['emails']} писем")
+    cur.execute(SEED_SQL.format(**sizes))
+    conn.commit()
+    
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE")
+    print("Готово")
+    conn.close()
+
+def load_function(function: str):
+    spec = importlib.util.spec_from_file_location(
+        f"plan_check_{function.replace('-', '_')}", BACKEND_DIR / function / 'index.py'
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def to_positional(sql: str) -> str:
+    counter = iter(range(1, 1000))
+    return re.sub(r'%s', lambda _: f"${next(counter)}", sql)
+
+def collect_statements(function: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    '''(метка, SQL с $n) всех запросов функции и (метка, причина) пропущенных динамических запросов'''
+    module = load_function(function)
+    statements = [(f"{function}:{name}", sql) for name, sql in module.STATEMENTS.items()]
+    skipped = []
+    
+    tree = ast.parse((BACKEND_DIR / function / 'index.py').read_text(encoding='utf-8'))
+    # execute_prepared сам шлёт PREPARE/EXECUTE для STATEMENTS, они уже в списке выше
+    prepared_calls = {
+        id(node) for func in ast.walk(tree)
+        if isinstance(func, ast.FunctionDef) and func.name == 'execute_prepared'
+        for node in ast.walk(func)
+    }
+    
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == 'execute' and node.args) or id(node) in prepared_calls:
+            continue
+        
+        query = node.args[0]
+        label = f"{function}:{node.lineno}"
+        if isinstance(query, ast.Constant) and isinstance(query.value, str):
+            statements.append((label, to_positional(query.value)))
+        elif isinstance(query, ast.Name) and isinstance(getattr(module, query.id, None), str) and query.id.isupper():
+            statements.append((label, to_positional(getattr(module, query.id))))
+        elif isinstance(query, ast.JoinedStr):
+            skipped.append((label, 'запрос собирается f-строкой'))
+        else:
+            # .format(), склейка, локальная переменная: текст известен только во время вызова
+            skipped.append((label, f"запрос не литерал и не константа модуля: {ast.unparse(query)[:60]}"))
+    
+    return statements, skipped
+
+def plan_nodes(plan: Dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def explain(cur, sql: str) -> Dict:
+    cur.execute(f"PREPARE plan_check AS {sql}")
+    try:
+        cur.execute("SELECT cardinality(parameter_types) FROM pg_prepared_statements WHERE name = 'plan_check'")
+        params = cur.fetchone()[0]
+        # NULL вместо значений: при force_generic_plan они не подставляются в план
+        cur.execute(f"EXPLAIN (FORMAT JSON) EXECUTE plan_check ({', '.join(['NULL'] * params)})" if params
+                    else "EXPLAIN (FORMAT JSON) EXECUTE plan_check")
+        return cur.fetchone()[0][0]['Plan']
+    finally:
+        cur.execute("DEALLOCATE plan_check")
+
+def check(max_cost: float, verbose: bool) -> int:
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SET plan_cache_mode = force_generic_plan")
+    
+    failures = 0
+    for function in FUNCTIONS:
+        statements, skipped = collect_statements(function)
+        
+        for label, sql in statements:
+            try:
+                plan = explain(cur, sql)
+            except psycopg2.Error as e:
+                failures += 1
+                print(f"FAIL {label}: {str(e).strip().splitlines()[0]}")
+                continue
+            
+            problems = [
+                f"Seq Scan on {node['Relation Name']}"
+                for node in plan_nodes(plan)
+                if node['Node Type'] == 'Seq Scan' and node['Relation Name'] not in SEQ_SCAN_ALLOWED
+            ]
+            # Sort под Limit значит, что индекс не отдаёт строки в нужном порядке и ради
+            # первых N читается всё, что подошло под WHERE, — стоимость растёт с размером ящика
+            problems += [
+                f"Sort ({', '.join(sort['Sort Key'])}) before Limit"
+                for node in plan_nodes(plan) if node['Node Type'] == 'Limit'
+                for sort in plan_nodes(node) if sort['Node Type'] == 'Sort'
+            ]
+            if plan['Total Cost'] > max_cost:
+                problems.append(f"cost {plan['Total Cost']:.0f} > {max_cost:.0f}")
+            
+            if problems:
+                failures += 1
+                print(f"FAIL {label}: {'; '.join(problems)}")
+            elif verbose:
+                print(f"ok   {label}: cost {plan['Total Cost']:.0f}")
+        
+        for label, reason in skipped:
+            print(f"skip {label}: {reason}")
+    
+    print(f"Не прошли проверку: {failures}")
+    conn.close()
+    return 1 if failures else 0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Проверка планов запросов функций')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    seed_parser = commands.add_parser('seed')
+    seed_parser.add_argument('--users', type=int, default=20000)
+    
+    check_parser = commands.add_parser('check')
+    check_parser.add_argument('--max-cost', type=float, default=PLAN_MAX_COST)
+    check_parser.add_argument('--verbose', action='store_true')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'seed':
+        seed(args.users)
+    else:
+        sys.exit(check(args.max_cost, args.verbose))
+
+if __name__ == '__main__':
+    main()
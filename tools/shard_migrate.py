@@ -0,0 +1,303 @@
+"""
+Перенос строк пользователя между шардами (DATABASE_SHARDS) без остановки сервиса.
+
+    python tools/shard_migrate.py move USER_ID TARGET_SHARD
+    python tools/shard_migrate.py pin-for-growth NEW_SHARD_COUNT
+
+move:
+  1. в user_shards ставится moving_to — функции перестают писать в таблицы
+     пользователя (503 + Retry-After), чтение продолжается со старого шарда;
+  2. ждём SHARD_DIRECTORY_TTL, пока все контейнеры увидят отметку;
+  3. строки USER_TABLES копируются на целевой шард одной транзакцией;
+  4. справочник переключается на новый шард, снова ждём TTL;
+  5. строки удаляются со старого шарда пачками.
+Идентификаторы строк на новом шарде выдаёт его последовательность.
+
+pin-for-growth закрепляет за текущими шардами всех пользователей, чей jump-хэш
+изменится при переходе на NEW_SHARD_COUNT шардов. Запускается до того, как
+в DATABASE_SHARDS добавят новые базы; дальше таких пользователей можно
+переносить командой move по одному.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import List
+
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor, execute_values
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+SHARD_DSNS: List[str] = json.loads(os.environ['DATABASE_SHARDS']) if os.environ.get('DATABASE_SHARDS') else [DATABASE_URL]
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', '60'))
+BATCH_SIZE = int(os.environ.get('SHARD_MIGRATE_BATCH', '5000'))
+
+# Таблицы, строки которых принадлежат пользователю и живут на его шарде
+USER_TABLES = ['emails', 'search_history', 'downloads']
+# Сводки без собственного id: на новом шарде строятся заново, на старом удаляются целиком
+ROLLUP_TABLES = ['search_daily_stats', 'search_top_queries']
+# Кэши первых страниц почты просто удаляются на обоих шардах, чтение построит их заново
+CACHE_TABLES = ['mail_folder_heads']
+
+# Сводка переписок ссылается на id писем, а на новом шарде они другие, поэтому её не копируем,
+# а строим заново по письмам (тот же запрос, что у maintenance-действия rebuild_threads)
+THREAD_REBUILD_SQL = """
+    INSERT INTO mail_threads (user_id, thread_id, subject, participants, message_count, unread_count,
+                              last_email_id, last_from_email, last_from_name, last_at)
+    SELECT DISTINCT ON (user_id, thread_id)
+           user_id, thread_id, subject,
+           ARRAY(SELECT DISTINCT lower(trim(address)) FROM unnest(ARRAY[from_email, to_email]) address ORDER BY 1),
+           count(*) OVER thread, count(*) FILTER (WHERE is_read IS NOT TRUE) OVER thread,
+           id, from_email, from_name, created_at
+    FROM emails
+    WHERE user_id = ANY(%s) AND thread_id IS NOT NULL
+    WINDOW thread AS (PARTITION BY user_id, thread_id)
+    ORDER BY user_id, thread_id, created_at DESC, id DESC
+"""
+
+# Сводки аналитики поиска тоже пересчитываются из самой истории, а не копируются
+SEARCH_ROLLUP_REBUILD_SQL = [
+    """
+    INSERT INTO search_daily_stats (user_id, day, search_engine, searches)
+    SELECT user_id, created_at::date, COALESCE(search_engine, 'google'), count(*)
+    FROM search_history
+    WHERE user_id = %(user_id)s AND is_incognito = false
+    GROUP BY 1, 2, 3
+    """,
+    """
+    INSERT INTO search_top_queries (user_id, normalized_query, search_query, searches, last_searched_at)
+    SELECT DISTINCT ON (left(lower(trim(search_query)), 256))
+           user_id, left(lower(trim(search_query)), 256), search_query,
+           count(*) OVER (PARTITION BY left(lower(trim(search_query)), 256)), created_at
+    FROM search_history
+    WHERE user_id = %(user_id)s AND is_incognito = false
+    ORDER BY left(lower(trim(search_query)), 256), created_at DESC, id DESC
+    """,
+]
+
+def jump_hash(key: int, buckets: int) -> int:
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def connect(dsn: str):
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+
+def current_shard(home_cur, user_id: int) -> int:
+    home_cur.execute("SELECT shard FROM user_shards WHERE user_id = %s", (user_id,))
+    row = home_cur.fetchone()
+    return row['shard'] if row else jump_hash(user_id, len(SHARD_DSNS))
+
+def copy_mail_bodies(source_cur, target_cur, user_id: int) -> None:
+    # Тексты писем общие для всех писем шарда: копируем те, на которые ссылается пользователь
+    source_cur.execute("""
+        SELECT body_hash, body, body_zlib, created_at
+        FROM mail_bodies
+        WHERE body_hash IN (SELECT body_hash FROM emails WHERE user_id = %s)
+    """, (user_id,))
+    
+    while True:
+        rows = source_cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        execute_values(target_cur, """
+            INSERT INTO mail_bodies (body_hash, body, body_zlib, created_at) VALUES %s
+            ON CONFLICT (body_hash) DO NOTHING
+        """, [(row['body_hash'], row['body'], row['body_zlib'], row['created_at']) for row in rows])
+
+def copy_download_catalog(source_cur, target_cur, user_id: int) -> None:
+    # URL загрузок тоже общие для шарда; на старом шарде записи каталога остаются,
+    # их по-прежнему могут использовать другие пользователи и кэши контейнеров
+    source_cur.execute("""
+        SELECT url_hash, file_url, created_at
+        FROM download_catalog
+        WHERE url_hash IN (SELECT url_hash FROM downloads WHERE user_id = %s)
+    """, (user_id,))
+    
+    while True:
+        rows = source_cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        execute_values(target_cur, """
+            INSERT INTO download_catalog (url_hash, file_url, created_at) VALUES %s
+            ON CONFLICT (url_hash) DO NOTHING
+        """, [(row['url_hash'], row['file_url'], row['created_at']) for row in rows])
+
+def copy_user_rows(source, target, user_id: int) -> None:
+    source_cur = source.cursor()
+    target_cur = target.cursor()
+    
+    copy_mail_bodies(source_cur, target_cur, user_id)
+    copy_download_catalog(source_cur, target_cur, user_id)
+    
+    for table in USER_TABLES:
+        # Остатки прошлой неудачной попытки
+        target_cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+        
+        last_id = 0
+        while True:
+            source_cur.execute(
+                f"SELECT * FROM {table} WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s",
+                (user_id, last_id, BATCH_SIZE)
+            )
+            rows = source_cur.fetchall()
+            if not rows:
+                break
+            
+            columns = [column for column in rows[0].keys() if column != 'id']
+            execute_values(
+                target_cur,
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                [tuple(json.dumps(row[c]) if isinstance(row[c], (dict, list)) else row[c] for c in columns) for row in rows]
+            )
+            last_id = rows[-1]['id']
+            print(f"  {table}: скопировано до id {last_id}")
+    
+    target_cur.execute("DELETE FROM mail_threads WHERE user_id = %s", (user_id,))
+    target_cur.execute(THREAD_REBUILD_SQL, ([user_id],))
+    
+    for table in ROLLUP_TABLES + CACHE_TABLES:
+        target_cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+    for sql in SEARCH_ROLLUP_REBUILD_SQL:
+        target_cur.execute(sql, {'user_id': user_id})
+    
+    source.rollback()
+    target.commit()
+
+def delete_user_rows(source, user_id: int) -> None:
+    cur = source.cursor()
+    cur.execute("SELECT DISTINCT body_hash FROM emails WHERE user_id = %s", (user_id,))
+    body_hashes = [row['body_hash'] for row in cur.fetchall()]
+    cur.execute("DELETE FROM mail_threads WHERE user_id = %s", (user_id,))
+    for table in ROLLUP_TABLES + CACHE_TABLES:
+        cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+    source.commit()
+    
+    for table in USER_TABLES:
+        while True:
+            cur.execute(f"""
+                DELETE FROM {table}
+                WHERE id IN (SELECT id FROM {table} WHERE user_id = %s LIMIT %s)
+            """, (user_id, BATCH_SIZE))
+            deleted = cur.rowcount
+            source.commit()
+            if deleted < BATCH_SIZE:
+                break
+    
+    for start in range(0, len(body_hashes), BATCH_SIZE):
+        try:
+            cur.execute("""
+                DELETE FROM mail_bodies b
+                WHERE b.body_hash = ANY(%s)
+                  AND NOT EXISTS (SELECT 1 FROM emails e WHERE e.body_hash = b.body_hash)
+            """, (body_hashes[start:start + BATCH_SIZE],))
+            source.commit()
+        except psycopg2.errors.ForeignKeyViolation:
+            # На текст только что сослалось новое письмо — значит, он ещё нужен
+            source.rollback()
+
+def move_user(user_id: int, target_shard: int) -> None:
+    if not 0 <= target_shard < len(SHARD_DSNS):
+        sys.exit(f"Нет шарда {target_shard}, всего шардов: {len(SHARD_DSNS)}")
+    
+    home = connect(DATABASE_URL)
+    home_cur = home.cursor()
+    source_shard = current_shard(home_cur, user_id)
+    
+    if source_shard == target_shard:
+        print(f"Пользователь {user_id} уже на шарде {target_shard}")
+        return
+    
+    print(f"Пользователь {user_id}: шард {source_shard} -> {target_shard}")
+    home_cur.execute("""
+        INSERT INTO user_shards (user_id, shard, moving_to, updated_at)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET moving_to = EXCLUDED.moving_to, updated_at = EXCLUDED.updated_at
+    """, (user_id, source_shard, target_shard, datetime.utcnow()))
+    home.commit()
+    
+    print(f"Ждём {SHARD_DIRECTORY_TTL:.0f} с, пока контейнеры увидят блокировку записи")
+    time.sleep(SHARD_DIRECTORY_TTL + 1)
+    
+    source = connect(SHARD_DSNS[source_shard])
+    target = connect(SHARD_DSNS[target_shard])
+    
+    try:
+        copy_user_rows(source, target, user_id)
+    except Exception:
+        target.rollback()
+        home_cur.execute("UPDATE user_shards SET moving_to = NULL, updated_at = %s WHERE user_id = %s", (datetime.utcnow(), user_id))
+        home.commit()
+        raise
+    
+    home_cur.execute("""
+        UPDATE user_shards SET shard = %s, moving_to = NULL, updated_at = %s WHERE user_id = %s
+    """, (target_shard, datetime.utcnow(), user_id))
+    home.commit()
+    
+    print(f"Справочник переключён, ждём {SHARD_DIRECTORY_TTL:.0f} с перед удалением старых строк")
+    time.sleep(SHARD_DIRECTORY_TTL + 1)
+    
+    delete_user_rows(source, user_id)
+    print("Готово")
+    
+    for conn in (home, source, target):
+        conn.close()
+
+def pin_for_growth(new_count: int) -> None:
+    home = connect(DATABASE_URL)
+    cur = home.cursor()
+    last_id = 0
+    pinned = 0
+    
+    while True:
+        cur.execute("SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s", (last_id, BATCH_SIZE))
+        ids = [row['id'] for row in cur.fetchall()]
+        if not ids:
+            break
+        
+        moved = [
+            (user_id, jump_hash(user_id, len(SHARD_DSNS)))
+            for user_id in ids
+            if jump_hash(user_id, len(SHARD_DSNS)) != jump_hash(user_id, new_count)
+        ]
+        if moved:
+            execute_values(cur, """
+                INSERT INTO user_shards (user_id, shard) VALUES %s
+                ON CONFLICT (user_id) DO NOTHING
+            """, moved)
+        home.commit()
+        
+        pinned += len(moved)
+        last_id = ids[-1]
+    
+    print(f"Закреплено пользователей: {pinned}")
+    home.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Перенос пользователей между шардами')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    move = commands.add_parser('move')
+    move.add_argument('user_id', type=int)
+    move.add_argument('target_shard', type=int)
+    
+    grow = commands.add_parser('pin-for-growth')
+    grow.add_argument('new_shard_count', type=int)
+    
+    args = parser.parse_args()
+    
+    if args.command == 'move':
+        move_user(args.user_id, args.target_shard)
+    else:
+        pin_for_growth(args.new_shard_count)
+
+if __name__ == '__main__':
+    main()